@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""Benchmark the background subtraction in `plate-solver`.
+
+Times `background.subtract_background` and reports the peak memory (RSS) of
+the process for a full PANOPTES frame (5208 x 3476, about 18 MP). With
+`--legacy` the previous `panoptes.utils.images.bayer` path is run as well,
+which needs `panoptes-utils` and `photutils`.
+
+Each method runs in a new process, so the peaks do not include each other.
+Without a FITS file a synthetic frame is used:
+
+    cd $PANDIR/panoptes-network
+    python benchmarks/bench_background.py
+    python benchmarks/bench_background.py --fits /var/panoptes/images/test-image.fits.fz --legacy
+"""
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import click
+import numpy as np
+from astropy.io import fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'plate-solver'))
+
+# A PANOPTES frame from the CR2 files.
+IMAGE_SHAPE = (3476, 5208)
+
+BACKGROUND_CONFIG = {
+    "camera_bias": 2048.,
+    "filter_size": 3,
+    "box_size": (84, 84),
+}
+
+
+def make_frame(path, seed=42):
+    """Write a synthetic bayer frame with a sloped background and stars."""
+    rng = np.random.default_rng(seed)
+    height, width = IMAGE_SHAPE
+    data = np.empty(IMAGE_SHAPE, dtype=np.uint16)
+    x = np.arange(width, dtype=np.float32)
+    for row in range(0, height, 500):
+        rows = np.arange(row, min(row + 500, height), dtype=np.float32)[:, None]
+        block = 2048 + 300 + 0.02 * x + 0.01 * rows + rng.normal(0, 20, (len(rows), width)).astype(np.float32)
+        data[row:row + len(rows)] = np.clip(block, 0, 65535)
+    data[1::2, 0::2] += 100
+    data[rng.integers(0, height, 5000), rng.integers(0, width, 5000)] = 60000
+
+    fits.PrimaryHDU(data=data).writeto(path, overwrite=True)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def lean_background(path):
+    import background
+
+    data = fits.getdata(path)
+    rss_after_read = peak_rss_mb()
+    t0 = time.time()
+    subtracted, _ = background.subtract_background(data, **BACKGROUND_CONFIG)
+    return time.time() - t0, rss_after_read
+
+
+def legacy_background(path):
+    from panoptes.utils.images import bayer
+    from panoptes.utils.images import fits as fits_utils
+
+    data = fits_utils.getdata(path)
+    rss_after_read = peak_rss_mb()
+    t0 = time.time()
+    rgb_backs = bayer.get_rgb_background(path, return_separate=True, **BACKGROUND_CONFIG)
+    rgb_masks = bayer.get_rgb_masks(fits_utils.getdata(path))
+    full_background = np.array([np.ma.array(data=d0.background, mask=m0).filled(0)
+                                for d0, m0
+                                in zip(rgb_backs, rgb_masks)]).sum(0)
+    subtracted = (data - full_background).copy()
+    return time.time() - t0, rss_after_read
+
+
+def run_method(method, path, results):
+    elapsed, rss_after_read = method(path)
+    results.put((elapsed, rss_after_read, peak_rss_mb()))
+
+
+@click.command()
+@click.option('--fits', 'fits_path', default=None, help='A FITS image, default a synthetic frame.')
+@click.option('--legacy', is_flag=True, help='Also run the previous panoptes-utils background.')
+def main(fits_path, legacy):
+    methods = [('lean', lean_background)]
+    if legacy:
+        methods.append(('legacy', legacy_background))
+
+    mp_context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if fits_path is None:
+            fits_path = os.path.join(tmp_dir, 'frame.fits')
+            make_frame(fits_path)
+
+        frame_mb = np.prod(IMAGE_SHAPE) * 2 / 2**20
+        print(f'Frame {IMAGE_SHAPE[1]}x{IMAGE_SHAPE[0]} uint16, {frame_mb:.0f} MB')
+        for name, method in methods:
+            results = mp_context.Queue()
+            process = mp_context.Process(target=run_method, args=(method, fits_path, results))
+            process.start()
+            elapsed, rss_after_read, peak_rss = results.get()
+            process.join()
+
+            print(f'{name:>7}: {elapsed:6.2f} sec  peak RSS {peak_rss:7.0f} MB  '
+                  f'({peak_rss - rss_after_read:+.0f} MB after reading the frame)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Benchmark the catalog footprint lookups in `lookup-catalog-sources`.
+
+Times `catalog.LocalCatalog` for a set of random PANOPTES-sized footprints and,
+with `--bigquery`, the BigQuery path used by default for the same footprints.
+
+Without `--catalog-dir` a synthetic catalog is built first, which is enough to
+time the local engine but not to compare the results with BigQuery:
+
+    cd $PANDIR/panoptes-network
+    python benchmarks/bench_catalog_lookup.py --num-stars 5000000
+    python benchmarks/bench_catalog_lookup.py --catalog-dir /var/panoptes/catalog --bigquery
+"""
+import os
+import sys
+import tempfile
+import time
+
+import click
+import numpy as np
+import pyarrow as pa
+from astropy.wcs import WCS
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lookup-catalog-sources'))
+
+import build_catalog  # noqa: E402
+import catalog  # noqa: E402
+
+# A PANOPTES camera: 5208 x 3476 pixels at about 10.3 arcsec per pixel.
+IMAGE_SHAPE = (5208, 3476)
+PIXEL_SCALE = 10.3 / 3600
+
+
+def make_wcs(ra, dec):
+    """Make a simple TAN WCS for an image centered on the coordinates."""
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [IMAGE_SHAPE[0] / 2, IMAGE_SHAPE[1] / 2]
+    wcs.wcs.cdelt = [-PIXEL_SCALE, PIXEL_SCALE]
+    wcs.pixel_shape = IMAGE_SHAPE
+
+    return wcs
+
+
+def build_synthetic_catalog(output_dir, num_stars, seed=42):
+    """Build a local catalog of stars spread uniformly over the sky."""
+    rng = np.random.default_rng(seed)
+    ra = rng.uniform(0, 360, num_stars)
+    dec = np.degrees(np.arcsin(rng.uniform(-1, 1, num_stars)))
+    vmag = rng.uniform(catalog.VMAG_MIN, catalog.VMAG_MAX, num_stars)
+
+    def read_band(dec_min, dec_max, vmag_min, vmag_max):
+        in_band = (dec >= dec_min) & (dec < dec_max)
+        return pa.table({
+            'picid': np.flatnonzero(in_band),
+            'twomass': pa.array(['00000000+0000000'] * int(in_band.sum())),
+            'gaia': pa.array(['0000000000000000000'] * int(in_band.sum())),
+            'catalog_ra': ra[in_band],
+            'catalog_dec': dec[in_band],
+            'catalog_vmag': vmag[in_band],
+            'catalog_vmag_bin': np.floor(vmag[in_band]).astype(int),
+            'catalog_vmag_err': np.full(int(in_band.sum()), 0.1),
+        })
+
+    return build_catalog.write_catalog(read_band, output_dir)
+
+
+@click.command()
+@click.option('--catalog-dir', default=None, help='A catalog built with build_catalog.py.')
+@click.option('--num-stars', default=2_000_000, help='Size of the synthetic catalog.')
+@click.option('--num-lookups', default=20, help='Number of random footprints.')
+@click.option('--bigquery', is_flag=True, help='Also time the BigQuery lookups.')
+def main(catalog_dir, num_stars, num_lookups, bigquery):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if catalog_dir is None:
+            catalog_dir = tmp_dir
+            t0 = time.time()
+            build_synthetic_catalog(catalog_dir, num_stars)
+            print(f'Built synthetic catalog of {num_stars} stars in {time.time() - t0:.1f} sec')
+
+        local_catalog = catalog.LocalCatalog(catalog_dir)
+
+        rng = np.random.default_rng(0)
+        pointings = list(zip(rng.uniform(0, 360, num_lookups), rng.uniform(-30, 70, num_lookups)))
+
+        results = dict(local=list())
+        if bigquery:
+            from google.cloud import bigquery as bq
+            from panoptes.utils.stars import get_stars_from_footprint
+            bq_client = bq.Client()
+            results['bigquery'] = list()
+
+        for ra, dec in pointings:
+            wcs = make_wcs(ra, dec)
+
+            t0 = time.time()
+            stars, _ = local_catalog.get_stars_from_footprint(wcs)
+            results['local'].append((time.time() - t0, len(stars)))
+
+            if bigquery:
+                t0 = time.time()
+                stars = get_stars_from_footprint(wcs, bq_client=bq_client)
+                results['bigquery'].append((time.time() - t0, len(stars)))
+
+        print(f'{num_lookups} lookups of {IMAGE_SHAPE[0]}x{IMAGE_SHAPE[1]} px footprints')
+        for name, timings in results.items():
+            elapsed = np.array([t for t, _ in timings]) * 1000
+            num_found = np.array([n for _, n in timings])
+            print(f'{name:>9}: median {np.median(elapsed):8.1f} ms  p95 {np.percentile(elapsed, 95):8.1f} ms  '
+                  f'median stars {np.median(num_found):.0f}')
+
+
+if __name__ == '__main__':
+    main()
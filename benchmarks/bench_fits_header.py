@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Micro-benchmark for the FITS header parsing in `common.fits_header`.
+
+Compares the shared parser against the per-card loop that was previously
+copied into `raw-file-uploaded` and `get-fits-header`. The corpus is a list of
+real PANOPTES images, given as local paths or public urls, e.g.:
+
+    cd $PANDIR/panoptes-network
+    python benchmarks/bench_fits_header.py \
+        https://storage.googleapis.com/panoptes-raw-images/<UNIT_ID>/<CAMERA_ID>/<SEQ_TIME>/<IMG_TIME>.fits.fz
+
+Only the header bytes are read (with an HTTP range request for urls).
+"""
+import os
+import sys
+import timeit
+
+import click
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from common import fits_header  # noqa: E402
+
+NUM_READ_BLOCKS = 10
+
+
+def legacy_parse(b_string):
+    """The previous per-card loop, kept verbatim for comparison."""
+    headers = dict()
+    for j in range(0, len(b_string), 80):
+        item_string = b_string[j: j + 80].decode()
+
+        if item_string.startswith('END'):
+            break
+
+        if item_string.find('=') > 0:
+            k, v = item_string.split('=')
+
+            if ' / ' in v:
+                v = v.split(' / ')[0]
+
+            v = v.strip()
+
+            if v.startswith("'") and v.endswith("'"):
+                v = v.replace("'", "").strip()
+            elif v.find('.') > 0:
+                v = float(v)
+            elif v == 'T':
+                v = True
+            elif v == 'F':
+                v = False
+            else:
+                v = int(v)
+
+            headers[k.strip()] = v
+
+    return headers
+
+
+def read_header_bytes(path):
+    """Get the raw bytes for the header of interest, skipping the primary for `.fz`."""
+    num_bytes = fits_header.BLOCK_SIZE * NUM_READ_BLOCKS
+    if path.startswith('http'):
+        res = requests.get(path, headers={'Range': f'bytes=0-{num_bytes - 1}'})
+        res.raise_for_status()
+        raw_bytes = res.content
+    else:
+        with open(path, 'rb') as f:
+            raw_bytes = f.read(num_bytes)
+
+    if path.endswith('.fz'):
+        raw_bytes = raw_bytes[fits_header.BLOCK_SIZE:]
+
+    end_idx = fits_header.find_end(fits_header.split_cards(raw_bytes))
+    if end_idx < 0:
+        raise ValueError(f'No END card in the first {NUM_READ_BLOCKS} blocks of {path}')
+
+    num_blocks = (end_idx * fits_header.CARD_SIZE) // fits_header.BLOCK_SIZE + 1
+    return raw_bytes[:num_blocks * fits_header.BLOCK_SIZE]
+
+
+@click.command()
+@click.argument('corpus', nargs=-1, required=True)
+@click.option('--repeat', default=1000, help='Number of times each header is parsed.')
+@click.option('--keys', default='IMAGEID,EXPTIME,MEASRGGB,CAMTEMP,LAT-OBS,LONG-OBS',
+              help='Comma separated keywords for the subset parse.')
+def main(corpus, repeat, keys):
+    headers = [read_header_bytes(path) for path in corpus]
+    num_cards = sum(len(h) // fits_header.CARD_SIZE for h in headers)
+    print(f'Corpus: {len(headers)} headers, {num_cards} cards')
+
+    keys = keys.split(',')
+    parsers = [
+        ('legacy', legacy_parse),
+        ('common', fits_header.parse_header),
+        ('subset', lambda h: fits_header.parse_header(h, keys=keys)),
+    ]
+    for name, parse in parsers:
+        try:
+            elapsed = timeit.timeit(lambda: [parse(h) for h in headers], number=repeat)
+        except ValueError as e:
+            print(f'{name:>8}: failed to parse corpus: {e!r}')
+            continue
+        per_header = elapsed / (repeat * len(headers)) * 1e6
+        print(f'{name:>8}: {per_header:8.1f} µs/header')
+
+    # Report keywords where the two parsers disagree.
+    for path, header_bytes in zip(corpus, headers):
+        try:
+            legacy = legacy_parse(header_bytes)
+        except ValueError:
+            continue
+        new = fits_header.parse_header(header_bytes)
+        changed = sorted(k for k in legacy if legacy[k] != new.get(k))
+        if changed:
+            print(f'{path}: values differ for {changed}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Benchmark building the observation `-metadata.parquet` file.
+
+Compares the previous pandas implementation in `lookup-catalog-sources` with
+the typed Arrow implementation in `lookup-catalog-sources/metadata.py` for a
+synthetic observation with realistic PANOPTES header values. Each
+implementation runs in a fresh process so the peak RSS can be compared.
+
+    cd $PANDIR/panoptes-network
+    python benchmarks/bench_metadata_parquet.py --num-images 500
+"""
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from contextlib import suppress
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from io import BytesIO
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lookup-catalog-sources'))
+
+
+def make_observation(num_images):
+    """Make image documents and headers like those for a real observation."""
+    sequence_id = 'PAN012_358d0f_20191005T112325'
+    unit_id, camera_id, _ = sequence_id.split('_')
+    start_time = datetime(2019, 10, 5, 11, 23, 25, tzinfo=timezone.utc)
+
+    image_docs = list()
+    headers = list()
+    for i in range(num_images):
+        image_time = start_time + timedelta(seconds=150 * i)
+        image_id = f'{unit_id}_{camera_id}_{image_time:%Y%m%dT%H%M%S}'
+        bucket_path = f'{unit_id}/{camera_id}/20191005T112325/{image_time:%Y%m%dT%H%M%S}.fits.fz'
+        image_docs.append(dict(
+            image_id=image_id,
+            unit_id=unit_id,
+            sequence_id=sequence_id,
+            time=image_time,
+            ra_mnt=303.1 + i * 1e-4,
+            ha_mnt=1.2,
+            dec_mnt=46.2,
+            ra_image=303.2 + i * 1e-4,
+            dec_image=46.3,
+            airmass=1.1,
+            moonsep=80.5,
+            moonfrac=0.4,
+            exptime=120,
+            bucket_path=bucket_path,
+            public_url=f'https://storage.googleapis.com/panoptes-raw-images/{bucket_path}',
+            status='solved',
+        ))
+        headers.append({
+            'SIMPLE': True,
+            'BITPIX': 16,
+            'IMAGEID': image_id,
+            'CRVAL1': 303.2 + i * 1e-4,
+            'CRVAL2': 46.3,
+            'ISO': 100,
+            'CAMTEMP': f'{20 + i % 5} C',
+            'CIRCCONF': '0.019 mm',
+            'COLORTMP': 5000,
+            'INTSN': '0000000000',
+            'CAMSN': '01234567890',
+            'MEASEV': 1.5,
+            'MEASEV2': 1.625,
+            'MEASRGGB': f'{400 + i % 7} 1024 1024 {500 + i % 3}',
+            'WHTLVLN': 11765,
+            'WHTLVLS': 11765,
+            'REDBAL': 2.1,
+            'BLUEBAL': 1.5,
+            'LAT-OBS': 19.54,
+            'LONG-OBS': -155.58,
+            'ELEV-OBS': 3400.0,
+            'FILENAME': f'https://storage.googleapis.com/panoptes-raw-images/{bucket_path}',
+        })
+
+    return image_docs, headers
+
+
+def legacy_build(image_docs, headers):
+    """The previous pandas implementation from `update_observation_file`."""
+    import pandas as pd
+    import metadata
+
+    header_columns = {key: col for key, (col, _) in metadata.HEADER_COLUMNS.items()}
+
+    metadata_df = pd.DataFrame(image_docs)
+    headers_df = pd.DataFrame(headers)[list(header_columns.keys())].convert_dtypes().dropna()
+
+    rggb_df = headers_df['MEASRGGB'].str.split(' ', expand=True).rename(columns={
+        0: 'camera_measured_r',
+        1: 'camera_measured_g1',
+        2: 'camera_measured_g2',
+        3: 'camera_measured_b',
+    }).astype('int')
+    headers_df = headers_df.join(rggb_df)
+    headers_df['CAMTEMP'] = headers_df.CAMTEMP.map(lambda x: float(x.split(' ')[0]))
+    headers_df['CIRCCONF'] = headers_df.CIRCCONF.map(lambda x: float(x.split(' ')[0]))
+
+    headers_df = headers_df.convert_dtypes(convert_integer=False).rename(columns=header_columns)
+    metadata_df = metadata_df.merge(headers_df, on='image_id')
+    metadata_df = metadata_df[list(metadata.METADATA_COLUMNS.keys())].rename(
+        columns=metadata.METADATA_COLUMNS).convert_dtypes()
+
+    dtype_lookup = {
+        'site_elevation': 'float',
+        'image_exptime': 'float',
+        'camera_temp': 'float',
+        'camera_colortemp': 'int',
+        'camera_lens_serial_number': 'string',
+        'camera_serial_number': 'string',
+    }
+    for col, dtype in dtype_lookup.items():
+        with suppress(TypeError):
+            metadata_df[col] = metadata_df[col].astype(dtype)
+
+    bio = BytesIO()
+    metadata_df.dropna().to_parquet(bio, index=False)
+    bio.seek(0)
+    return bio
+
+
+def arrow_build(image_docs, headers):
+    """The typed Arrow implementation."""
+    import metadata
+
+    return metadata.to_parquet_buffer(metadata.build_metadata_table(image_docs, headers))
+
+
+def run(name, num_images, repeat, results):
+    """Time one implementation and record the increase in peak RSS (in a child process)."""
+    import pandas  # noqa: F401
+    import pyarrow as pa
+    import pyarrow.parquet  # noqa: F401
+
+    build = dict(legacy=legacy_build, arrow=arrow_build)[name]
+    image_docs, headers = make_observation(num_images)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.time()
+    for _ in range(repeat):
+        bio = build(image_docs, headers)
+    elapsed = (time.time() - t0) / repeat
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    arrow_mb = pa.default_memory_pool().max_memory() / 1024 ** 2
+
+    results[name] = (elapsed, (rss_after - rss_before) / 1024, arrow_mb, len(bio.getvalue()))
+
+
+@click.command()
+@click.option('--num-images', default=500, help='Number of images in the observation.')
+@click.option('--repeat', default=5, help='Number of builds to average over.')
+def main(num_images, repeat):
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Manager() as manager:
+        results = manager.dict()
+        for name in ['legacy', 'arrow']:
+            proc = ctx.Process(target=run, args=(name, num_images, repeat, results))
+            proc.start()
+            proc.join()
+
+        print(f'Observation with {num_images} images')
+        for name, (elapsed, rss_mb, arrow_mb, num_bytes) in results.items():
+            print(f'{name:>8}: {elapsed * 1000:8.1f} ms  peak RSS +{rss_mb:6.1f} MB  '
+                  f'peak Arrow pool {arrow_mb:6.1f} MB  parquet {num_bytes / 1024:.1f} KB')
+
+
+if __name__ == '__main__':
+    main()
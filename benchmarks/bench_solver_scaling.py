@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Benchmark the plate-solver throughput as the number of solver workers grows.
+
+Runs the service pipeline (`pipeline.Pipeline` with a `workers.SolverPool`) on
+copies of a local image, with directories standing in for the incoming and
+raw images buckets. The background, solve and output stages do the same work
+as in `solver.py`, without the WCS transfer, but nothing is read from or written to firestore or storage, with
+`--latency` seconds added to each download and upload instead.
+
+Needs `panoptes-utils` and `solve-field` with the index files, e.g. run in the
+service image:
+
+    cd $PANDIR/panoptes-network
+    python benchmarks/bench_solver_scaling.py /var/panoptes/images/test-image.fits.fz --num-images 16
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import click
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'plate-solver'))
+
+import pipeline  # noqa: E402
+import workers  # noqa: E402
+
+BACKGROUND_CONFIG = {
+    "camera_bias": 2048.,
+    "filter_size": 3,
+    "box_size": (84, 84),
+}
+
+
+class LocalJob(object):
+    """The parts of `solver.SolveJob` used by the pipeline, for a local file."""
+
+    def __init__(self, source_path, storage_dir, latency):
+        self.source_path = source_path
+        self.storage_dir = storage_dir
+        self.latency = latency
+        self.sequence_id = os.path.basename(source_path)
+
+        self.timings = dict()
+        self.finished = False
+        self.error = None
+
+        self.tmp_dir_name = tempfile.mkdtemp(dir=storage_dir)
+        self.local_path = None
+        self.header = None
+        self.data = None
+        self.subtracted_data = None
+        self.backgrounds = None
+        self.solved_header = None
+        self.solved_path = None
+
+    def __getstate__(self):
+        return dict(self.__dict__)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+def download_stage(job):
+    time.sleep(job.latency)
+    job.local_path = os.path.join(job.tmp_dir_name, os.path.basename(job.source_path))
+    shutil.copy(job.source_path, job.local_path)
+
+
+def background_stage(job):
+    import background
+    from panoptes.utils.images import fits as fits_utils
+
+    job.data = fits_utils.getdata(job.local_path)
+    job.header = fits_utils.getheader(job.local_path)
+    job.subtracted_data, job.backgrounds = background.subtract_background(job.data, **BACKGROUND_CONFIG)
+
+
+def solve_stage(job):
+    import astrometry
+    from astropy.io import fits
+
+    subtracted_path = os.path.join(job.tmp_dir_name, 'subtracted.fits')
+    fits.PrimaryHDU(data=job.subtracted_data, header=job.header).writeto(subtracted_path, overwrite=True)
+    wcs_header, _ = astrometry.solve(subtracted_path, hint=astrometry.mount_hint(job.header))
+    if wcs_header is None:
+        raise Exception(f'Unable to plate-solve {job.local_path}')
+
+    job.solved_header = astrometry.add_wcs(job.header.copy(), wcs_header)
+    job.subtracted_data = None
+
+
+def output_stage(job):
+    import numpy as np
+    from astropy.io import fits
+
+    job.solved_path = os.path.join(job.tmp_dir_name, 'solved.fits.fz')
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data=job.data, header=job.solved_header)]
+                 ).writeto(job.solved_path, overwrite=True)
+    fits.HDUList([fits.PrimaryHDU()] + [fits.CompImageHDU(data=np.clip(back, 0, None).astype(np.uint16))
+                                        for maps in job.backgrounds.values()
+                                        for back in maps]
+                 ).writeto(os.path.join(job.tmp_dir_name, 'background.fits.fz'), overwrite=True)
+    job.data = None
+    job.backgrounds = None
+
+
+def upload_stage(job):
+    time.sleep(job.latency)
+    shutil.copy(job.solved_path, os.path.join(job.storage_dir, os.path.basename(job.tmp_dir_name)))
+
+
+STAGES = [
+    ('download', download_stage),
+    ('background', background_stage),
+    ('solve', solve_stage),
+    ('output', output_stage),
+    ('upload', upload_stage),
+]
+
+
+def run_benchmark(image_path, storage_dir, num_workers, num_images, latency):
+    """Solve `num_images` copies of the image with `num_workers` solver workers.
+
+    Returns:
+        float: The seconds taken, not including the worker start.
+    """
+    solver_pool = workers.SolverPool(num_workers=num_workers, module_name='bench_solver_scaling')
+    solver_pool.wait_ready()
+
+    done = list()
+    all_done = threading.Event()
+
+    def on_done(job):
+        if job.error is not None:
+            print(f'Error solving {job.source_path}: {job.error!r}')
+        shutil.rmtree(job.tmp_dir_name, ignore_errors=True)
+        done.append(job)
+        if len(done) == num_images:
+            all_done.set()
+
+    solve_pipeline = pipeline.Pipeline(
+        [
+            ('download', download_stage, 2),
+            ('process', lambda job: solver_pool.run(job, ['background', 'solve', 'output']), num_workers),
+            ('upload', upload_stage, 2),
+        ],
+        on_done=on_done,
+        interval=0
+    )
+    solve_pipeline.start()
+
+    t0 = time.time()
+    for _ in range(num_images):
+        solve_pipeline.submit(LocalJob(image_path, storage_dir, latency))
+    all_done.wait()
+    elapsed = time.time() - t0
+
+    solver_pool.close()
+    return elapsed
+
+
+@click.command()
+@click.argument('image_path')
+@click.option('--num-images', default=8, help='Number of copies of the image to solve for each pool size.')
+@click.option('--max-workers', default=None, type=int, help='Largest pool size, default the number of CPUs.')
+@click.option('--latency', default=1., help='Seconds added to each download and upload.')
+def main(image_path, num_images, max_workers, latency):
+    max_workers = max_workers or workers.available_cpus()
+    pool_sizes = sorted({2 ** i for i in range(max_workers.bit_length()) if 2 ** i <= max_workers} | {max_workers})
+
+    print(f'{num_images} images per run, {workers.available_cpus()} CPUs, '
+          f'{workers.available_memory() / 2**30:.1f} GB memory')
+    with tempfile.TemporaryDirectory() as storage_dir:
+        for num_workers in pool_sizes:
+            elapsed = run_benchmark(os.path.abspath(image_path), storage_dir, num_workers, num_images, latency)
+            print(f'{num_workers:>3} workers: {elapsed:7.1f} sec  {num_images / elapsed * 3600:8.0f} images/hour')
+
+
+if __name__ == '__main__':
+    main()
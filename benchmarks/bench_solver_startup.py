@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Benchmark the per-image startup cost of the plate-solver.
+
+Compares starting `solver.py` in a new process for each image, which pays for
+the interpreter start, the imports and creating the google clients, with
+sending a job to a warm `workers.SolverPool` worker. Both are timed without
+doing any solving, so the difference is the overhead saved per image.
+
+Needs the google credentials that the service uses, e.g. run in the service image:
+
+    cd $PANDIR/panoptes-network
+    python benchmarks/bench_solver_startup.py --repeat 5
+"""
+import os
+import subprocess
+import sys
+import time
+
+import click
+import numpy as np
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SOLVER_DIR = os.path.join(ROOT_DIR, 'plate-solver')
+
+# The workers are spawned with the same path, so `common` and `solver` import in them too.
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, SOLVER_DIR)
+
+import workers  # noqa: E402
+
+
+@click.command()
+@click.option('--repeat', default=5, help='Number of cold starts and warm jobs to time.')
+def main(repeat):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([SOLVER_DIR, ROOT_DIR]))
+
+    cold_times = list()
+    for _ in range(repeat):
+        t0 = time.time()
+        # `--help` exits once the imports and clients are done.
+        subprocess.run([sys.executable, os.path.join(SOLVER_DIR, 'solver.py'), '--help'],
+                       env=env, stdout=subprocess.DEVNULL, check=True)
+        cold_times.append(time.time() - t0)
+
+    pool = workers.SolverPool(num_workers=1)
+    pool_start = pool.wait_ready()
+    warm_times = [pool.ping() for _ in range(repeat)]
+    pool.close()
+
+    cold_ms = np.array(cold_times) * 1000
+    warm_ms = np.array(warm_times) * 1000
+    print(f'Cold subprocess start: median {np.median(cold_ms):8.1f} ms  max {cold_ms.max():8.1f} ms')
+    print(f'Warm worker job:       median {np.median(warm_ms):8.1f} ms  max {warm_ms.max():8.1f} ms')
+    print(f'Worker pool start (once): {pool_start * 1000:.1f} ms')
+    print(f'Saved per image: {np.median(cold_ms) - np.median(warm_ms):.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
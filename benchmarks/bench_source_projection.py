@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""Benchmark projecting catalog stars onto the image in `lookup-catalog-sources`.
+
+Compares the previous projection (`all_world2pix` on every catalog row and a
+per-row `apply(np.floor)`) with `projection.project_sources` for a synthetic
+dense Milky Way field on a PANOPTES-sized image with SIP distortion:
+
+    cd $PANDIR/panoptes-network
+    python benchmarks/bench_source_projection.py --num-stars 500000
+"""
+import os
+import sys
+import time
+
+import click
+import numpy as np
+import pandas as pd
+from astropy.wcs import Sip
+from astropy.wcs import WCS
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'lookup-catalog-sources'))
+
+import projection  # noqa: E402
+
+# A PANOPTES camera: 5208 x 3476 pixels at about 10.3 arcsec per pixel.
+IMAGE_SHAPE = (5208, 3476)
+PIXEL_SCALE = 10.3 / 3600
+
+
+def make_wcs(ra=283.8, dec=-3.5):
+    """Make a TAN-SIP WCS with a few pixels of distortion in the corners."""
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN-SIP', 'DEC--TAN-SIP']
+    wcs.wcs.crval = [ra, dec]
+    wcs.wcs.crpix = [IMAGE_SHAPE[0] / 2, IMAGE_SHAPE[1] / 2]
+    wcs.wcs.cd = [[-PIXEL_SCALE, 1e-5], [1e-5, PIXEL_SCALE]]
+    wcs.pixel_shape = IMAGE_SHAPE
+
+    a = np.zeros((4, 4))
+    b = np.zeros((4, 4))
+    a[2, 0] = 1e-7
+    a[3, 0] = 1e-10
+    a[1, 2] = 1e-10
+    b[0, 2] = -1e-7
+    b[0, 3] = 1e-10
+    b[2, 1] = 1e-10
+    wcs.sip = Sip(a, b, None, None, wcs.wcs.crpix)
+
+    return wcs
+
+
+def make_field(wcs, num_stars, seed=42):
+    """Stars spread over the footprint plus a 10% margin, as from a catalog query."""
+    rng = np.random.default_rng(seed)
+    width, height = wcs.pixel_shape
+    x = rng.uniform(-0.1 * width, 1.1 * width, num_stars)
+    y = rng.uniform(-0.1 * height, 1.1 * height, num_stars)
+    ra, dec = wcs.all_pix2world(x, y, 0)
+
+    return pd.DataFrame(dict(
+        picid=np.arange(num_stars),
+        catalog_ra=ra,
+        catalog_dec=dec,
+        catalog_vmag=rng.uniform(6, 18, num_stars),
+    ))
+
+
+def legacy_project(wcs, catalog_sources):
+    """The previous projection from `process_topic`."""
+    catalog_sources = catalog_sources.copy()
+    catalog_coords = catalog_sources[['catalog_ra', 'catalog_dec']]
+    catalog_xy = wcs.all_world2pix(catalog_coords, 1)
+    catalog_sources['x'] = catalog_xy.T[0]
+    catalog_sources['y'] = catalog_xy.T[1]
+    catalog_sources['x_int'] = catalog_sources.x.astype(int)
+    catalog_sources['y_int'] = catalog_sources.y.astype(int)
+    catalog_sources['catalog_vmag_bin'] = catalog_sources['catalog_vmag'].apply(np.floor).astype('int')
+
+    return catalog_sources
+
+
+@click.command()
+@click.option('--num-stars', default=500_000, help='Number of catalog stars in the field.')
+@click.option('--repeat', default=3, help='Number of runs to average over.')
+def main(num_stars, repeat):
+    wcs = make_wcs()
+    catalog_sources = make_field(wcs, num_stars)
+
+    t0 = time.time()
+    for _ in range(repeat):
+        legacy_sources = legacy_project(wcs, catalog_sources)
+    legacy_elapsed = (time.time() - t0) / repeat
+
+    t0 = time.time()
+    for _ in range(repeat):
+        sources, projection_info = projection.project_sources(wcs, catalog_sources)
+    elapsed = (time.time() - t0) / repeat
+
+    # Compare the positions for the stars that were kept.
+    legacy_sources = legacy_sources.set_index('picid').loc[sources.picid]
+    max_error = np.max(np.hypot(legacy_sources.x.values - sources.x.values,
+                                legacy_sources.y.values - sources.y.values))
+
+    print(f'Field of {num_stars} stars, {projection_info!r}')
+    print(f'  legacy: {legacy_elapsed * 1000:8.1f} ms  {len(catalog_sources)} rows written')
+    print(f' project: {elapsed * 1000:8.1f} ms  {len(sources)} rows written  '
+          f'max difference {max_error:.4f} px  speedup {legacy_elapsed / elapsed:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
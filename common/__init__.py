@@ -0,0 +1,5 @@
+"""Modules shared between the panoptes-network services.
+
+Each service is deployed from its own folder, so `bin/deploy` copies this
+package into the service folder before uploading it.
+"""
@@ -0,0 +1,132 @@
+"""Publish pubsub messages in batches and wait for them to be sent.
+
+The pubsub client sends messages from a background thread, so a cloud function
+that returns without waiting on the futures can be frozen before its messages
+are sent, and they are lost without an error. `BatchPublisher.flush` waits on
+every message published since the last flush, which should be called before
+the function returns.
+
+The messages are batched with explicit `BatchSettings`, set with the
+`PUBLISH_MAX_MESSAGES`, `PUBLISH_MAX_BYTES` and `PUBLISH_MAX_LATENCY` env vars,
+and the number of messages sent and failed and the time from publishing to
+being sent are counted.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+from google.cloud import pubsub
+
+PROJECT_ID = os.getenv('GOOGLE_CLOUD_PROJECT', 'panoptes-exp')
+
+MAX_MESSAGES = int(os.getenv('PUBLISH_MAX_MESSAGES', 100))
+MAX_BYTES = int(os.getenv('PUBLISH_MAX_BYTES', 1024 * 1024))
+MAX_LATENCY = float(os.getenv('PUBLISH_MAX_LATENCY', 0.05))
+
+# Number of the most recent publish latencies kept for the stats.
+NUM_LATENCIES = 1000
+
+# Seconds to wait for the outstanding messages in `flush`.
+FLUSH_TIMEOUT = float(os.getenv('PUBLISH_FLUSH_TIMEOUT', 30))
+
+
+class BatchPublisher(object):
+    """A pubsub publisher that keeps the futures of the published messages.
+
+    Args:
+        project_id (str): The project of the topics.
+        max_messages (int): The most messages in a batch.
+        max_bytes (int): The most bytes in a batch.
+        max_latency (float): The longest time in seconds a message waits for a batch.
+        client (`google.cloud.pubsub.PublisherClient`|None): The client, made
+            with the batch settings if not given.
+    """
+
+    def __init__(self,
+                 project_id=PROJECT_ID,
+                 max_messages=MAX_MESSAGES,
+                 max_bytes=MAX_BYTES,
+                 max_latency=MAX_LATENCY,
+                 client=None):
+        if client is None:
+            batch_settings = pubsub.types.BatchSettings(max_messages=max_messages,
+                                                        max_bytes=max_bytes,
+                                                        max_latency=max_latency)
+            client = pubsub.PublisherClient(batch_settings=batch_settings)
+
+        self.client = client
+        self.project_id = project_id
+
+        self.num_published = 0
+        self.num_failed = 0
+        self._latencies = deque(maxlen=NUM_LATENCIES)
+
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    @property
+    def stats(self):
+        """dict: The messages sent, failed and pending and the recent publish latency in seconds."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return dict(published=self.num_published,
+                        failed=self.num_failed,
+                        pending=len(self._pending),
+                        median_seconds=round(latencies[len(latencies) // 2], 3) if latencies else None,
+                        max_seconds=round(latencies[-1], 3) if latencies else None)
+
+    def topic_path(self, topic):
+        """The full path of the topic in the project."""
+        return f'projects/{self.project_id}/topics/{topic}'
+
+    def publish(self, topic, data, **attributes):
+        """Add the message to the batch for the topic.
+
+        Args:
+            topic (str): The name of the topic.
+            data (bytes): The message body.
+            **attributes: The message attributes, as strings.
+
+        Returns:
+            `google.cloud.pubsub_v1.publisher.futures.Future`: Resolves to the message id.
+        """
+        publish_time = time.monotonic()
+        future = self.client.publish(self.topic_path(topic), data, **attributes)
+        with self._lock:
+            self._pending.add(future)
+
+        def done(done_future):
+            latency = time.monotonic() - publish_time
+            with self._lock:
+                self._pending.discard(done_future)
+                if done_future.exception() is None:
+                    self.num_published += 1
+                    self._latencies.append(latency)
+                else:
+                    self.num_failed += 1
+
+        future.add_done_callback(done)
+        return future
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Wait for every message published so far to be sent.
+
+        Args:
+            timeout (float): The total seconds to wait.
+
+        Returns:
+            list: The exceptions of the messages that failed or were not sent in time.
+        """
+        with self._lock:
+            pending = list(self._pending)
+
+        errors = list()
+        end_time = time.monotonic() + timeout
+        for future in pending:
+            try:
+                future.result(timeout=max(end_time - time.monotonic(), 0))
+            except Exception as e:
+                errors.append(e)
+
+        return errors
@@ -0,0 +1,313 @@
+"""Fast parsing of FITS headers read directly from storage.
+
+FITS Header Units are stored in blocks of 2880 bytes consisting of 36 cards
+that are 80 bytes long each. The Header Unit always ends with the single
+word 'END' on a card (not necessarily card 36).
+
+The raw header bytes are viewed as a NumPy record array of cards so that the
+`END` card and the `key = value` cards can be found without decoding every
+line. Only the value cards that are actually used are decoded and parsed.
+
+See https://fits.gsfc.nasa.gov/fits_primer.html for overview of FITS format and
+https://fits.gsfc.nasa.gov/standard40/fits_standard40aa-le.pdf (section 4.2)
+for the value rules.
+"""
+import os
+import re
+
+import numpy as np
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# Number of blocks fetched by the first ranged read of a header.
+NUM_READ_BLOCKS = int(os.getenv('FITS_HEADER_BLOCKS', 5))
+
+# keyword (cols 1-8), value indicator (cols 9-10), value/comment (cols 11-80).
+CARD_DTYPE = np.dtype([('keyword', 'S8'), ('indicator', 'S2'), ('value', 'S70')])
+
+END_KEYWORD = b'END     '
+CONTINUE_KEYWORD = b'CONTINUE'
+VALUE_INDICATOR = b'= '
+
+_STRING_RE = re.compile(r"'((?:[^']|'')*)'?")
+_COMPLEX_RE = re.compile(r'\(\s*([^,]+?)\s*,\s*([^)]+?)\s*\)')
+
+
+def split_cards(header_bytes):
+    """View the raw header bytes as an array of cards.
+
+    No copy of the data is made and nothing is decoded. Any trailing partial
+    card is ignored.
+
+    Args:
+        header_bytes (bytes): The raw header, usually a multiple of `BLOCK_SIZE`.
+
+    Returns:
+        `numpy.ndarray`: A record array with `keyword`, `indicator` and `value` fields.
+    """
+    num_cards = len(header_bytes) // CARD_SIZE
+    return np.frombuffer(header_bytes, dtype=CARD_DTYPE, count=num_cards)
+
+
+def find_end(cards):
+    """Find the index of the `END` card.
+
+    Args:
+        cards (`numpy.ndarray`): Cards as returned by `split_cards`.
+
+    Returns:
+        int: The index of the `END` card or -1 if it is not present.
+    """
+    end_idx = np.flatnonzero(cards['keyword'] == END_KEYWORD)
+    if len(end_idx) == 0:
+        return -1
+
+    return int(end_idx[0])
+
+
+def parse_value(value_field):
+    """Parse the value portion of a card according to the FITS value rules.
+
+    Strings are single-quoted with embedded quotes given as `''` and trailing
+    spaces are not significant. Anything after a `/` outside of a string is a
+    comment. Logicals are `T` or `F`, floats may use `E` or `D` exponents and
+    complex values are given as `(real, imag)`. An empty value is undefined.
+
+    Values that do not follow the standard are returned as stripped strings.
+
+    Args:
+        value_field (str): The value and comment, i.e. columns 11-80 of the card.
+
+    Returns:
+        str|bool|int|float|complex|None: The parsed value.
+    """
+    value_field = value_field.lstrip()
+
+    if value_field.startswith("'"):
+        # Fast path for the common case of a string without embedded quotes.
+        close_idx = value_field.find("'", 1)
+        if close_idx > 0 and value_field[close_idx + 1:close_idx + 2] != "'":
+            return value_field[1:close_idx].rstrip()
+        return _STRING_RE.match(value_field).group(1).replace("''", "'").rstrip()
+
+    value = value_field.partition('/')[0].strip()
+
+    if value == 'T':
+        return True
+    elif value == 'F':
+        return False
+    elif value == '':
+        return None
+    elif value.startswith('('):
+        complex_match = _COMPLEX_RE.match(value)
+        if complex_match:
+            real, imag = (_parse_number(v) for v in complex_match.groups())
+            if real is not None and imag is not None:
+                return complex(real, imag)
+        return value
+
+    number = _parse_number(value)
+    if number is None:
+        return value
+
+    return number
+
+
+def _parse_number(value):
+    """Parse an integer or float, including `D` exponents. Returns None if invalid."""
+    digits = value[1:] if value[:1] in ('+', '-') else value
+    if digits.isdigit():
+        return int(value)
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    try:
+        return float(value.replace('D', 'E').replace('d', 'e'))
+    except ValueError:
+        return None
+
+
+def parse_header(header_bytes, keys=None):
+    """Parse the raw bytes of a single Header Unit into a dictionary.
+
+    Commentary cards (`COMMENT`, `HISTORY`, blank) are skipped. Long string
+    values split over `CONTINUE` cards are joined. If no `END` card is present
+    all of the given cards are parsed.
+
+    Args:
+        header_bytes (bytes): The raw header bytes, starting at the first card.
+        keys (list|None): Only parse these keywords, default None parses all.
+
+    Returns:
+        dict: FITS header as a dictionary.
+    """
+    cards = split_cards(header_bytes)
+
+    end_idx = find_end(cards)
+    if end_idx >= 0:
+        cards = cards[:end_idx]
+
+    keywords = cards['keyword']
+    is_value_card = cards['indicator'] == VALUE_INDICATOR
+    if keys is not None:
+        is_value_card &= np.isin(keywords, [k.encode().ljust(8) for k in keys])
+
+    # CONTINUE cards only matter when they follow a selected card.
+    is_continue = keywords == CONTINUE_KEYWORD
+    if is_continue.any():
+        follows_value = np.zeros_like(is_value_card)
+        for idx in np.flatnonzero(is_continue):
+            # A CONTINUE at the start of the header has nothing to continue.
+            if idx > 0:
+                follows_value[idx] = is_value_card[idx - 1] or follows_value[idx - 1]
+        is_value_card |= follows_value
+
+    selected = cards[is_value_card]
+
+    # Decode all the selected cards at once and slice out the fields.
+    card_strings = selected.tobytes().decode('ascii', 'replace')
+
+    headers = dict()
+    last_key = None
+    for card_start in range(0, len(card_strings), CARD_SIZE):
+        keyword = card_strings[card_start:card_start + 8].rstrip()
+
+        if keyword == 'CONTINUE':
+            last_value = headers.get(last_key)
+            if isinstance(last_value, str) and last_value.endswith('&'):
+                continuation = parse_value(card_strings[card_start + 8:card_start + CARD_SIZE])
+                if isinstance(continuation, str):
+                    headers[last_key] = last_value[:-1] + continuation
+            continue
+
+        last_key = keyword
+        headers[keyword] = parse_value(card_strings[card_start + 10:card_start + CARD_SIZE])
+
+    return headers
+
+
+def read_header_bytes(storage_blob, skip_primary=None, num_blocks=None, timeout=None, read_info=None):
+    """Read the raw bytes of a FITS header from storage with ranged requests.
+
+    A range of `num_blocks` blocks is requested first, which covers the
+    whole header for the usual PANOPTES image, including the empty primary
+    header of an fpacked file. Only if the `END` card has not appeared is the
+    read extended, with the size of the requested range doubling each time.
+
+    Args:
+        storage_blob (`google.cloud.storage.blob.Blob`): The blob to read.
+        skip_primary (bool|None): If the (empty) primary header should be skipped,
+            which is the case for fpacked files. Default None will skip if the blob
+            name ends with `.fz`.
+        num_blocks (int|None): The number of blocks in the first request, default
+            None will use `NUM_READ_BLOCKS`.
+        timeout (float|None): The timeout in seconds for each request, default None
+            uses the storage client default.
+        read_info (dict|None): If given, the number of bytes downloaded is added
+            to it as `bytes_read`.
+
+    Returns:
+        tuple(bytes, int): The raw header bytes and the number of requests made.
+    """
+    if skip_primary is None:
+        skip_primary = storage_blob.name.endswith('.fz')
+
+    download_kwargs = dict()
+    if timeout is not None:
+        download_kwargs['timeout'] = timeout
+
+    def read_range(start_byte, end_byte):
+        return storage_blob.download_as_string(start=start_byte, end=end_byte, **download_kwargs)
+
+    return _read_header_bytes(read_range, skip_primary, num_blocks, read_info)
+
+
+def read_file_header_bytes(local_path, skip_primary=None, num_blocks=None):
+    """Read the raw bytes of a FITS header from a local file.
+
+    The same header is returned as `read_header_bytes` would return for the
+    file once uploaded to storage.
+
+    Args:
+        local_path (str): The path to the FITS file.
+        skip_primary (bool|None): If the (empty) primary header should be skipped.
+            Default None will skip if the path ends with `.fz`.
+        num_blocks (int|None): The number of blocks in the first read.
+
+    Returns:
+        tuple(bytes, int): The raw header bytes and the number of reads made.
+    """
+    if skip_primary is None:
+        skip_primary = local_path.endswith('.fz')
+
+    with open(local_path, 'rb') as f:
+        def read_range(start_byte, end_byte):
+            f.seek(start_byte)
+            return f.read(end_byte - start_byte + 1)
+
+        return _read_header_bytes(read_range, skip_primary, num_blocks)
+
+
+def _read_header_bytes(read_range, skip_primary, num_blocks, read_info=None):
+    """Read ranges with `read_range(start_byte, end_byte)` until the header `END`."""
+    read_size = BLOCK_SIZE * (num_blocks or NUM_READ_BLOCKS)
+
+    raw_bytes = b''
+    num_requests = 0
+    header_start = 0
+    while True:
+        start_byte = len(raw_bytes)
+        chunk = read_range(start_byte, start_byte + read_size - 1)
+        raw_bytes += chunk
+        num_requests += 1
+        if read_info is not None:
+            read_info['bytes_read'] = len(raw_bytes)
+
+        end_idx = find_end(split_cards(raw_bytes[header_start:]))
+        if end_idx >= 0 and skip_primary:
+            # The primary header of an fpacked file has no data so the
+            # compressed image header starts with the next block.
+            header_start = _next_block_start(header_start + (end_idx + 1) * CARD_SIZE)
+            skip_primary = False
+            end_idx = find_end(split_cards(raw_bytes[header_start:]))
+
+        if end_idx >= 0:
+            header_end = header_start + (end_idx + 1) * CARD_SIZE
+            return raw_bytes[header_start:header_end], num_requests
+
+        # End of the file without finding END.
+        if len(chunk) < read_size:
+            return raw_bytes[header_start:], num_requests
+
+        read_size *= 2
+
+
+def _next_block_start(num_bytes):
+    """The byte offset of the first block boundary at or after `num_bytes`."""
+    return -(-num_bytes // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def lookup_fits_header(storage_blob, skip_primary=None, num_blocks=None):
+    """Read the FITS header from storage.
+
+    See `read_header_bytes` for how the header is read.
+
+    Args:
+        storage_blob (`google.cloud.storage.blob.Blob`): The blob to read.
+        skip_primary (bool|None): If the (empty) primary header should be skipped,
+            which is the case for fpacked files. Default None will skip if the blob
+            name ends with `.fz`.
+        num_blocks (int|None): The number of blocks in the first request.
+
+    Returns:
+        dict: FITS header as a dictionary.
+    """
+    header_bytes, _ = read_header_bytes(storage_blob,
+                                        skip_primary=skip_primary,
+                                        num_blocks=num_blocks)
+
+    return parse_header(header_bytes)
@@ -0,0 +1,279 @@
+"""A cache of parsed FITS headers keyed by the blob generation.
+
+Every write to a storage object gets a new generation number, so keying on
+`(bucket, name, generation)` means an entry can never be stale: when a blob is
+rewritten (e.g. after the plate solver uploads the solved image) the new
+generation simply misses the cache.
+
+There are two layers:
+
+    1. An in-process LRU, which is reused by warm instances.
+    2. An optional shared layer of small JSON objects, either on local disk
+       (`HEADER_CACHE_DIR`) or in a storage bucket (`HEADER_CACHE_BUCKET`).
+
+A lookup without a generation does not fetch the blob metadata. The last
+generation seen for the blob by this process is used for up to
+`HEADER_CACHE_GENERATION_TTL` seconds, so a header that was rewritten can be
+returned for at most that long. Otherwise the header is read and the
+generation is taken from the response to the first ranged read.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from google.cloud import exceptions
+
+from common import fits_header
+
+MAX_SIZE = int(os.getenv('HEADER_CACHE_SIZE', 1024))
+CACHE_DIR = os.getenv('HEADER_CACHE_DIR')
+CACHE_BUCKET = os.getenv('HEADER_CACHE_BUCKET')
+CACHE_PREFIX = os.getenv('HEADER_CACHE_PREFIX', 'header-cache')
+
+# Seconds the last generation seen for a blob is used when none is given.
+GENERATION_TTL = float(os.getenv('HEADER_CACHE_GENERATION_TTL', 300))
+
+
+class HeaderCache(object):
+    """Parsed FITS headers keyed by `(bucket, name, generation)`.
+
+    Args:
+        max_size (int): The number of headers to keep in the in-process layer.
+        cache_dir (str|None): A local directory for the shared layer.
+        cache_bucket (`google.cloud.storage.bucket.Bucket`|None): A bucket for the
+            shared layer, used if no `cache_dir` is given.
+        prefix (str): The prefix for the shared objects in `cache_bucket`.
+        generation_ttl (float): Seconds the last generation seen for a blob is
+            used for a lookup without a generation.
+    """
+
+    def __init__(self, max_size=MAX_SIZE, cache_dir=None, cache_bucket=None, prefix=CACHE_PREFIX,
+                 generation_ttl=GENERATION_TTL):
+        self.max_size = max_size
+        self.generation_ttl = generation_ttl
+        self.cache_dir = cache_dir
+        self.cache_bucket = cache_bucket
+        self.prefix = prefix
+
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.storage_requests = 0
+
+        self._headers = OrderedDict()
+        self._generations = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def is_shared(self):
+        """bool: If the cache has a shared layer."""
+        return self.cache_dir is not None or self.cache_bucket is not None
+
+    @property
+    def stats(self):
+        """dict: The hit and miss counters, the storage requests made on a miss and the size."""
+        return dict(hits=self.hits,
+                    shared_hits=self.shared_hits,
+                    misses=self.misses,
+                    storage_requests=self.storage_requests,
+                    size=len(self._headers))
+
+    def get(self, bucket_name, blob_name, generation):
+        """Get a header from the cache.
+
+        Args:
+            bucket_name (str): The name of the bucket.
+            blob_name (str): The name of the blob.
+            generation (int): The generation of the blob.
+
+        Returns:
+            dict|None: A copy of the header or None if not cached.
+        """
+        key = (bucket_name, blob_name, int(generation))
+        with self._lock:
+            try:
+                header = self._headers[key]
+                self._headers.move_to_end(key)
+                self.hits += 1
+                return dict(header)
+            except KeyError:
+                pass
+
+        header = self._get_shared(key)
+        if header is not None:
+            self._put_local(key, header)
+            with self._lock:
+                self.shared_hits += 1
+            return dict(header)
+
+        with self._lock:
+            self.misses += 1
+
+        return None
+
+    def put(self, bucket_name, blob_name, generation, header):
+        """Add a header to the cache, including the shared layer if configured.
+
+        Args:
+            bucket_name (str): The name of the bucket.
+            blob_name (str): The name of the blob.
+            generation (int): The generation of the blob.
+            header (dict): The parsed header.
+        """
+        key = (bucket_name, blob_name, int(generation))
+        header = dict(header)
+        self._put_local(key, header)
+        self._put_shared(key, header)
+
+    def lookup(self, storage_blob, generation=None, timeout=None, timings=None, **kwargs):
+        """Get the header for a blob, reading it from storage only on a miss.
+
+        If the generation is not given, or set on the blob, the last one seen
+        for the blob is used if recent. If there is none the header is read
+        without a generation and cached for the generation of the response, so
+        no metadata request is made.
+
+        Args:
+            storage_blob (`google.cloud.storage.blob.Blob`): The blob to read.
+            generation (int|None): The generation of the blob if known, e.g. from
+                a storage notification.
+            timeout (float|None): The timeout in seconds for each storage request.
+            timings (dict|None): If given, the seconds to check the cache (`cache`),
+                read the header bytes (`read`) and parse them (`parse`), the
+                number of storage `requests` and the `bytes_read` are added to it.
+            **kwargs: Passed to `fits_header.read_header_bytes` on a miss.
+
+        Returns:
+            dict: FITS header as a dictionary.
+        """
+        timings = timings if timings is not None else dict()
+        timings.update(cache=0., read=0., parse=0., requests=0, bytes_read=0)
+
+        t0 = time.time()
+        bucket_name = storage_blob.bucket.name
+        generation = generation or storage_blob.generation or self._last_generation(bucket_name,
+                                                                                    storage_blob.name)
+        if generation is not None:
+            header = self.get(bucket_name, storage_blob.name, generation)
+            timings['cache'] = time.time() - t0
+            if header is not None:
+                return header
+            read_blob = storage_blob.bucket.blob(storage_blob.name, generation=int(generation))
+        else:
+            # The first ranged read sets the generation on the blob and pins the later ones to it.
+            read_blob = storage_blob.bucket.blob(storage_blob.name)
+
+        t1 = time.time()
+        header_bytes, num_requests = fits_header.read_header_bytes(read_blob,
+                                                                  timeout=timeout,
+                                                                  read_info=timings,
+                                                                  **kwargs)
+        t2 = time.time()
+        header = fits_header.parse_header(header_bytes)
+        timings.update(read=t2 - t1, parse=time.time() - t2, requests=num_requests)
+        with self._lock:
+            self.storage_requests += num_requests
+
+        if read_blob.generation is not None:
+            self.put(bucket_name, storage_blob.name, read_blob.generation, header)
+
+        return header
+
+    def _last_generation(self, bucket_name, blob_name):
+        """The last generation seen for the blob, or None if not seen within the `generation_ttl`."""
+        with self._lock:
+            try:
+                generation, seen_time = self._generations[(bucket_name, blob_name)]
+            except KeyError:
+                return None
+
+        if time.monotonic() - seen_time > self.generation_ttl:
+            return None
+
+        return generation
+
+    def _put_local(self, key, header):
+        bucket_name, blob_name, generation = key
+        with self._lock:
+            self._headers[key] = header
+            self._headers.move_to_end(key)
+            while len(self._headers) > self.max_size:
+                self._headers.popitem(last=False)
+
+            self._generations[(bucket_name, blob_name)] = (generation, time.monotonic())
+            self._generations.move_to_end((bucket_name, blob_name))
+            while len(self._generations) > self.max_size:
+                self._generations.popitem(last=False)
+
+    def _shared_path(self, key):
+        bucket_name, blob_name, generation = key
+        return f'{bucket_name}/{blob_name}#{generation}.json'
+
+    def _get_shared(self, key):
+        shared_path = self._shared_path(key)
+        try:
+            if self.cache_dir is not None:
+                with open(os.path.join(self.cache_dir, shared_path)) as f:
+                    return _from_json(f.read())
+            elif self.cache_bucket is not None:
+                cache_blob = self.cache_bucket.blob(f'{self.prefix}/{shared_path}')
+                return _from_json(cache_blob.download_as_string())
+        except (FileNotFoundError, exceptions.NotFound):
+            pass
+        except Exception as e:
+            print(f'Problem reading shared header cache for {shared_path}: {e!r}')
+
+    def _put_shared(self, key, header):
+        shared_path = self._shared_path(key)
+        try:
+            if self.cache_dir is not None:
+                local_path = os.path.join(self.cache_dir, shared_path)
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+                with open(local_path, 'w') as f:
+                    f.write(_to_json(header))
+            elif self.cache_bucket is not None:
+                cache_blob = self.cache_bucket.blob(f'{self.prefix}/{shared_path}')
+                cache_blob.upload_from_string(_to_json(header), content_type='application/json')
+        except Exception as e:
+            print(f'Problem writing shared header cache for {shared_path}: {e!r}')
+
+
+def from_env(storage_client=None):
+    """Create a `HeaderCache` configured from the environment.
+
+    The shared layer uses `HEADER_CACHE_DIR` if set, otherwise `HEADER_CACHE_BUCKET`
+    if set and a `storage_client` is given.
+
+    Args:
+        storage_client (`google.cloud.storage.Client`|None): Client for the shared bucket.
+
+    Returns:
+        `HeaderCache`: The header cache.
+    """
+    cache_bucket = None
+    if CACHE_BUCKET and storage_client is not None:
+        cache_bucket = storage_client.bucket(CACHE_BUCKET)
+
+    return HeaderCache(cache_dir=CACHE_DIR, cache_bucket=cache_bucket)
+
+
+def _encode_value(value):
+    if isinstance(value, complex):
+        return {'__complex__': [value.real, value.imag]}
+    raise TypeError(f'Can not serialize {value!r}')
+
+
+def _decode_value(obj):
+    if '__complex__' in obj:
+        return complex(*obj['__complex__'])
+    return obj
+
+
+def _to_json(header):
+    return json.dumps(header, default=_encode_value)
+
+
+def _from_json(json_string):
+    return json.loads(json_string, object_hook=_decode_value)
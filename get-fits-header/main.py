@@ -1,10 +1,21 @@
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from flask import jsonify
+from google.cloud import exceptions
 from google.cloud import storage
 
+from common import header_cache
+
 PROJECT_ID = os.getenv('PROJECT_ID', 'panoptes-exp')
 BUCKET_NAME = os.getenv('BUCKET_NAME', 'panoptes-raw-images')
+MAX_WORKERS = int(os.getenv('MAX_WORKERS', 10))
+
+# Created on first use and reused by warm instances.
+storage_client = None
+bucket_handles = dict()
+fits_header_cache = None
 
 
 # Entry point
@@ -13,7 +24,13 @@ def entry_point(request):
 
     This endpoint looks for one parameters, `bucket_path`. If `bucket_path`
     is present then the header information will be pulled from the file
-    and returned as a json document.
+    and returned as a json document. An optional `generation` of the file
+    can be given, which avoids a metadata lookup when the header is cached.
+
+    A list of paths can be given as `bucket_paths` instead, in which case the
+    headers are fetched concurrently and returned as a mapping of path to
+    header, with any per-path errors returned separately. The generations of
+    the files can be given as a mapping of path to generation in `generations`.
 
      Note that the headers are streamed from the bucket rather than pulling
      the entire file from the bucket and then looking up the headers.
@@ -32,99 +49,135 @@ def entry_point(request):
 
     bucket_name = request_json.get('bucket_name', BUCKET_NAME)
     bucket_path = request_json.get('bucket_path')
-    bucket = storage.Client(project=PROJECT_ID).get_bucket(bucket_name)
+    bucket_paths = request_json.get('bucket_paths')
+    generation = request_json.get('generation')
+    generations = request_json.get('generations') or dict()
+
+    t0 = time.time()
+    bucket, client_seconds = get_bucket(bucket_name)
+    t1 = time.time()
+
+    def print_timing():
+        print(f'Request timing: client={client_seconds:.03f} bucket={t1 - t0 - client_seconds:.03f} '
+              f'headers={time.time() - t1:.03f} total={time.time() - t0:.03f} sec')
+        print(f'Header cache: {fits_header_cache.stats!r}')
+
+    if bucket_paths:
+        headers, errors = lookup_headers(bucket, bucket_paths, generations=generations)
+        success = len(headers) > 0
+        print_timing()
+        return jsonify(success=success, headers=headers, errors=errors)
 
     if not bucket_path:
         return jsonify(success=success, msg='No bucket_path, nothing to do!')
 
     try:
-        bucket_path = bucket_path.replace('https://storage.googleapis.com/panoptes-raw-images/', '')
-    except AttributeError as e:
-        print(f'Problem with bucket_path={bucket_path}: {e!r}')
+        fits_headers = lookup_header(bucket, bucket_path, generation=generation)
+        success = True
+    except FileNotFoundError as e:
+        return jsonify(success=success, msg=str(e))
 
-    fits_headers = dict()
+    print_timing()
+    return jsonify(success=success, header=fits_headers)
 
-    print(f"Looking up header for file:  {bucket_path}")
-    storage_blob = bucket.get_blob(bucket_path)
-    print(f"Got storage blob: {storage_blob}")
-    if storage_blob is not None:
-        fits_headers = lookup_fits_header(storage_blob)
 
-        # Change filename to public url of file.
-        fits_headers['FILENAME'] = storage_blob.public_url
-        success = True
-    else:
-        return jsonify(success=success, msg=f"Nothing found in storage bucket for {bucket_path}")
+def get_bucket(bucket_name):
+    """Get the bucket handle, creating the storage client and header cache if needed.
 
-    return jsonify(success=success, header=fits_headers)
+    The handles are created without a metadata request and are cached by name.
+
+    Args:
+        bucket_name (str): The name of the bucket.
 
+    Returns:
+        tuple(`google.cloud.storage.bucket.Bucket`, float): The bucket handle and
+            the seconds taken to create the storage client, 0 if it already existed.
+    """
+    global storage_client
+    global fits_header_cache
+    client_seconds = 0.
+    if storage_client is None:
+        print(f'Creating storage client for {PROJECT_ID}')
+        t0 = time.time()
+        storage_client = storage.Client(project=PROJECT_ID)
+        fits_header_cache = header_cache.from_env(storage_client)
+        client_seconds = time.time() - t0
 
-def lookup_fits_header(remote_path):
-    """Read the FITS header from storage.
+    try:
+        bucket = bucket_handles[bucket_name]
+    except KeyError:
+        bucket = storage_client.bucket(bucket_name)
+        bucket_handles[bucket_name] = bucket
 
-    FITS Header Units are stored in blocks of 2880 bytes consisting of 36 lines
-    that are 80 bytes long each. The Header Unit always ends with the single
-    word 'END' on a line (not necessarily line 36).
+    return bucket, client_seconds
 
-    Here the header is streamed from Storage until the 'END' is found, with
-    each line given minimal parsing.
 
-    See https://fits.gsfc.nasa.gov/fits_primer.html for overview of FITS format.
+def lookup_headers(bucket, bucket_paths, generations=None):
+    """Look up the headers for several files concurrently.
 
     Args:
-        remote_path (`google.cloud.storage.blob.Blob`): Blob or path to remote blob.
-            If just the blob name is given then the blob is looked up first.
+        bucket (`google.cloud.storage.bucket.Bucket`): The bucket holding the files.
+        bucket_paths (list): The relative paths or public urls of the files.
+        generations (dict|None): The generations of the files if known, keyed by path.
 
     Returns:
-        dict: FITS header as a dictonary.
+        tuple(dict, dict): The headers and the error messages, both keyed by the
+            given path.
     """
-    i = 1
-    if remote_path.name.endswith('.fz'):
-        i = 2  # We skip the compression header info
+    print(f'Looking up headers for {len(bucket_paths)} files')
+    generations = generations or dict()
 
     headers = dict()
+    errors = dict()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {path: executor.submit(lookup_header, bucket, path, generation=generations.get(path))
+                   for path in bucket_paths}
+        for path, future in futures.items():
+            try:
+                headers[path] = future.result()
+            except Exception as e:
+                print(f'Problem looking up header for {path}: {e!r}')
+                errors[path] = str(e)
+
+    print(f'Found {len(headers)} headers with {len(errors)} errors')
+    return headers, errors
+
+
+def lookup_header(bucket, bucket_path, generation=None):
+    """Look up the header for a single file.
+
+    The header is read from the cache if present for the generation of the
+    file, see `common.header_cache.HeaderCache.lookup`.
+
+    Args:
+        bucket (`google.cloud.storage.bucket.Bucket`): The bucket holding the file.
+        bucket_path (str): The relative path or public url of the file.
+        generation (int|None): The generation of the file if known.
+
+    Returns:
+        dict: The FITS header, with `FILENAME` set to the public url of the file.
+
+    Raises:
+        FileNotFoundError: If the file is not in the bucket.
+    """
+    try:
+        bucket_path = bucket_path.replace('https://storage.googleapis.com/panoptes-raw-images/', '')
+    except AttributeError as e:
+        print(f'Problem with bucket_path={bucket_path}: {e!r}')
+
+    print(f"Looking up header for file:  {bucket_path}")
+    storage_blob = bucket.blob(bucket_path)
+
+    timings = dict()
+    try:
+        fits_headers = fits_header_cache.lookup(storage_blob, generation=generation, timings=timings)
+    except exceptions.NotFound:
+        raise FileNotFoundError(f"Nothing found in storage bucket for {bucket_path}")
+
+    print(f'Read header for {bucket_path}. Timing: cache={timings["cache"]:.03f} read={timings["read"]:.03f} '
+          f'parse={timings["parse"]:.03f} sec requests={timings["requests"]}')
+
+    # Change filename to public url of file.
+    fits_headers['FILENAME'] = storage_blob.public_url
 
-    streaming = True
-    while streaming:
-        # Get a header card
-        start_byte = 2880 * (i - 1)
-        end_byte = (2880 * i) - 1
-        b_string = remote_path.download_as_string(start=start_byte,
-                                                  end=end_byte)
-
-        # Loop over 80-char lines
-        for j in range(0, len(b_string), 80):
-            item_string = b_string[j: j + 80].decode()
-
-            # End of FITS Header, stop streaming
-            if item_string.startswith('END'):
-                streaming = False
-                break
-
-            # Get key=value pairs (skip COMMENTS and HISTORY)
-            if item_string.find('=') > 0:
-                k, v = item_string.split('=')
-
-                # Remove FITS comment
-                if ' / ' in v:
-                    v = v.split(' / ')[0]
-
-                v = v.strip()
-
-                # Cleanup and discover type in dumb fashion
-                if v.startswith("'") and v.endswith("'"):
-                    v = v.replace("'", "").strip()
-                elif v.find('.') > 0:
-                    v = float(v)
-                elif v == 'T':
-                    v = True
-                elif v == 'F':
-                    v = False
-                else:
-                    v = int(v)
-
-                headers[k.strip()] = v
-
-        i += 1
-
-    return headers
+    return fits_headers
@@ -0,0 +1,117 @@
+"""Collect subscriber messages into batches.
+
+The subscriber calls `MessageBatcher.add` for each message, which only queues
+the message. A background thread hands the queued messages to the processing
+function once there are `max_size` of them or the oldest has waited
+`max_wait` seconds, whichever is first. The batches are processed on the
+given executor, so several can run at once. Each message is still acked or
+nacked individually by the processing function; if it raises, only the
+messages it had not finished are nacked with the `nack` callback.
+"""
+import threading
+import time
+from collections import deque
+
+
+class MessageBatcher(object):
+    """Hand messages to `process_batch` in batches.
+
+    Args:
+        process_batch (callable): Called with a list of messages.
+        max_size (int): The largest number of messages in a batch.
+        max_wait (float): The longest time in seconds a message waits for a batch.
+        executor (`concurrent.futures.Executor`|None): Runs the batches, default
+            None processes them one at a time on the batcher thread.
+        nack (callable|None): Called with each message to nack if `process_batch`
+            raises, default None calls `message.nack`.
+    """
+
+    def __init__(self, process_batch, max_size=10, max_wait=5., executor=None, nack=None):
+        self.process_batch = process_batch
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.executor = executor
+        self.nack = nack or (lambda message: message.nack())
+
+        # The arrival time and message, oldest first.
+        self._messages = deque()
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, name='message-batcher', daemon=True)
+        self._thread.start()
+
+    @property
+    def queue_size(self):
+        """int: The number of messages waiting for a batch."""
+        with self._condition:
+            return len(self._messages)
+
+    def add(self, message):
+        """Queue a message for the next batch."""
+        with self._condition:
+            self._messages.append((time.monotonic(), BatchMessage(message)))
+            if len(self._messages) >= self.max_size:
+                self._condition.notify()
+
+    def next_batch(self):
+        """Wait for the next batch of messages.
+
+        Returns:
+            list: The messages, at most `max_size`.
+        """
+        with self._condition:
+            while True:
+                if self._messages:
+                    oldest_time, _ = self._messages[0]
+                    wait_time = oldest_time + self.max_wait - time.monotonic()
+                    if len(self._messages) >= self.max_size or wait_time <= 0:
+                        break
+                else:
+                    wait_time = None
+
+                self._condition.wait(timeout=wait_time)
+
+            batch_size = min(len(self._messages), self.max_size)
+            batch = [self._messages.popleft()[1] for _ in range(batch_size)]
+
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self.next_batch()
+            if self.executor is None:
+                self._process(batch)
+            else:
+                self.executor.submit(self._process, batch)
+
+    def _process(self, batch):
+        print(f'Processing batch of {len(batch)} messages')
+        try:
+            self.process_batch(batch)
+        except Exception as e:
+            print(f'Problem processing batch: {e!r}')
+            for message in batch:
+                if not message.finished:
+                    self.nack(message)
+
+
+class BatchMessage(object):
+    """A subscriber message that records if it was acked or nacked.
+
+    Everything else is passed through to the message.
+    """
+
+    def __init__(self, message):
+        self.message = message
+        self.finished = False
+
+    def __getattr__(self, name):
+        return getattr(self.message, name)
+
+    def ack(self):
+        self.finished = True
+        self.message.ack()
+
+    def nack(self):
+        self.finished = True
+        self.message.nack()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Build the local catalog used with `CATALOG_ENGINE=local`.
+
+The stars are read one declination band at a time, either from BigQuery or
+from a parquet export of the `catalog.pic` table, sorted by sky tile and
+appended to a raw file per column. See `catalog.LocalCatalog` for the layout.
+
+    cd $PANDIR/panoptes-network/lookup-catalog-sources
+    python build_catalog.py bigquery /var/panoptes/catalog
+    python build_catalog.py /data/pic-export/ /var/panoptes/catalog --tile-size 2
+"""
+import json
+import os
+import time
+
+import click
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import catalog
+
+# Column names in the `catalog.pic` table.
+SOURCE_COLUMNS = {
+    'id': 'picid',
+    'twomass': 'twomass',
+    'gaia': 'gaia',
+    'ra': 'catalog_ra',
+    'dec': 'catalog_dec',
+    'vmag': 'catalog_vmag',
+    'vmag_partition': 'catalog_vmag_bin',
+    'e_vmag': 'catalog_vmag_err',
+}
+
+
+def read_band_bigquery(bq_client, dec_min, dec_max, vmag_min, vmag_max):
+    """Read the stars in a declination band from BigQuery."""
+    sql = catalog.catalog_sql(f'dec >= {dec_min:.06f} AND dec < {dec_max:.06f}', vmag_min, vmag_max)
+    return bq_client.query(sql).to_arrow()
+
+
+def read_band_parquet(dataset, dec_min, dec_max, vmag_min, vmag_max):
+    """Read the stars in a declination band from a parquet export."""
+    import pyarrow.dataset as ds
+
+    band_filter = ((ds.field('dec') >= dec_min) & (ds.field('dec') < dec_max) &
+                   (ds.field('vmag_partition') >= vmag_min) &
+                   (ds.field('vmag_partition') < vmag_max))
+    band_table = dataset.to_table(columns=list(SOURCE_COLUMNS.keys()), filter=band_filter)
+
+    return band_table.rename_columns([SOURCE_COLUMNS[col] for col in band_table.column_names])
+
+
+def column_values(band_table, col, dtype):
+    """Get a column as a numpy array of the local catalog type."""
+    values = band_table.column(col)
+    if dtype.startswith('S'):
+        values = pc.fill_null(pc.cast(values, pa.string()), '')
+        return np.array(values.to_pylist(), dtype=dtype)
+
+    return values.to_numpy().astype(dtype)
+
+
+def write_catalog(read_band, output_dir, tile_size=catalog.TILE_SIZE,
+                  vmag_min=catalog.VMAG_MIN, vmag_max=catalog.VMAG_MAX):
+    """Write the local catalog files.
+
+    Args:
+        read_band (callable): Called with `(dec_min, dec_max, vmag_min, vmag_max)` and
+            returns a `pyarrow.Table` with the `CATALOG_COLUMNS` for the band.
+        output_dir (str): The directory for the catalog files.
+        tile_size (float): The tile size in degrees.
+        vmag_min (int): Minimum Vmag to include (inclusive).
+        vmag_max (int): Maximum Vmag to include (exclusive).
+
+    Returns:
+        int: The number of stars written.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tiles = catalog.SkyTiles(tile_size)
+
+    tile_counts = np.zeros(tiles.num_tiles, dtype='int64')
+    column_files = {col: open(os.path.join(output_dir, f'{col}.bin'), 'wb')
+                    for col in catalog.LOCAL_DTYPES}
+
+    try:
+        for band in range(tiles.num_bands):
+            dec_min = -90 + band * tile_size
+            dec_max = min(90., dec_min + tile_size)
+            # Include the pole in the last band.
+            if band == tiles.num_bands - 1:
+                dec_max += 1e-6
+
+            t0 = time.time()
+            band_table = read_band(dec_min, dec_max, vmag_min, vmag_max)
+
+            ra = column_values(band_table, 'catalog_ra', 'float64')
+            dec = column_values(band_table, 'catalog_dec', 'float64')
+            # Keep rounding at the band edges from moving a star into another band.
+            band_first_tile = tiles.band_offsets[band]
+            tile_ids = np.clip(tiles.tile_index(ra, dec),
+                               band_first_tile,
+                               band_first_tile + tiles.band_num_tiles[band] - 1)
+            sort_idx = np.argsort(tile_ids, kind='stable')
+
+            for col, dtype in catalog.LOCAL_DTYPES.items():
+                column_values(band_table, col, dtype)[sort_idx].tofile(column_files[col])
+
+            tile_counts += np.bincount(tile_ids, minlength=tiles.num_tiles)
+            print(f'Band {band + 1}/{tiles.num_bands} dec=[{dec_min:.1f}, {dec_max:.1f}): '
+                  f'{band_table.num_rows} stars in {time.time() - t0:.1f} sec')
+    finally:
+        for f in column_files.values():
+            f.close()
+
+    num_rows = int(tile_counts.sum())
+    np.save(os.path.join(output_dir, 'tile_offsets.npy'), np.concatenate([[0], np.cumsum(tile_counts)]))
+    with open(os.path.join(output_dir, 'catalog.json'), 'w') as f:
+        json.dump(dict(tile_size=tile_size,
+                       vmag_min=vmag_min,
+                       vmag_max=vmag_max,
+                       num_rows=num_rows,
+                       columns=catalog.LOCAL_DTYPES), f, indent=2)
+
+    return num_rows
+
+
+@click.command()
+@click.argument('source')
+@click.argument('output_dir')
+@click.option('--tile-size', default=catalog.TILE_SIZE, help='Tile size in degrees.')
+@click.option('--vmag-min', default=catalog.VMAG_MIN, help='Minimum Vmag (inclusive).')
+@click.option('--vmag-max', default=catalog.VMAG_MAX, help='Maximum Vmag (exclusive).')
+def main(source, output_dir, tile_size, vmag_min, vmag_max):
+    """Build the catalog from SOURCE, either `bigquery` or a parquet file or directory."""
+    if source == 'bigquery':
+        from google.cloud import bigquery
+        bq_client = bigquery.Client()
+
+        def read_band(*args):
+            return read_band_bigquery(bq_client, *args)
+    else:
+        import pyarrow.dataset as ds
+        dataset = ds.dataset(source, format='parquet')
+
+        def read_band(*args):
+            return read_band_parquet(dataset, *args)
+
+    t0 = time.time()
+    num_rows = write_catalog(read_band, output_dir, tile_size=tile_size, vmag_min=vmag_min, vmag_max=vmag_max)
+    print(f'Wrote {num_rows} stars to {output_dir} in {time.time() - t0:.1f} sec')
+
+
+if __name__ == '__main__':
+    main()
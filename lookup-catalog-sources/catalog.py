@@ -0,0 +1,671 @@
+"""Catalog lookups by sky tile.
+
+The sky is split into fixed tiles: declination bands of `TILE_SIZE` degrees,
+each split into roughly square RA tiles. The catalog stars for a tile are
+stored as a small parquet file, either in a local directory or in a bucket.
+Units revisit the same fields night after night, so most lookups only need
+tiles that are already stored and the BigQuery query is skipped entirely.
+
+The store has a size cap and the least recently used tiles are evicted first.
+
+Alternatively the whole catalog can be kept on local disk as column files
+sorted by tile (see `build_catalog.py`), in which case a footprint lookup is
+a few slices of memory-mapped arrays and BigQuery is not used at all.
+"""
+import json
+import os
+import time
+import uuid
+from contextlib import suppress
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from astropy.wcs.utils import proj_plane_pixel_scales
+from google.cloud import exceptions
+
+TILE_SIZE = float(os.getenv('CATALOG_TILE_SIZE', 2.))  # degrees
+VMAG_MIN = int(os.getenv('CATALOG_VMAG_MIN', 6))
+VMAG_MAX = int(os.getenv('CATALOG_VMAG_MAX', 18))
+
+CACHE_DIR = os.getenv('CATALOG_CACHE_DIR')
+CACHE_BUCKET = os.getenv('CATALOG_CACHE_BUCKET')
+CACHE_PREFIX = os.getenv('CATALOG_CACHE_PREFIX', 'catalog-tiles')
+CACHE_MAX_BYTES = int(os.getenv('CATALOG_CACHE_MAX_BYTES', 5 * 1024 ** 3))
+
+# The last use of a tile in a bucket is only updated if older than this many
+# seconds, so most cache hits do not write to the bucket.
+CACHE_TOUCH_INTERVAL = float(os.getenv('CATALOG_CACHE_TOUCH_INTERVAL', 24 * 3600))
+
+# Seconds between listing the store to evict tiles, unless the tiles written
+# since the last listing could take it over the size cap.
+CACHE_EVICT_INTERVAL = float(os.getenv('CATALOG_CACHE_EVICT_INTERVAL', 3600))
+
+# Suffix of the tile files that are still being written to the local cache.
+TMP_SUFFIX = '.tmp'
+
+# Which catalog to use, either `bigquery` (optionally with the tile cache) or `local`.
+ENGINE = os.getenv('CATALOG_ENGINE', 'bigquery')
+LOCAL_DIR = os.getenv('CATALOG_LOCAL_DIR')
+
+CATALOG_COLUMNS = [
+    'picid',
+    'twomass',
+    'gaia',
+    'catalog_ra',
+    'catalog_dec',
+    'catalog_vmag',
+    'catalog_vmag_bin',
+    'catalog_vmag_err',
+]
+
+# The column types in the local catalog files.
+LOCAL_DTYPES = {
+    'picid': 'int64',
+    'twomass': 'S20',
+    'gaia': 'S20',
+    'catalog_ra': 'float64',
+    'catalog_dec': 'float64',
+    'catalog_vmag': 'float32',
+    'catalog_vmag_bin': 'int8',
+    'catalog_vmag_err': 'float32',
+}
+
+# Pixels outside the image that still count as in the footprint.
+FOOTPRINT_MARGIN = 50
+
+
+class SkyTiles(object):
+    """Quantize the sky into tiles of roughly equal area.
+
+    Args:
+        tile_size (float): The height of the declination bands in degrees, which is
+            also the approximate width of the tiles.
+    """
+
+    def __init__(self, tile_size=TILE_SIZE):
+        self.tile_size = tile_size
+        self.num_bands = int(np.ceil(180 / tile_size))
+
+        band_centers = -90 + (np.arange(self.num_bands) + 0.5) * tile_size
+        band_widths = 360 * np.cos(np.radians(band_centers)) / tile_size
+        self.band_num_tiles = np.maximum(1, np.floor(band_widths)).astype(int)
+        self.band_offsets = np.concatenate([[0], np.cumsum(self.band_num_tiles)[:-1]])
+
+    @property
+    def num_tiles(self):
+        """int: The total number of tiles."""
+        return int(self.band_num_tiles.sum())
+
+    def tile_index(self, ra, dec):
+        """Get the tile index for each coordinate.
+
+        Args:
+            ra (`numpy.ndarray`|float): The RA in degrees.
+            dec (`numpy.ndarray`|float): The Dec in degrees.
+
+        Returns:
+            `numpy.ndarray`: The tile indexes.
+        """
+        band = np.clip(np.floor((np.asarray(dec) + 90) / self.tile_size).astype(int),
+                       0, self.num_bands - 1)
+        num_tiles = self.band_num_tiles[band]
+        ra_idx = np.minimum(np.floor(np.mod(ra, 360) / 360 * num_tiles).astype(int), num_tiles - 1)
+
+        return self.band_offsets[band] + ra_idx
+
+    def tile_bounds(self, tile_id):
+        """Get the bounds of a tile.
+
+        Args:
+            tile_id (int): The tile index.
+
+        Returns:
+            tuple(float): The `(ra_min, ra_max, dec_min, dec_max)` in degrees.
+        """
+        band = int(np.searchsorted(self.band_offsets, tile_id, side='right') - 1)
+        tile_width = 360 / self.band_num_tiles[band]
+        ra_idx = tile_id - self.band_offsets[band]
+        dec_min = -90 + band * self.tile_size
+
+        return (ra_idx * tile_width,
+                (ra_idx + 1) * tile_width,
+                dec_min,
+                min(90., dec_min + self.tile_size))
+
+    def footprint_tiles(self, wcs, margin=FOOTPRINT_MARGIN):
+        """Get the tiles covering the footprint of a WCS.
+
+        The image is sampled on a grid with a spacing of a quarter tile, so
+        only slivers of a tile at the very edge of the image can be missed.
+
+        Args:
+            wcs (`astropy.wcs.WCS`): The WCS with a `pixel_shape`.
+            margin (int): Pixels outside the image to include.
+
+        Returns:
+            list: The sorted tile indexes.
+        """
+        if wcs.pixel_shape is None:
+            world_coords = wcs.calc_footprint()
+        else:
+            pixel_scale = proj_plane_pixel_scales(wcs.celestial).max()
+            width, height = wcs.pixel_shape
+            num_x = int(np.ceil((width + 2 * margin) * pixel_scale / (self.tile_size / 4))) + 1
+            num_y = int(np.ceil((height + 2 * margin) * pixel_scale / (self.tile_size / 4))) + 1
+            xx, yy = np.meshgrid(np.linspace(-margin, width - 1 + margin, num_x),
+                                 np.linspace(-margin, height - 1 + margin, num_y))
+            world_coords = wcs.all_pix2world(np.column_stack([xx.ravel(), yy.ravel()]), 0)
+
+        tile_ids = np.unique(self.tile_index(world_coords[:, 0], world_coords[:, 1]))
+
+        return tile_ids.tolist()
+
+
+class LocalTileStore(object):
+    """Tile files in a local directory, with the modification time as last use.
+
+    The directory can be shared by several threads or processes: tiles are
+    written to a temporary file that is moved into place and a tile removed by
+    another process is skipped.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+
+    def read(self, name):
+        path = os.path.join(self.root_dir, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def write(self, name, data):
+        path = os.path.join(self.root_dir, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Written next to the tile and moved into place, so a reader never sees part of a tile.
+        tmp_path = f'{path}.{uuid.uuid4().hex}{TMP_SUFFIX}'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        finally:
+            with suppress(FileNotFoundError):
+                os.remove(tmp_path)
+
+    def entries(self):
+        """list: The `(name, size, last_used)` for each tile."""
+        tile_entries = list()
+        for dir_path, _, filenames in os.walk(self.root_dir):
+            for filename in filenames:
+                if filename.endswith(TMP_SUFFIX):
+                    continue
+                path = os.path.join(dir_path, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another process since the walk.
+                    continue
+                tile_entries.append((os.path.relpath(path, self.root_dir), stat.st_size, stat.st_mtime))
+
+        return tile_entries
+
+    def delete(self, name):
+        # Another process may have evicted it already.
+        with suppress(FileNotFoundError):
+            os.remove(os.path.join(self.root_dir, name))
+
+
+class BucketTileStore(object):
+    """Tile objects in a bucket, with the last use stored as custom metadata.
+
+    The last use is only written when the one known to this process, from
+    using the tile or from `entries`, is older than `touch_interval` seconds.
+
+    Args:
+        bucket (`google.cloud.storage.bucket.Bucket`): The bucket for the tiles.
+        prefix (str): The prefix of the tile objects.
+        touch_interval (float): The seconds before the last use is updated.
+    """
+
+    def __init__(self, bucket, prefix=CACHE_PREFIX, touch_interval=CACHE_TOUCH_INTERVAL):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.touch_interval = touch_interval
+
+        self._last_used = dict()
+
+    def read(self, name):
+        tile_blob = self.bucket.blob(f'{self.prefix}/{name}')
+        try:
+            data = tile_blob.download_as_string()
+        except exceptions.NotFound:
+            return None
+
+        now = time.time()
+        if now - self._last_used.get(name, 0) > self.touch_interval:
+            try:
+                tile_blob.metadata = dict(last_used=str(now))
+                tile_blob.patch()
+                self._last_used[name] = now
+            except Exception as e:
+                print(f'Problem marking {name} as used: {e!r}')
+
+        return data
+
+    def write(self, name, data):
+        tile_blob = self.bucket.blob(f'{self.prefix}/{name}')
+        now = time.time()
+        tile_blob.metadata = dict(last_used=str(now))
+        tile_blob.upload_from_string(data, content_type='application/octet-stream')
+        self._last_used[name] = now
+
+    def entries(self):
+        """list: The `(name, size, last_used)` for each tile."""
+        tile_entries = list()
+        for tile_blob in self.bucket.list_blobs(prefix=f'{self.prefix}/'):
+            last_used = (tile_blob.metadata or dict()).get('last_used')
+            if last_used is None:
+                last_used = tile_blob.updated.timestamp()
+            name = tile_blob.name[len(self.prefix) + 1:]
+            tile_entries.append((name, tile_blob.size, float(last_used)))
+            self._last_used[name] = max(float(last_used), self._last_used.get(name, 0))
+
+        return tile_entries
+
+    def delete(self, name):
+        self._last_used.pop(name, None)
+        with suppress(exceptions.NotFound):
+            self.bucket.delete_blob(f'{self.prefix}/{name}')
+
+
+class CatalogTileCache(object):
+    """Catalog stars cached per sky tile.
+
+    Args:
+        store (`LocalTileStore`|`BucketTileStore`): Where the tiles are kept.
+        tiles (`SkyTiles`|None): The tiling, default None uses `TILE_SIZE`.
+        max_bytes (int): The size cap for the store.
+        vmag_min (int): Minimum Vmag to include (inclusive).
+        vmag_max (int): Maximum Vmag to include (exclusive).
+        evict_interval (float): The seconds between listing the store for `evict`.
+    """
+
+    def __init__(self, store, tiles=None, max_bytes=CACHE_MAX_BYTES, vmag_min=VMAG_MIN, vmag_max=VMAG_MAX,
+                 evict_interval=CACHE_EVICT_INTERVAL):
+        self.store = store
+        self.tiles = tiles or SkyTiles()
+        self.max_bytes = max_bytes
+        self.vmag_min = vmag_min
+        self.vmag_max = vmag_max
+        self.evict_interval = evict_interval
+
+        # The size of the store at the last listing plus the tiles written since.
+        self._stored_bytes = None
+        self._listed_time = None
+
+    def tile_name(self, tile_id):
+        return f'{self.vmag_min}-{self.vmag_max}/{self.tiles.tile_size:g}/{tile_id}.parquet'
+
+    def get_stars_from_footprint(self, wcs, bq_client):
+        """Look up the catalog stars in the footprint of the WCS.
+
+        Args:
+            wcs (`astropy.wcs.WCS`): A valid WCS.
+            bq_client (`google.cloud.bigquery.Client`): The BigQuery client for missing tiles.
+
+        Returns:
+            tuple(`pandas.DataFrame`, dict): The catalog stars and info about the lookup.
+        """
+        stars_list, lookup_info = self.get_stars_from_footprints([wcs], bq_client)
+        return stars_list[0], lookup_info
+
+    def get_stars_from_footprints(self, wcs_list, bq_client):
+        """Look up the catalog stars in the footprints of several WCS at once.
+
+        Each tile is read once even if it is in several footprints and only the
+        tiles that are not stored are queried, all in one query.
+
+        Args:
+            wcs_list (list): The `astropy.wcs.WCS` for each footprint.
+            bq_client (`google.cloud.bigquery.Client`): The BigQuery client for missing tiles.
+
+        Returns:
+            tuple(list, dict): The catalog stars for each footprint and info about the
+                lookup, i.e. the number of tiles and hits, the hit rate and the BigQuery
+                bytes scanned and saved.
+        """
+        tile_ids = footprints_tiles(self.tiles, wcs_list)
+
+        tile_frames = list()
+        missing_tiles = list()
+        bytes_saved = 0
+        for tile_id in tile_ids:
+            tile_data = self.store.read(self.tile_name(tile_id))
+            if tile_data is None:
+                missing_tiles.append(tile_id)
+                continue
+
+            tile_table = pq.read_table(pa.BufferReader(tile_data))
+            bytes_saved += int((tile_table.schema.metadata or dict()).get(b'bytes_scanned', 0))
+            tile_frames.append(tile_table.to_pandas())
+
+        bytes_scanned = 0
+        if missing_tiles:
+            stars, bytes_scanned = self.query_tiles(missing_tiles, bq_client)
+            stars_tile_ids = self.tiles.tile_index(stars.catalog_ra.values, stars.catalog_dec.values)
+            tile_bytes_scanned = bytes_scanned // len(missing_tiles)
+            for tile_id in missing_tiles:
+                tile_stars = stars[stars_tile_ids == tile_id].reset_index(drop=True)
+                tile_data = to_tile_parquet(tile_stars, tile_bytes_scanned)
+                self.store.write(self.tile_name(tile_id), tile_data)
+                tile_frames.append(tile_stars)
+                if self._stored_bytes is not None:
+                    self._stored_bytes += len(tile_data)
+
+            self.evict()
+
+        catalog_stars = pd.concat(tile_frames, ignore_index=True)
+
+        num_hits = len(tile_ids) - len(missing_tiles)
+        lookup_info = dict(
+            engine='tile-cache',
+            num_footprints=len(wcs_list),
+            num_tiles=len(tile_ids),
+            tile_hits=num_hits,
+            hit_rate=round(num_hits / len(tile_ids), 3),
+            bytes_scanned=int(bytes_scanned),
+            bytes_scanned_saved=int(bytes_saved),
+        )
+
+        return split_footprints(wcs_list, catalog_stars), lookup_info
+
+    def query_tiles(self, tile_ids, bq_client):
+        """Query BigQuery for all the stars in the given tiles, see `query_tiles`."""
+        return query_tiles(self.tiles, tile_ids, bq_client, vmag_min=self.vmag_min, vmag_max=self.vmag_max)
+
+    def evict(self):
+        """Remove the least recently used tiles until the store is under `max_bytes`.
+
+        The store is only listed every `evict_interval` seconds, or sooner if
+        the tiles written since the last listing could take it over `max_bytes`.
+        """
+        now = time.monotonic()
+        if (self._stored_bytes is not None
+                and self._stored_bytes <= self.max_bytes
+                and now - self._listed_time < self.evict_interval):
+            return
+
+        tile_entries = sorted(self.store.entries(), key=lambda entry: entry[2])
+        total_bytes = sum(size for _, size, _ in tile_entries)
+
+        for name, size, _ in tile_entries:
+            if total_bytes <= self.max_bytes:
+                break
+
+            self.store.delete(name)
+            total_bytes -= size
+
+        self._stored_bytes = total_bytes
+        self._listed_time = now
+
+
+class LocalCatalog(object):
+    """The catalog on local disk, with the rows sorted by sky tile.
+
+    The directory holds a raw file for each of the `LOCAL_DTYPES` columns, the
+    `tile_offsets.npy` index of where each tile starts and a `catalog.json`
+    describing the tiling, as written by `build_catalog.py`. The column files
+    are memory-mapped so only the pages for the requested tiles are read.
+
+    Args:
+        catalog_dir (str): The directory with the catalog files.
+    """
+
+    def __init__(self, catalog_dir):
+        self.catalog_dir = catalog_dir
+
+        with open(os.path.join(catalog_dir, 'catalog.json')) as f:
+            catalog_info = json.load(f)
+
+        self.tiles = SkyTiles(catalog_info['tile_size'])
+        self.vmag_min = catalog_info['vmag_min']
+        self.vmag_max = catalog_info['vmag_max']
+        self.num_rows = catalog_info['num_rows']
+
+        self.tile_offsets = np.load(os.path.join(catalog_dir, 'tile_offsets.npy'))
+        self.columns = {
+            col: np.memmap(os.path.join(catalog_dir, f'{col}.bin'),
+                           dtype=dtype,
+                           mode='r',
+                           shape=(self.num_rows,))
+            for col, dtype in catalog_info['columns'].items()
+        }
+
+    def get_stars_from_footprint(self, wcs, bq_client=None):
+        """Look up the catalog stars in the footprint of the WCS.
+
+        Args:
+            wcs (`astropy.wcs.WCS`): A valid WCS.
+            bq_client (None): Unused, for the same signature as `CatalogTileCache`.
+
+        Returns:
+            tuple(`pandas.DataFrame`, dict): The catalog stars and info about the lookup.
+        """
+        stars_list, lookup_info = self.get_stars_from_footprints([wcs])
+        return stars_list[0], lookup_info
+
+    def get_stars_from_footprints(self, wcs_list, bq_client=None):
+        """Look up the catalog stars in the footprints of several WCS at once.
+
+        Args:
+            wcs_list (list): The `astropy.wcs.WCS` for each footprint.
+            bq_client (None): Unused, for the same signature as `CatalogTileCache`.
+
+        Returns:
+            tuple(list, dict): The catalog stars for each footprint and info about the
+                lookup, i.e. the number of tiles and the number of rows read.
+        """
+        tile_ids = footprints_tiles(self.tiles, wcs_list)
+
+        # Neighbouring tiles in a band are contiguous in the files.
+        row_ranges = list()
+        for tile_id in tile_ids:
+            start, end = self.tile_offsets[tile_id], self.tile_offsets[tile_id + 1]
+            if row_ranges and row_ranges[-1][1] == start:
+                row_ranges[-1][1] = end
+            else:
+                row_ranges.append([start, end])
+
+        stars = dict()
+        for col, values in self.columns.items():
+            stars[col] = np.concatenate([values[start:end] for start, end in row_ranges])
+            if values.dtype.kind == 'S':
+                stars[col] = stars[col].astype(str)
+
+        catalog_stars = pd.DataFrame(stars)[CATALOG_COLUMNS]
+
+        lookup_info = dict(
+            engine='local',
+            num_footprints=len(wcs_list),
+            num_tiles=len(tile_ids),
+            rows_read=len(catalog_stars),
+        )
+
+        return split_footprints(wcs_list, catalog_stars), lookup_info
+
+
+class BigQueryCatalog(object):
+    """The catalog in BigQuery, without a cache.
+
+    A single footprint uses `panoptes.utils.stars.get_stars_from_footprint`. Several
+    footprints are looked up with one query for the tiles covering all of them.
+
+    Args:
+        tiles (`SkyTiles`|None): The tiling, default None uses `TILE_SIZE`.
+        vmag_min (int): Minimum Vmag to include (inclusive).
+        vmag_max (int): Maximum Vmag to include (exclusive).
+    """
+
+    def __init__(self, tiles=None, vmag_min=VMAG_MIN, vmag_max=VMAG_MAX):
+        self.tiles = tiles or SkyTiles()
+        self.vmag_min = vmag_min
+        self.vmag_max = vmag_max
+
+    def get_stars_from_footprint(self, wcs, bq_client):
+        """Look up the catalog stars in the footprint of the WCS.
+
+        Args:
+            wcs (`astropy.wcs.WCS`): A valid WCS.
+            bq_client (`google.cloud.bigquery.Client`): The BigQuery client.
+
+        Returns:
+            tuple(`pandas.DataFrame`, dict): The catalog stars and info about the lookup.
+        """
+        stars_list, lookup_info = self.get_stars_from_footprints([wcs], bq_client)
+        return stars_list[0], lookup_info
+
+    def get_stars_from_footprints(self, wcs_list, bq_client):
+        """Look up the catalog stars in the footprints of several WCS at once.
+
+        Args:
+            wcs_list (list): The `astropy.wcs.WCS` for each footprint.
+            bq_client (`google.cloud.bigquery.Client`): The BigQuery client.
+
+        Returns:
+            tuple(list, dict): The catalog stars for each footprint and info about the
+                lookup, i.e. the number of tiles and the bytes scanned by the query.
+        """
+        if len(wcs_list) == 1:
+            from panoptes.utils.stars import get_stars_from_footprint
+            catalog_stars = get_stars_from_footprint(wcs_list[0], bq_client=bq_client)
+            return [catalog_stars], dict(engine='bigquery', num_footprints=1)
+
+        tile_ids = footprints_tiles(self.tiles, wcs_list)
+        catalog_stars, bytes_scanned = query_tiles(self.tiles, tile_ids, bq_client,
+                                                   vmag_min=self.vmag_min, vmag_max=self.vmag_max)
+
+        lookup_info = dict(
+            engine='bigquery',
+            num_footprints=len(wcs_list),
+            num_tiles=len(tile_ids),
+            bytes_scanned=int(bytes_scanned),
+        )
+
+        return split_footprints(wcs_list, catalog_stars), lookup_info
+
+
+def footprints_tiles(tiles, wcs_list):
+    """The sorted tile indexes covering all the footprints."""
+    return sorted(set().union(*[tiles.footprint_tiles(wcs) for wcs in wcs_list]))
+
+
+def split_footprints(wcs_list, catalog_stars):
+    """Split the stars into those in each footprint, a star can be in several."""
+    return [catalog_stars[in_footprint(wcs, catalog_stars)].reset_index(drop=True) for wcs in wcs_list]
+
+
+def query_tiles(tiles, tile_ids, bq_client, vmag_min=VMAG_MIN, vmag_max=VMAG_MAX):
+    """Query BigQuery for all the stars in the given tiles.
+
+    Args:
+        tiles (`SkyTiles`): The tiling.
+        tile_ids (list): The tile indexes.
+        bq_client (`google.cloud.bigquery.Client`): The BigQuery client.
+        vmag_min (int): Minimum Vmag to include (inclusive).
+        vmag_max (int): Maximum Vmag to include (exclusive).
+
+    Returns:
+        tuple(`pandas.DataFrame`, int): The stars and the bytes scanned by the query.
+    """
+    tile_constraints = list()
+    for tile_id in tile_ids:
+        ra_min, ra_max, dec_min, dec_max = tiles.tile_bounds(tile_id)
+        tile_constraints.append(f'(ra >= {ra_min:.06f} AND ra < {ra_max:.06f} '
+                                f'AND dec >= {dec_min:.06f} AND dec < {dec_max:.06f})')
+
+    sql = catalog_sql(' OR '.join(tile_constraints), vmag_min, vmag_max)
+
+    query_job = bq_client.query(sql)
+    stars = query_job.to_dataframe()
+
+    return stars[CATALOG_COLUMNS], query_job.total_bytes_processed or 0
+
+
+def in_footprint(wcs, stars, margin=FOOTPRINT_MARGIN):
+    """Mask for the stars that fall on (or within `margin` pixels of) the image.
+
+    Uses the linear part of the WCS, which is cheap for the whole catalog and
+    close enough for a margin of a few pixels.
+    """
+    if wcs.pixel_shape is None:
+        return np.ones(len(stars), dtype=bool)
+
+    width, height = wcs.pixel_shape
+    x, y = wcs.wcs_world2pix(stars.catalog_ra.values, stars.catalog_dec.values, 0)
+
+    return (x >= -margin) & (x < width + margin) & (y >= -margin) & (y < height + margin)
+
+
+def to_tile_parquet(tile_stars, bytes_scanned):
+    """Write the stars for a tile to parquet bytes, recording the bytes scanned to get them."""
+    tile_table = pa.Table.from_pandas(tile_stars, preserve_index=False)
+    tile_table = tile_table.replace_schema_metadata({
+        **(tile_table.schema.metadata or dict()),
+        b'bytes_scanned': str(int(bytes_scanned)).encode(),
+    })
+
+    bio = BytesIO()
+    pq.write_table(tile_table, bio)
+
+    return bio.getvalue()
+
+
+def catalog_sql(constraint, vmag_min=VMAG_MIN, vmag_max=VMAG_MAX):
+    """The catalog query with the `CATALOG_COLUMNS` names for the given sky constraint."""
+    # Note that for how the BigQuery partition works, we need the partition one step
+    # below the requested Vmag_max.
+    return f"""
+    SELECT
+        id as picid, twomass, gaia,
+        ra as catalog_ra,
+        dec as catalog_dec,
+        vmag as catalog_vmag,
+        vmag_partition as catalog_vmag_bin,
+        e_vmag as catalog_vmag_err
+    FROM catalog.pic
+    WHERE
+      vmag_partition BETWEEN {vmag_min} AND {vmag_max - 1}
+      AND ({constraint})
+    """
+
+
+def from_env(storage_client=None):
+    """Create the catalog engine configured from the environment.
+
+    If `CATALOG_ENGINE=local` the catalog in `CATALOG_LOCAL_DIR` is used. Otherwise
+    the BigQuery lookups are cached in `CATALOG_CACHE_DIR` if set, or in
+    `CATALOG_CACHE_BUCKET` if set and a `storage_client` is given.
+
+    Args:
+        storage_client (`google.cloud.storage.Client`|None): Client for the cache bucket.
+
+    Returns:
+        `LocalCatalog`|`CatalogTileCache`|`BigQueryCatalog`: The catalog engine.
+    """
+    if ENGINE == 'local':
+        return LocalCatalog(LOCAL_DIR)
+
+    if CACHE_DIR:
+        return CatalogTileCache(LocalTileStore(CACHE_DIR))
+
+    if CACHE_BUCKET and storage_client is not None:
+        return CatalogTileCache(BucketTileStore(storage_client.bucket(CACHE_BUCKET)))
+
+    return BigQueryCatalog()
@@ -1,130 +1,146 @@
 import os
 import sys
-from contextlib import suppress
-from io import BytesIO
-
-import numpy as np
-import pandas as pd
-import pendulum
-import requests
-from astropy.utils.data import clear_download_cache
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+
+from astropy.io import fits
+from astropy.wcs import WCS
 from google.cloud import bigquery
+from google.cloud import exceptions
 from google.cloud import firestore
 from google.cloud import pubsub
 from google.cloud import pubsub_v1
 from google.cloud import storage
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
 from panoptes.utils import image_id_from_path
 from panoptes.utils import sequence_id_from_path
-from panoptes.utils.images import fits as fits_utils
 from panoptes.utils.logger import logger
-from panoptes.utils.stars import get_stars_from_footprint
+
+import batching
+import catalog
+import metadata
+import metrics
+import sources
+from common import header_cache
 
 logger.enable('panoptes')
 
 PROJECT_ID = os.getenv('PROJECT_ID', 'panoptes-exp')
 BUCKET_NAME = os.getenv('BUCKET_NAME', 'panoptes-observations')
+RAW_BUCKET_NAME = os.getenv('RAW_BUCKET_NAME', 'panoptes-raw-images')
 
 PUBSUB_SUBSCRIPTION = 'read-lookup-catalog-sources'
-MAX_MESSAGES = os.getenv('MAX_MESSAGES', 5)
-
-FITS_HEADER_URL = 'https://us-central1-panoptes-exp.cloudfunctions.net/get-fits-header'
-
-SOURCE_COLUMNS = [
-    'picid',
-    'time',
-    'sequence_id',
-    'catalog_ra',
-    'catalog_dec',
-    'catalog_vmag',
-    'catalog_vmag_err',
-    'catalog_vmag_bin',
-    'x',
-    'y',
-    'x_int',
-    'y_int',
-    'twomass',
-    'gaia',
-    'unit_id',
-]
-
-METADATA_COLUMNS = {
-    'unit_id': 'unit_id',
-    'sequence_id': 'sequence_id',
-    'image_id': 'image_id',
-    'time': 'time',
-    'ra_mnt': 'mount_ra',
-    'ha_mnt': 'mount_ha',
-    'dec_mnt': 'mount_dec',
-    'ra_image': 'image_ra',
-    'dec_image': 'image_dec',
-    'airmass': 'image_airmass',
-    'moonsep': 'image_moonsep',
-    'moonfrac': 'image_moonfrac',
-    'exptime': 'image_exptime',
-    'camera_iso': 'camera_iso',
-    'camera_temp': 'camera_temp',
-    'camera_circconf': 'camera_circconf',
-    'camera_colortemp': 'camera_colortemp',
-    'camera_lens_serial_number': 'camera_lens_serial_number',
-    'camera_serial_number': 'camera_serial_number',
-    'camera_measured_ev': 'camera_measured_ev',
-    'camera_measured_ev2': 'camera_measured_ev2',
-    'camera_measured_r': 'camera_measured_r',
-    'camera_measured_g1': 'camera_measured_g1',
-    'camera_measured_g2': 'camera_measured_g2',
-    'camera_measured_b': 'camera_measured_b',
-    'camera_white_lvln': 'camera_white_lvln',
-    'camera_white_lvls': 'camera_white_lvls',
-    'camera_red_balance': 'camera_red_balance',
-    'camera_blue_balance': 'camera_blue_balance',
-    'site_latitude': 'site_latitude',
-    'site_longitude': 'site_longitude',
-    'site_elevation': 'site_elevation',
-    'bucket_path': 'bucket_path',
-    'public_url': 'public_url',
-}
-HEADER_COLUMNS = {
-    'IMAGEID': 'image_id',
-    'CRVAL1': 'image_ra_center',
-    'CRVAL2': 'image_dec_center',
-    'ISO': 'camera_iso',
-    'CAMTEMP': 'camera_temp',
-    'CIRCCONF': 'camera_circconf',
-    'COLORTMP': 'camera_colortemp',
-    'INTSN': 'camera_lens_serial_number',
-    'CAMSN': 'camera_serial_number',
-    'MEASEV': 'camera_measured_ev',
-    'MEASEV2': 'camera_measured_ev2',
-    'MEASRGGB': 'camera_measured_rggb',
-    'WHTLVLN': 'camera_white_lvln',
-    'WHTLVLS': 'camera_white_lvls',
-    'REDBAL': 'camera_red_balance',
-    'BLUEBAL': 'camera_blue_balance',
-    'LAT-OBS': 'site_latitude',
-    'LONG-OBS': 'site_longitude',
-    'ELEV-OBS': 'site_elevation',
-}
-
-# Storage
-try:
-    bq_client = bigquery.Client()
-    firestore_db = firestore.Client()
-    subscriber = pubsub.SubscriberClient()
-    subscription_path = subscriber.subscription_path(PROJECT_ID, PUBSUB_SUBSCRIPTION)
-
-    storage_client = storage.Client()
-    output_bucket = storage.Client().bucket(BUCKET_NAME)
-except RuntimeError:
-    print(f"Can't load Google credentials, exiting")
-    sys.exit(1)
+
+# Subscriber flow control and concurrency. The work is mostly waiting on Firestore,
+# BigQuery and storage so there are more threads than CPUs. With `PROCESS_WORKERS`
+# the projection and parquet writing run in a pool of processes instead.
+MAX_MESSAGES = int(os.getenv('MAX_MESSAGES', 5))
+MAX_BYTES = int(os.getenv('MAX_BYTES', 10 * 1024 ** 2))
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', 16))
+PROCESS_WORKERS = int(os.getenv('PROCESS_WORKERS', 0))
+METRICS_INTERVAL = float(os.getenv('METRICS_INTERVAL', 60))
+
+# Batch the catalog lookups for up to this many observations or seconds.
+BATCH_SIZE = int(os.getenv('BATCH_SIZE', 1))
+BATCH_WAIT = float(os.getenv('BATCH_WAIT', 5))
+
+# Header harvest for the metadata file.
+HEADER_WORKERS = int(os.getenv('HEADER_WORKERS', 16))
+HEADER_TIMEOUT = float(os.getenv('HEADER_TIMEOUT', 10))
+HEADER_RETRIES = int(os.getenv('HEADER_RETRIES', 3))
+HEADER_BACKOFF = float(os.getenv('HEADER_BACKOFF', 0.5))
+
+# Created by `main` with `init_clients`, so the spawned worker processes, which
+# import this module, do not make any clients.
+bq_client = None
+firestore_db = None
+subscriber = None
+subscription_path = None
+storage_client = None
+output_bucket = None
+raw_images_bucket = None
+fits_header_cache = None
+star_catalog = None
+
+# Created by `main`.
+subscriber_metrics = None
+process_pool = None
+
+
+def init_clients():
+    """Create the clients, the buckets, the header cache and the catalog."""
+    global bq_client
+    global firestore_db
+    global subscriber
+    global subscription_path
+    global storage_client
+    global output_bucket
+    global raw_images_bucket
+    global fits_header_cache
+    global star_catalog
+
+    try:
+        bq_client = bigquery.Client()
+        firestore_db = firestore.Client()
+        subscriber = pubsub.SubscriberClient()
+        subscription_path = subscriber.subscription_path(PROJECT_ID, PUBSUB_SUBSCRIPTION)
+
+        storage_client = storage.Client()
+        output_bucket = storage_client.bucket(BUCKET_NAME)
+        raw_images_bucket = storage_client.bucket(RAW_BUCKET_NAME)
+        fits_header_cache = header_cache.from_env(storage_client)
+        star_catalog = catalog.from_env(storage_client)
+    except RuntimeError:
+        print(f"Can't load Google credentials, exiting")
+        sys.exit(1)
 
 
 def main():
-    print(f'Creating subscriber (messages={MAX_MESSAGES}) for {subscription_path}')
+    global subscriber_metrics
+    global process_pool
+
+    init_clients()
+
+    max_messages = max(MAX_MESSAGES, BATCH_SIZE)
+    print(f'Creating subscriber (messages={max_messages} bytes={MAX_BYTES} threads={WORKER_THREADS} '
+          f'processes={PROCESS_WORKERS}) for {subscription_path}')
+
+    executor = metrics.CountingThreadPoolExecutor(max_workers=WORKER_THREADS,
+                                                  thread_name_prefix='catalog-worker')
+    scheduler = ThreadScheduler(executor=executor)
+    queue_depths = dict(executor=executor.queue_depth)
+
+    if PROCESS_WORKERS > 0:
+        # Spawn so the workers do not inherit the gRPC state of the clients.
+        process_pool = ProcessPoolExecutor(max_workers=PROCESS_WORKERS,
+                                           mp_context=multiprocessing.get_context('spawn'))
+
+    if BATCH_SIZE > 1:
+        print(f'Batching up to {BATCH_SIZE} observations or {BATCH_WAIT} seconds')
+        batcher = batching.MessageBatcher(process_batch,
+                                          max_size=BATCH_SIZE,
+                                          max_wait=BATCH_WAIT,
+                                          executor=executor,
+                                          nack=nack)
+        queue_depths['batcher'] = batcher.queue_size
+        process = batcher.add
+    else:
+        process = process_topic
+
+    subscriber_metrics = metrics.SubscriberMetrics(interval=METRICS_INTERVAL, queue_depths=queue_depths)
+    subscriber_metrics.start()
+
+    def callback(message):
+        subscriber_metrics.message_received(message)
+        process(message)
+
     streaming_pull_future = subscriber.subscribe(
         subscription_path,
-        callback=process_topic,
-        flow_control=pubsub_v1.types.FlowControl(max_messages=int(MAX_MESSAGES))
+        callback=callback,
+        flow_control=pubsub_v1.types.FlowControl(max_messages=max_messages, max_bytes=MAX_BYTES),
+        scheduler=scheduler,
     )
 
     print(f'Listening for messages on {subscription_path}')
@@ -139,6 +155,97 @@ def main():
 
 
 def process_topic(message):
+    process_batch([message])
+
+
+def process_batch(messages):
+    """Look up the catalog sources for the observations in a batch of messages.
+
+    The catalog is queried once for the footprints of all the observations and
+    the stars are then split per observation. Each message is acked as soon as
+    its observation is done, or nacked if there was a problem with it.
+
+    Args:
+        messages (list): The `google.cloud.pubsub_v1.subscriber.message.Message`s.
+    """
+    observations = list()
+    for message in messages:
+        try:
+            observation = prepare_observation(message)
+        except Exception as e:
+            logger.warning(f'Problem preparing observation for {dict(message.attributes)!r}: {e!r}')
+            nack(message)
+            continue
+
+        if observation is None:
+            continue
+
+        # Only match the observation once if it is in the batch several times.
+        for other_observation in observations:
+            if other_observation['sequence_id'] == observation['sequence_id']:
+                logger.debug(f'Duplicate message for {observation["sequence_id"]} in batch')
+                other_observation['messages'].append(message)
+                break
+        else:
+            observations.append(observation)
+
+    if len(observations) == 0:
+        return
+
+    sequence_ids = [observation['sequence_id'] for observation in observations]
+    logger.debug(f'Looking up sources for {sequence_ids}')
+    try:
+        catalog_sources_list, catalog_info = star_catalog.get_stars_from_footprints(
+            [observation['wcs'] for observation in observations], bq_client=bq_client)
+    except Exception as e:
+        logger.warning(f'Problem looking up catalog sources for {sequence_ids}: {e!r}')
+        for observation in observations:
+            for message in observation['messages']:
+                nack(message)
+        return
+
+    logger.debug(f'Catalog lookup for {sequence_ids}: {catalog_info!r}')
+
+    for observation, catalog_sources in zip(observations, catalog_sources_list):
+        try:
+            save_sources(observation, catalog_sources, catalog_info)
+        except Exception as e:
+            logger.warning(f'Problem saving sources for {observation["sequence_id"]}: {e!r}')
+            for message in observation['messages']:
+                nack(message)
+            continue
+
+        logger.debug(f'Acking message for {observation["bucket_path"]}')
+        for message in observation['messages']:
+            ack(message)
+
+
+def ack(message):
+    message.ack()
+    if subscriber_metrics is not None:
+        subscriber_metrics.message_finished(message, success=True)
+
+
+def nack(message):
+    message.nack()
+    if subscriber_metrics is not None:
+        subscriber_metrics.message_finished(message, success=False)
+
+
+def prepare_observation(message):
+    """Get the observation and the WCS for a message.
+
+    Messages that do not need a catalog lookup are acked (or nacked for an
+    image that needs a new plate-solve) here.
+
+    Args:
+        message (`google.cloud.pubsub_v1.subscriber.message.Message`): The message.
+
+    Returns:
+        dict|None: The observation with the `sequence_id`, `image_id`, `bucket_path`,
+            `force` option, `wcs`, `wcs_info`, firestore `doc_ref` and `messages`, or
+            None if nothing needs to be done.
+    """
     data = message.data.decode('utf-8')
     attributes = dict(message.attributes)
 
@@ -165,8 +272,8 @@ def process_topic(message):
             bucket_path = url_list[0]
         except IndexError:
             logger.info(f'No solved images found for {sequence_id}')
-            message.ack()
-            return
+            ack(message)
+            return None
 
     if image_id is not None:
         logger.debug(f'Using image_id={image_id} to get bucket_path')
@@ -187,162 +294,272 @@ def process_topic(message):
             if source_file_exists and metadata_file_exists:
                 logger.debug(f'status="solved" but files exist, setting status="matched" for sequence_id={sequence_id}')
                 observation_doc_ref.set(dict(status='matched'), merge=True)
-                message.ack()
-                return
+                ack(message)
+                return None
 
         if obs_status != 'receiving_files':
             logger.warning(f'Observation status={obs_status}. Will only proceed if stats=received_files or force=True')
-            message.ack()
-            return
+            ack(message)
+            return None
 
     # If given a relative path instead of url, attempt default public location.
     if not bucket_path.startswith('https'):
         bucket_path = f'https://storage.googleapis.com/panoptes-raw-images/{bucket_path}'
         logger.debug(f'Given bucket_path looks like a relative path, change to url={bucket_path}')
 
-    wcs = fits_utils.getwcs(bucket_path)
+    wcs, wcs_info = get_wcs(bucket_path)
+    if wcs is None:
+        logger.warning(f'No file found for {bucket_path}')
+        ack(message)
+        return None
+
+    logger.debug(f'Read WCS header for {bucket_path}: {wcs_info!r}')
     if not wcs.is_celestial:
         logger.warning(f'Image says it is plate-solved but WCS is not valid.')
         firestore_db.document(f'images/{image_id}').set(dict(status='needs-solve', solved=False), merge=True)
         # Force the message to re-send where it will hopefully pick up a correctly solved image.
-        message.nack()
-
-        # Clear the download cache.
-        logger.debug(f'Clearing download cache for {bucket_path}')
-        clear_download_cache(bucket_path)
-        return
-
-    logger.debug(f'Looking up sources for {sequence_id} {wcs}')
-    catalog_sources = get_stars_from_footprint(wcs, bq_client=bq_client)
+        nack(message)
+        return None
+
+    return dict(sequence_id=sequence_id,
+                image_id=image_id,
+                bucket_path=bucket_path,
+                force=force,
+                wcs=wcs,
+                wcs_info=wcs_info,
+                doc_ref=observation_doc_ref,
+                messages=[message])
+
+
+def save_sources(observation, catalog_sources, catalog_info):
+    """Project the catalog sources onto the image and save them for the observation.
+
+    Args:
+        observation (dict): The observation from `prepare_observation`.
+        catalog_sources (`pandas.DataFrame`): The catalog stars in the footprint.
+        catalog_info (dict): Info about the catalog lookup.
+    """
+    sequence_id = observation['sequence_id']
+    wcs = observation['wcs']
+    observation_doc_ref = observation['doc_ref']
     logger.debug(f'Found {len(catalog_sources)} sources in {sequence_id}')
 
-    # Get the XY positions via the WCS
-    logger.debug(f'Getting XY positions for {sequence_id}')
-    catalog_coords = catalog_sources[['catalog_ra', 'catalog_dec']]
-    catalog_xy = wcs.all_world2pix(catalog_coords, 1)
-    catalog_sources['x'] = catalog_xy.T[0]
-    catalog_sources['y'] = catalog_xy.T[1]
-    catalog_sources['x_int'] = catalog_sources.x.astype(int)
-    catalog_sources['y_int'] = catalog_sources.y.astype(int)
-
-    # Get additional metadata.
-    unit_id, camera_id, observation_time = sequence_id.split('_')
-    catalog_sources['unit_id'] = unit_id
-    catalog_sources['sequence_id'] = sequence_id
-    catalog_sources['camera_id'] = camera_id
-    catalog_sources['time'] = pendulum.parse(observation_time).replace(tzinfo=None)
-    catalog_sources['catalog_vmag_bin'] = catalog_sources['catalog_vmag'].apply(np.floor).astype('int')
-
-    # Get just the columns we want.
-    catalog_sources = catalog_sources[SOURCE_COLUMNS]
+    logger.debug(f'Making catalog sources file for {sequence_id}')
+    if process_pool is None:
+        parquet_bytes, projection_info = sources.make_sources_parquet(wcs, catalog_sources, sequence_id)
+    else:
+        parquet_bytes, projection_info = process_pool.submit(sources.make_sources_parquet,
+                                                             wcs, catalog_sources, sequence_id).result()
+    logger.debug(f'Projected sources for {sequence_id}: {projection_info!r}')
 
     sources_bucket_path = f'{sequence_id}-sources.parquet'
     logger.debug(f'Saving catalog sources to {sources_bucket_path}')
 
-    # Lookup output format and save.
-    bio = BytesIO()
-    catalog_sources.convert_dtypes().dropna().to_parquet(bio, index=False)
-    bio.seek(0)
-
     # Upload
     obs_blob = output_bucket.blob(sources_bucket_path)
-    obs_blob.upload_from_file(bio)
+    obs_blob.upload_from_string(parquet_bytes)
     logger.debug(f'Observation metadata saved to {obs_blob.public_url}')
 
     # Update observation status
     wcs_ra = wcs.wcs.crval[0]
     wcs_dec = wcs.wcs.crval[1]
     logger.debug(f'Updating observation status and coordinates for {sequence_id}')
-    observation_doc_ref.set(dict(status='solved', ra=wcs_ra, dec=wcs_dec), merge=True)
+    observation_doc_ref.set(dict(status='solved',
+                                 ra=wcs_ra,
+                                 dec=wcs_dec,
+                                 wcs_lookup=observation['wcs_info'],
+                                 catalog_lookup=catalog_info), merge=True)
 
     # Update observation metadata file
-    update_observation_file(sequence_id)
+    update_observation_file(sequence_id, incremental=observation['force'] is False)
 
     # Mark observation as updated.
     observation_doc_ref.set(dict(status='matched'), merge=True)
     print(f'Observation status set to "matched" for sequence_id={sequence_id}')
 
-    # Clear the WCS from the cache.
-    logger.debug(f'Clearing download cache for {bucket_path}')
-    clear_download_cache(bucket_path)
 
-    logger.debug(f'Acking message for {bucket_path}')
-    message.ack()
+def get_wcs(public_url):
+    """Get the WCS of an image from its header, through the header cache.
+
+    On a miss only the header blocks are read with ranged requests, without
+    fetching the blob metadata, and the header is then cached for the metadata
+    harvest of the observation.
 
+    Args:
+        public_url (str): The public url of the image.
 
-def update_observation_file(sequence_id):
-    print(f'Updating {sequence_id} static file')
+    Returns:
+        tuple(`astropy.wcs.WCS`|None, dict): The WCS, or None if there is no such
+            image, and info about the read, i.e. the bytes downloaded, the number
+            of requests, if the header was cached and the elapsed seconds.
+    """
+    t0 = time.time()
+    bucket_path = public_url.replace(f'https://storage.googleapis.com/{RAW_BUCKET_NAME}/', '')
+    storage_blob = raw_images_bucket.blob(bucket_path)
+
+    timings = dict()
+    try:
+        header = fits_header_cache.lookup(storage_blob, timeout=HEADER_TIMEOUT, timings=timings)
+    except exceptions.NotFound:
+        return None, dict()
+
+    wcs = header_to_wcs(header)
+    wcs_info = dict(
+        bytes_read=timings['bytes_read'],
+        num_requests=timings['requests'],
+        cached=timings['requests'] == 0,
+        elapsed_seconds=round(time.time() - t0, 3),
+    )
+
+    return wcs, wcs_info
+
+
+def header_to_wcs(header):
+    """Build the WCS from the parsed header.
+
+    For an fpacked image the header is for the compressed table, so the image
+    size is taken from the `ZNAXISn` keywords.
+
+    Args:
+        header (dict): The header, as from `fits_header.parse_header`.
+
+    Returns:
+        `astropy.wcs.WCS`: The WCS with the `pixel_shape` of the image.
+    """
+    header = fits.Header(list(header.items()))
+    if header.get('ZIMAGE', False):
+        for i in range(1, header['ZNAXIS'] + 1):
+            header[f'NAXIS{i}'] = header[f'ZNAXIS{i}']
+
+    return WCS(header)
+
+
+def update_observation_file(sequence_id, incremental=True):
+    """Update the metadata file for the observation.
+
+    In incremental mode the image_ids already in the existing metadata file
+    act as the watermark: headers are only looked up for images that are not
+    in the file yet, which are then appended. If there are no new images the
+    file is left untouched.
+
+    Args:
+        sequence_id (str): The sequence_id of the observation.
+        incremental (bool): If only new images should be added to an existing
+            file, default True. If False the file is rebuilt from all images.
+    """
+    print(f'Updating {sequence_id} static file (incremental={incremental})')
+
+    blob = output_bucket.blob(f'{sequence_id}-metadata.parquet')
 
     # Build query
     obs_query = firestore_db.collection('images').where('sequence_id', '==', sequence_id)
 
-    # Fetch documents into a DataFrame.
-    metadata_df = pd.DataFrame([dict(image_id=doc.id, **doc.to_dict()) for doc in obs_query.stream()])
-    print(f'{sequence_id}: Caching {len(metadata_df)} results from lookup')
+    # Fetch documents.
+    image_docs = [dict(image_id=doc.id, **doc.to_dict()) for doc in obs_query.stream()]
+    print(f'{sequence_id}: Caching {len(image_docs)} results from lookup')
+
+    existing_table = None
+    if incremental:
+        try:
+            existing_table = metadata.read_parquet_buffer(blob.download_as_string())
+        except exceptions.NotFound:
+            print(f'No existing metadata file for {sequence_id}')
+        except Exception as e:
+            print(f'Problem reading existing metadata file for {sequence_id}, rebuilding: {e!r}')
+
+    if existing_table is not None:
+        known_image_ids = set(existing_table.column('image_id').to_pylist())
+        image_docs = [doc for doc in image_docs if doc['image_id'] not in known_image_ids]
+        print(f'{sequence_id}: {len(known_image_ids)} images in existing file, '
+              f'{len(image_docs)} new images')
 
     # Look up fits headers
-    fits_list = metadata_df.public_url.tolist()
+    fits_list = [doc['public_url'] for doc in image_docs if doc.get('public_url')]
+    if len(fits_list) == 0:
+        print(f'No new images for {sequence_id}, metadata file unchanged')
+        return
+
     print(f'Looking up headers for {len(fits_list)}')
-    headers = [get_header(f) for f in fits_list]
-    headers = [h for h in headers if type(h) == dict]
-
-    # Build DataFrame.
-    print(f'Making DataFrame for headers')
-    headers_df = pd.DataFrame(headers)[list(HEADER_COLUMNS.keys())].convert_dtypes().dropna()
-
-    # Clean values.
-    rggb_df = headers_df['MEASRGGB'].str.split(' ', expand=True).rename(columns={
-        0: 'camera_measured_r',
-        1: 'camera_measured_g1',
-        2: 'camera_measured_g2',
-        3: 'camera_measured_b',
-    }).astype('int')
-    headers_df = headers_df.join(rggb_df)
-    headers_df['CAMTEMP'] = headers_df.CAMTEMP.map(lambda x: float(x.split(' ')[0]))
-    headers_df['CIRCCONF'] = headers_df.CIRCCONF.map(lambda x: float(x.split(' ')[0]))
-
-    # Give better column names.
-    headers_df = headers_df.convert_dtypes(convert_integer=False).rename(columns=HEADER_COLUMNS)
-
-    print(f'Merging headers DataFrame with metadata')
-    metadata_df = metadata_df.merge(headers_df, on='image_id')
-
-    # Rename to friendlier columns.
-    metadata_df = metadata_df[list(METADATA_COLUMNS.keys())].rename(columns=METADATA_COLUMNS).convert_dtypes()
-
-    dtype_lookup = {
-        'site_elevation': 'float',
-        'image_exptime': 'float',
-        'camera_temp': 'float',
-        'camera_colortemp': 'int',
-        'camera_lens_serial_number': 'string',
-        'camera_serial_number': 'string',
-    }
-
-    # Force dtypes on certain columns.
-    for col, dtype in dtype_lookup.items():
-        with suppress(TypeError):
-            metadata_df[col] = metadata_df[col].astype(dtype)
-
-    bio = BytesIO()
-    metadata_df.dropna().to_parquet(bio, index=False)
-    bio.seek(0)
+    headers, harvest_info = get_headers(fits_list)
+    print(f'{sequence_id}: Header harvest {harvest_info!r}')
+    firestore_db.document(f'observations/{sequence_id}').set(dict(header_harvest=harvest_info), merge=True)
+
+    # Build typed columns directly from the documents and headers.
+    print(f'Making metadata table for {sequence_id}')
+    metadata_table = metadata.build_metadata_table(image_docs, headers)
+
+    if existing_table is not None:
+        if metadata_table.num_rows == 0:
+            print(f'No new complete image records for {sequence_id}, metadata file unchanged')
+            return
+
+        try:
+            metadata_table = metadata.append_rows(existing_table, metadata_table)
+        except ValueError as e:
+            print(f'Unable to append to existing metadata file for {sequence_id}: {e!r}')
+            return update_observation_file(sequence_id, incremental=False)
+
+    bio = metadata.to_parquet_buffer(metadata_table)
 
     # Upload file object to public blob.
-    blob = output_bucket.blob(f'{sequence_id}-metadata.parquet')
     blob.upload_from_file(bio)
     print(f'Observations file available at: {blob.public_url}')
 
 
-def get_header(bucket_path):
-    """Small helper function to lookup FITS header"""
-    res = requests.post(FITS_HEADER_URL, json=dict(bucket_path=bucket_path))
-    try:
-        h0 = res.json()['header']
-    except Exception:
-        h0 = dict()
+def get_headers(public_urls):
+    """Look up the FITS headers for a list of images.
+
+    The headers are read directly from the raw images bucket (via the header
+    cache) with up to `HEADER_WORKERS` concurrent lookups.
+
+    Args:
+        public_urls (list): The public urls of the images.
+
+    Returns:
+        tuple(list, dict): The headers that were found and info about the
+            harvest, i.e. the number of headers, failures and elapsed seconds.
+    """
+    t0 = time.time()
+
+    with ThreadPoolExecutor(max_workers=HEADER_WORKERS) as executor:
+        results = list(executor.map(get_header, public_urls))
+
+    headers = [h for h in results if h is not None]
+    harvest_info = dict(
+        num_headers=len(headers),
+        num_failures=len(results) - len(headers),
+        elapsed_seconds=round(time.time() - t0, 2),
+    )
+
+    return headers, harvest_info
+
+
+def get_header(public_url):
+    """Look up the FITS header for a single image, retrying with backoff.
+
+    Args:
+        public_url (str): The public url of the image.
+
+    Returns:
+        dict|None: The FITS header or None if it could not be read.
+    """
+    bucket_path = public_url.replace(f'https://storage.googleapis.com/{RAW_BUCKET_NAME}/', '')
+    storage_blob = raw_images_bucket.blob(bucket_path)
+
+    for attempt in range(HEADER_RETRIES):
+        try:
+            header = fits_header_cache.lookup(storage_blob, timeout=HEADER_TIMEOUT)
+            header['FILENAME'] = storage_blob.public_url
+            return header
+        except exceptions.NotFound:
+            print(f'No file found for {bucket_path}')
+            return None
+        except Exception as e:
+            print(f'Problem getting header for {bucket_path} (attempt {attempt + 1}): {e!r}')
+            if attempt + 1 < HEADER_RETRIES:
+                time.sleep(HEADER_BACKOFF * 2 ** attempt)
 
-    return h0
+    return None
 
 
 if __name__ == '__main__':
@@ -0,0 +1,240 @@
+"""Build the observation metadata table directly as typed Arrow columns.
+
+The image documents and the FITS headers are each turned into an Arrow
+table with a fixed schema, matched on `image_id` and written to parquet
+without going through object-dtype DataFrames.
+"""
+from io import BytesIO
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Firestore image document fields and their types.
+IMAGE_DOC_TYPES = {
+    'unit_id': pa.string(),
+    'sequence_id': pa.string(),
+    'image_id': pa.string(),
+    'time': pa.timestamp('us', tz='UTC'),
+    'ra_mnt': pa.float64(),
+    'ha_mnt': pa.float64(),
+    'dec_mnt': pa.float64(),
+    'ra_image': pa.float64(),
+    'dec_image': pa.float64(),
+    'airmass': pa.float64(),
+    'moonsep': pa.float64(),
+    'moonfrac': pa.float64(),
+    'exptime': pa.float64(),
+    'bucket_path': pa.string(),
+    'public_url': pa.string(),
+}
+
+# FITS header keywords, the column name and type.
+HEADER_COLUMNS = {
+    'IMAGEID': ('image_id', pa.string()),
+    'CRVAL1': ('image_ra_center', pa.float64()),
+    'CRVAL2': ('image_dec_center', pa.float64()),
+    'ISO': ('camera_iso', pa.int64()),
+    'CAMTEMP': ('camera_temp', pa.float64()),
+    'CIRCCONF': ('camera_circconf', pa.float64()),
+    'COLORTMP': ('camera_colortemp', pa.int64()),
+    'INTSN': ('camera_lens_serial_number', pa.string()),
+    'CAMSN': ('camera_serial_number', pa.string()),
+    'MEASEV': ('camera_measured_ev', pa.float64()),
+    'MEASEV2': ('camera_measured_ev2', pa.float64()),
+    'MEASRGGB': ('camera_measured_rggb', pa.string()),
+    'WHTLVLN': ('camera_white_lvln', pa.int64()),
+    'WHTLVLS': ('camera_white_lvls', pa.int64()),
+    'REDBAL': ('camera_red_balance', pa.float64()),
+    'BLUEBAL': ('camera_blue_balance', pa.float64()),
+    'LAT-OBS': ('site_latitude', pa.float64()),
+    'LONG-OBS': ('site_longitude', pa.float64()),
+    'ELEV-OBS': ('site_elevation', pa.float64()),
+}
+
+# Header values that have a unit suffix, e.g. `CAMTEMP = '25 C'`.
+UNIT_SUFFIX_COLUMNS = ['camera_temp', 'camera_circconf']
+
+# The space separated `MEASRGGB` value is split into these columns.
+RGGB_COLUMNS = ['camera_measured_r', 'camera_measured_g1', 'camera_measured_g2', 'camera_measured_b']
+
+METADATA_COLUMNS = {
+    'unit_id': 'unit_id',
+    'sequence_id': 'sequence_id',
+    'image_id': 'image_id',
+    'time': 'time',
+    'ra_mnt': 'mount_ra',
+    'ha_mnt': 'mount_ha',
+    'dec_mnt': 'mount_dec',
+    'ra_image': 'image_ra',
+    'dec_image': 'image_dec',
+    'airmass': 'image_airmass',
+    'moonsep': 'image_moonsep',
+    'moonfrac': 'image_moonfrac',
+    'exptime': 'image_exptime',
+    'camera_iso': 'camera_iso',
+    'camera_temp': 'camera_temp',
+    'camera_circconf': 'camera_circconf',
+    'camera_colortemp': 'camera_colortemp',
+    'camera_lens_serial_number': 'camera_lens_serial_number',
+    'camera_serial_number': 'camera_serial_number',
+    'camera_measured_ev': 'camera_measured_ev',
+    'camera_measured_ev2': 'camera_measured_ev2',
+    'camera_measured_r': 'camera_measured_r',
+    'camera_measured_g1': 'camera_measured_g1',
+    'camera_measured_g2': 'camera_measured_g2',
+    'camera_measured_b': 'camera_measured_b',
+    'camera_white_lvln': 'camera_white_lvln',
+    'camera_white_lvls': 'camera_white_lvls',
+    'camera_red_balance': 'camera_red_balance',
+    'camera_blue_balance': 'camera_blue_balance',
+    'site_latitude': 'site_latitude',
+    'site_longitude': 'site_longitude',
+    'site_elevation': 'site_elevation',
+    'bucket_path': 'bucket_path',
+    'public_url': 'public_url',
+}
+
+
+def image_docs_to_table(image_docs):
+    """Build a typed table from the image documents.
+
+    Args:
+        image_docs (list): The image documents as dicts, including `image_id`.
+
+    Returns:
+        `pyarrow.Table`: The table of image document fields.
+    """
+    return pa.table({
+        col: typed_array([doc.get(col) for doc in image_docs], dtype)
+        for col, dtype in IMAGE_DOC_TYPES.items()
+    })
+
+
+def headers_to_table(headers):
+    """Build a typed table from the FITS headers, using only the `HEADER_COLUMNS` keywords.
+
+    The `MEASRGGB` value is split into separate integer columns and the unit
+    suffix is removed from `CAMTEMP` and `CIRCCONF`, all as vectorized string
+    operations over the whole column.
+
+    Args:
+        headers (list): The FITS headers as dicts.
+
+    Returns:
+        `pyarrow.Table`: The table of header values.
+    """
+    columns = dict()
+    for key, (col, dtype) in HEADER_COLUMNS.items():
+        values = [header.get(key) for header in headers]
+        if col in UNIT_SUFFIX_COLUMNS:
+            value_strings = typed_array(values, pa.string())
+            columns[col] = first_word(value_strings, dtype)
+        elif col == 'camera_measured_rggb':
+            rggb_words = pc.utf8_split_whitespace(typed_array(values, pa.string()))
+            for i, rggb_col in enumerate(RGGB_COLUMNS):
+                columns[rggb_col] = pc.cast(pc.list_element(rggb_words, i), pa.int64())
+        else:
+            columns[col] = typed_array(values, dtype)
+
+    return pa.table(columns)
+
+
+def build_metadata_table(image_docs, headers):
+    """Join the image documents and headers into the observation metadata table.
+
+    The headers are matched to the documents by `image_id` before any columns
+    are built. Images that are missing any value are dropped.
+
+    Args:
+        image_docs (list): The image documents as dicts, including `image_id`.
+        headers (list): The FITS headers as dicts.
+
+    Returns:
+        `pyarrow.Table`: The metadata with the `METADATA_COLUMNS` names.
+    """
+    headers_by_id = {header.get('IMAGEID'): header for header in headers}
+    image_docs = [doc for doc in image_docs if doc.get('image_id') in headers_by_id]
+    headers = [headers_by_id[doc['image_id']] for doc in image_docs]
+
+    docs_table = image_docs_to_table(image_docs)
+    headers_table = headers_to_table(headers)
+
+    columns = dict(zip(docs_table.column_names, docs_table.columns))
+    columns.update(zip(headers_table.column_names, headers_table.columns))
+
+    metadata_table = pa.table({new_col: columns[col] for col, new_col in METADATA_COLUMNS.items()})
+
+    return metadata_table.drop_null()
+
+
+def to_parquet_buffer(table):
+    """Write the table to an in-memory parquet file.
+
+    Args:
+        table (`pyarrow.Table`): The table to write.
+
+    Returns:
+        `io.BytesIO`: The parquet file, positioned at the start.
+    """
+    bio = BytesIO()
+    pq.write_table(table, bio)
+    bio.seek(0)
+
+    return bio
+
+
+def read_parquet_buffer(parquet_bytes):
+    """Read a parquet file from memory.
+
+    Args:
+        parquet_bytes (bytes): The contents of the parquet file.
+
+    Returns:
+        `pyarrow.Table`: The table.
+    """
+    return pq.read_table(pa.BufferReader(parquet_bytes))
+
+
+def append_rows(metadata_table, new_table):
+    """Append new rows to an existing metadata table.
+
+    Args:
+        metadata_table (`pyarrow.Table`): The existing metadata.
+        new_table (`pyarrow.Table`): The metadata for the new images.
+
+    Returns:
+        `pyarrow.Table`: The combined table, sorted by time with a single chunk per column.
+
+    Raises:
+        ValueError: If the tables do not have the same schema, e.g. for an older file.
+    """
+    if not metadata_table.schema.equals(new_table.schema):
+        raise ValueError(f'Metadata schema does not match: {metadata_table.schema}')
+
+    combined_table = pa.concat_tables([metadata_table, new_table]).combine_chunks()
+
+    return combined_table.sort_by('time')
+
+
+def typed_array(values, dtype):
+    """Make an array of the given type, parsing any string values.
+
+    Args:
+        values (list): The values, which may include None.
+        dtype (`pyarrow.DataType`): The type of the array.
+
+    Returns:
+        `pyarrow.Array`: The typed array.
+    """
+    try:
+        return pa.array(values, type=dtype)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError):
+        value_strings = pa.array([None if v is None else str(v).strip() for v in values],
+                                 type=pa.string())
+        return pc.cast(value_strings, dtype)
+
+
+def first_word(value_strings, dtype):
+    """Cast the first word of each string, e.g. to remove a unit suffix."""
+    return pc.cast(pc.list_element(pc.utf8_split_whitespace(value_strings), 0), dtype)
@@ -0,0 +1,129 @@
+"""Throughput and queue depth metrics for the subscriber.
+
+The metrics are printed as a single json line every `interval` seconds so
+they can be turned into log-based metrics, e.g. to size the instances.
+
+`CountingThreadPoolExecutor` counts the tasks waiting for a thread, to report
+the depth of the worker queue.
+"""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SubscriberMetrics(object):
+    """Count the messages received and finished and the time taken for each.
+
+    Args:
+        interval (float): Seconds between reports.
+        queue_depths (dict|None): Functions that return the current depth of a
+            queue, keyed by the name used in the report.
+    """
+
+    def __init__(self, interval=60., queue_depths=None):
+        self.interval = interval
+        self.queue_depths = queue_depths or dict()
+
+        self.num_received = 0
+        self.num_acked = 0
+        self.num_nacked = 0
+
+        self._received_times = dict()
+        self._durations = list()
+        self._lock = threading.Lock()
+
+    @property
+    def in_flight(self):
+        """int: The number of messages received but not finished."""
+        with self._lock:
+            return len(self._received_times)
+
+    def message_received(self, message):
+        with self._lock:
+            self.num_received += 1
+            self._received_times[message.message_id] = time.monotonic()
+
+    def message_finished(self, message, success=True):
+        with self._lock:
+            if success:
+                self.num_acked += 1
+            else:
+                self.num_nacked += 1
+
+            received_time = self._received_times.pop(message.message_id, None)
+            if received_time is not None:
+                self._durations.append(time.monotonic() - received_time)
+
+    def report(self, elapsed_seconds):
+        """Get the metrics since the last report and reset the counters.
+
+        Args:
+            elapsed_seconds (float): The time since the last report.
+
+        Returns:
+            dict: The metrics.
+        """
+        with self._lock:
+            num_finished = self.num_acked + self.num_nacked
+            durations = sorted(self._durations)
+            metrics = dict(
+                received=self.num_received,
+                acked=self.num_acked,
+                nacked=self.num_nacked,
+                messages_per_minute=round(num_finished / elapsed_seconds * 60, 2),
+                in_flight=len(self._received_times),
+                median_seconds=round(durations[len(durations) // 2], 3) if durations else None,
+                max_seconds=round(durations[-1], 3) if durations else None,
+            )
+
+            self.num_received = 0
+            self.num_acked = 0
+            self.num_nacked = 0
+            self._durations = list()
+
+        for name, queue_depth in self.queue_depths.items():
+            metrics[f'{name}_queue_depth'] = queue_depth()
+
+        return metrics
+
+    def start(self):
+        """Print the metrics every `interval` seconds in a background thread."""
+        def run():
+            last_time = time.monotonic()
+            while True:
+                time.sleep(self.interval)
+                now = time.monotonic()
+                print(json.dumps(dict(subscriber_metrics=self.report(now - last_time))))
+                last_time = now
+
+        threading.Thread(target=run, name='subscriber-metrics', daemon=True).start()
+
+
+class CountingThreadPoolExecutor(ThreadPoolExecutor):
+    """A thread pool that counts the tasks submitted but not yet started."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._num_waiting = 0
+        self._count_lock = threading.Lock()
+
+    def queue_depth(self):
+        """int: The number of tasks waiting for a thread."""
+        with self._count_lock:
+            return self._num_waiting
+
+    def submit(self, fn, *args, **kwargs):
+        def run():
+            with self._count_lock:
+                self._num_waiting -= 1
+            return fn(*args, **kwargs)
+
+        with self._count_lock:
+            self._num_waiting += 1
+        try:
+            return super().submit(run)
+        except Exception:
+            with self._count_lock:
+                self._num_waiting -= 1
+            raise
@@ -0,0 +1,294 @@
+"""Project catalog stars onto the image pixels.
+
+`wcs.all_world2pix` inverts the SIP distortion iteratively for every star,
+which is the slow part for a dense field. Instead the stars are:
+
+    1. Cut on the RA/Dec bounds of the footprint, which is cheap.
+    2. Projected with the linear part of the WCS, done directly with numpy for
+       the usual gnomonic (TAN) projection and with `wcs_world2pix` otherwise.
+    3. Corrected for the distortion by interpolating a grid of offsets that is
+       computed once per WCS with `all_world2pix`. The grid is checked against
+       the exact projection at the center of each cell when it is made and if
+       it is not accurate enough the exact projection is used for all stars
+       instead.
+    4. Clipped to the detector, dropping stars within `EDGE_PIXELS` of the edge.
+
+The cuts are made on arrays of row numbers so the rows of the catalog are only
+taken once.
+"""
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+# Stars closer than this to the edge of the image are dropped.
+EDGE_PIXELS = int(os.getenv('EDGE_PIXELS', 10))
+
+# Spacing of the distortion grid in pixels and the largest error allowed for it.
+GRID_STEP = int(os.getenv('DISTORTION_GRID_STEP', 64))
+MAX_GRID_ERROR = float(os.getenv('DISTORTION_GRID_MAX_ERROR', 0.05))
+
+# The distortion grids of the most recent WCS, see `distortion_grid`.
+MAX_CACHED_GRIDS = 16
+distortion_grids = OrderedDict()
+
+# Number of points per side used for the RA/Dec bounds of the footprint.
+NUM_EDGE_SAMPLES = 20
+
+
+def project_sources(wcs, catalog_sources, edge=EDGE_PIXELS, origin=1):
+    """Add the pixel positions and the Vmag bin for the stars on the image.
+
+    Args:
+        wcs (`astropy.wcs.WCS`): The WCS, with a `pixel_shape`.
+        catalog_sources (`pandas.DataFrame`): The stars, with at least the
+            `catalog_ra`, `catalog_dec` and `catalog_vmag` columns.
+        edge (int): Stars within this many pixels of the edge are dropped.
+        origin (int): The pixel origin of the `x` and `y` columns, default 1 as
+            for FITS.
+
+    Returns:
+        tuple(`pandas.DataFrame`, dict): The stars on the image with `x`, `y`,
+            `x_int`, `y_int` and `catalog_vmag_bin` columns, and info about the
+            projection, i.e. the number of stars after each cut and the method.
+    """
+    width, height = wcs.pixel_shape
+    num_catalog = len(catalog_sources)
+
+    # The cuts are made on the row numbers and the rows are only taken once at the end.
+    ra = catalog_sources.catalog_ra.values
+    dec = catalog_sources.catalog_dec.values
+    rows = np.flatnonzero(radec_precut(wcs, ra, dec))
+    num_in_bounds = len(rows)
+    ra = ra[rows]
+    dec = dec[rows]
+
+    # Stars more than one grid step off the image can not be moved onto it by the
+    # distortion, which is only a few pixels.
+    x, y = linear_world2pix(wcs, ra, dec)
+    near_chip = ((x >= -GRID_STEP) & (x < width + GRID_STEP) &
+                 (y >= -GRID_STEP) & (y < height + GRID_STEP))
+    rows = rows[near_chip]
+    num_near_chip = len(rows)
+    x, y, method, grid_error = correct_distortion(wcs, ra[near_chip], dec[near_chip],
+                                                  x[near_chip], y[near_chip])
+
+    on_chip = (x >= edge) & (x < width - edge) & (y >= edge) & (y < height - edge)
+    catalog_sources = catalog_sources.iloc[rows[on_chip]].reset_index(drop=True)
+    x = x[on_chip] + origin
+    y = y[on_chip] + origin
+
+    catalog_sources['x'] = x
+    catalog_sources['y'] = y
+    catalog_sources['x_int'] = x.astype(int)
+    catalog_sources['y_int'] = y.astype(int)
+    catalog_sources['catalog_vmag_bin'] = np.floor(catalog_sources.catalog_vmag.values).astype(int)
+
+    projection_info = dict(
+        num_catalog=num_catalog,
+        num_in_bounds=num_in_bounds,
+        num_near_chip=num_near_chip,
+        num_on_chip=len(catalog_sources),
+        method=method,
+        grid_error=grid_error,
+    )
+
+    return catalog_sources, projection_info
+
+
+def linear_world2pix(wcs, ra, dec):
+    """The zero-based pixel positions from the linear part of the WCS."""
+    if is_gnomonic(wcs):
+        return gnomonic_world2pix(wcs, ra, dec)
+
+    return wcs.wcs_world2pix(ra, dec, 0)
+
+
+def correct_distortion(wcs, ra, dec, x, y):
+    """Apply the SIP distortion to the linear pixel positions, using the grid if accurate enough.
+
+    Returns:
+        tuple: The `x` and `y` arrays, the method used and the largest error of the
+            grid (None if there is no distortion).
+    """
+    if wcs.sip is None or len(ra) == 0:
+        return x, y, 'linear', None
+
+    coefficients, grid_error = distortion_grid(wcs)
+    if grid_error > MAX_GRID_ERROR:
+        x, y = wcs.all_world2pix(ra, dec, 0)
+        return x, y, 'exact', round(grid_error, 4)
+
+    x, y = interpolate_grid(coefficients, x, y)
+    return x, y, 'grid', round(grid_error, 4)
+
+
+def distortion_grid(wcs, step=GRID_STEP):
+    """The bilinear coefficients for the distortion in each cell of a grid, made once per WCS.
+
+    The grid is over the linear (undistorted) pixel positions, covering the image
+    plus one step on each side, with the offsets to the distorted positions found
+    with `all_world2pix` at the grid points. The grid is checked against
+    `all_world2pix` at the center of each cell, where the interpolation is least
+    accurate. The grids for the last `MAX_CACHED_GRIDS` WCS are kept.
+
+    Returns:
+        tuple(`numpy.ndarray`, float): The coefficients with shape
+            `(num_y - 1, num_x - 1, 8)`, see `interpolate_grid`, and the largest
+            error of the grid in pixels.
+    """
+    key = (wcs_key(wcs), step)
+    try:
+        distortion_grids.move_to_end(key)
+        return distortion_grids[key]
+    except KeyError:
+        pass
+
+    width, height = wcs.pixel_shape
+    grid_x = np.arange(-step, width + 2 * step, step, dtype=float)
+    grid_y = np.arange(-step, height + 2 * step, step, dtype=float)
+    dx, dy = distortion_offsets(wcs, *np.meshgrid(grid_x, grid_y))
+
+    # For each cell the value is `c0 + c1 * fx + c2 * fy + c3 * fx * fy` for dx and the same for dy.
+    coefficients = np.stack([coefficient
+                             for offsets in (dx, dy)
+                             for coefficient in (offsets[:-1, :-1],
+                                                 offsets[:-1, 1:] - offsets[:-1, :-1],
+                                                 offsets[1:, :-1] - offsets[:-1, :-1],
+                                                 offsets[1:, 1:] - offsets[:-1, 1:] - offsets[1:, :-1] + offsets[:-1, :-1])],
+                            axis=-1)
+
+    center_x, center_y = np.meshgrid(grid_x[:-1] + step / 2, grid_y[:-1] + step / 2)
+    exact_dx, exact_dy = distortion_offsets(wcs, center_x, center_y)
+    fast_x, fast_y = interpolate_grid(coefficients, center_x.ravel(), center_y.ravel(), step=step)
+    grid_error = float(np.max(np.hypot(fast_x - center_x.ravel() - exact_dx.ravel(),
+                                       fast_y - center_y.ravel() - exact_dy.ravel())))
+
+    distortion_grids[key] = (coefficients, grid_error)
+    while len(distortion_grids) > MAX_CACHED_GRIDS:
+        distortion_grids.popitem(last=False)
+
+    return coefficients, grid_error
+
+
+def distortion_offsets(wcs, x, y):
+    """The offsets from the linear pixel positions to the distorted ones."""
+    ra, dec = wcs.wcs_pix2world(x.ravel(), y.ravel(), 0)
+    x_exact, y_exact = wcs.all_world2pix(ra, dec, 0)
+
+    return (x_exact.reshape(x.shape) - x), (y_exact.reshape(y.shape) - y)
+
+
+def interpolate_grid(coefficients, x, y, step=GRID_STEP):
+    """Apply the `distortion_grid` offsets to the pixel positions with bilinear interpolation."""
+    num_y, num_x, _ = coefficients.shape
+    gx = np.clip((x + step) / step, 0, num_x - 1e-6)
+    gy = np.clip((y + step) / step, 0, num_y - 1e-6)
+    ix = gx.astype(int)
+    iy = gy.astype(int)
+    fx = gx - ix
+    fy = gy - iy
+    fxy = fx * fy
+
+    # One lookup of all the coefficients of the cell for each position.
+    c = coefficients.reshape(-1, 8)[iy * num_x + ix]
+
+    x_out = x + c[:, 0] + c[:, 1] * fx + c[:, 2] * fy + c[:, 3] * fxy
+    y_out = y + c[:, 4] + c[:, 5] * fx + c[:, 6] * fy + c[:, 7] * fxy
+
+    return x_out, y_out
+
+
+def wcs_key(wcs):
+    """A key for the parts of the WCS used for the projection."""
+    sip_arrays = [] if wcs.sip is None else [wcs.sip.a, wcs.sip.b]
+    return (tuple(wcs.wcs.ctype),
+            tuple(wcs.wcs.crval),
+            tuple(wcs.wcs.crpix),
+            wcs.pixel_scale_matrix.tobytes(),
+            tuple(wcs.pixel_shape),
+            *[np.asarray(array).tobytes() for array in sip_arrays])
+
+
+def is_gnomonic(wcs):
+    """If the WCS is a plain RA/Dec gnomonic (TAN) projection with the default pole."""
+    ctype = list(wcs.wcs.ctype)
+    return (ctype[0].startswith('RA---TAN') and
+            ctype[1].startswith('DEC--TAN') and
+            wcs.wcs.lonpole == 180)
+
+
+def gnomonic_world2pix(wcs, ra, dec):
+    """The zero-based pixel positions from the linear part of a TAN WCS.
+
+    Gives the same result as `wcs.wcs_world2pix(ra, dec, 0)` for the projections
+    accepted by `is_gnomonic`, without the general spherical rotation.
+    """
+    ra0, dec0 = np.radians(wcs.wcs.crval)
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+
+    cos_dec = np.cos(dec)
+    sin_dec = np.sin(dec)
+    cos_dra = np.cos(ra - ra0)
+    cos_c = np.sin(dec0) * sin_dec + np.cos(dec0) * cos_dec * cos_dra
+
+    # Intermediate world coordinates in degrees, points behind the tangent plane are NaN.
+    with np.errstate(divide='ignore', invalid='ignore'):
+        xi = np.where(cos_c > 0, np.degrees(cos_dec * np.sin(ra - ra0) / cos_c), np.nan)
+        eta = np.where(cos_c > 0,
+                       np.degrees((np.cos(dec0) * sin_dec - np.sin(dec0) * cos_dec * cos_dra) / cos_c),
+                       np.nan)
+
+    inv_matrix = np.linalg.inv(wcs.pixel_scale_matrix)
+    x = inv_matrix[0, 0] * xi + inv_matrix[0, 1] * eta + wcs.wcs.crpix[0] - 1
+    y = inv_matrix[1, 0] * xi + inv_matrix[1, 1] * eta + wcs.wcs.crpix[1] - 1
+
+    return x, y
+
+
+def radec_precut(wcs, ra, dec, margin=0.1):
+    """Mask for the stars inside the RA/Dec bounds of the image plus a margin in degrees.
+
+    The bounds are from points along the border of the image. A pole just off
+    the image is close to the border point nearest to it, which has the most
+    extreme declination on the image and could be between the samples, so
+    that point is always included.
+    """
+    width, height = wcs.pixel_shape
+    pole_x, pole_y = wcs.wcs_world2pix([0, 0], [90, -90], 0)
+    pole_on_image = (pole_x >= 0) & (pole_x < width) & (pole_y >= 0) & (pole_y < height)
+
+    # The border points nearest to the poles that are on the projection.
+    near_pole = np.isfinite(pole_x) & np.isfinite(pole_y)
+    nearest_x = np.clip(pole_x[near_pole], 0, width - 1)
+    nearest_y = np.clip(pole_y[near_pole], 0, height - 1)
+
+    edge_x = np.linspace(0, width - 1, NUM_EDGE_SAMPLES)
+    edge_y = np.linspace(0, height - 1, NUM_EDGE_SAMPLES)
+    border_x = np.concatenate([edge_x, edge_x, np.zeros_like(edge_y), np.full_like(edge_y, width - 1), nearest_x])
+    border_y = np.concatenate([np.zeros_like(edge_x), np.full_like(edge_x, height - 1), edge_y, edge_y, nearest_y])
+    border_ra, border_dec = wcs.all_pix2world(border_x, border_y, 0)
+
+    dec_min = border_dec.min() - margin
+    dec_max = border_dec.max() + margin
+
+    # If the image includes a pole the stars around it are all in the image, so
+    # only the declination bound is used.
+    if pole_on_image[0]:
+        return dec >= dec_min
+    if pole_on_image[1]:
+        return dec <= dec_max
+
+    in_bounds = (dec >= dec_min) & (dec <= dec_max)
+    if dec_max >= 90 or dec_min <= -90:
+        return in_bounds
+
+    center_ra, _ = wcs.all_pix2world([(width - 1) / 2], [(height - 1) / 2], 0)
+    border_dra = (border_ra - center_ra[0] + 180) % 360 - 180
+    ra_margin = margin / np.cos(np.radians(max(abs(dec_min), abs(dec_max))))
+    dra = (ra - center_ra[0] + 180) % 360 - 180
+    in_bounds &= (dra >= border_dra.min() - ra_margin) & (dra <= border_dra.max() + ra_margin)
+
+    return in_bounds
+
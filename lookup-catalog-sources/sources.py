@@ -0,0 +1,58 @@
+"""Build the `-sources.parquet` file for an observation.
+
+This is the CPU-bound part of the catalog lookup, so it only depends on the
+WCS and the catalog stars and can run in a separate process.
+"""
+from io import BytesIO
+
+import pendulum
+
+import projection
+
+SOURCE_COLUMNS = [
+    'picid',
+    'time',
+    'sequence_id',
+    'catalog_ra',
+    'catalog_dec',
+    'catalog_vmag',
+    'catalog_vmag_err',
+    'catalog_vmag_bin',
+    'x',
+    'y',
+    'x_int',
+    'y_int',
+    'twomass',
+    'gaia',
+    'unit_id',
+]
+
+
+def make_sources_parquet(wcs, catalog_sources, sequence_id):
+    """Project the catalog stars onto the image and write them to parquet.
+
+    Args:
+        wcs (`astropy.wcs.WCS`): The WCS of the observation.
+        catalog_sources (`pandas.DataFrame`): The catalog stars in the footprint.
+        sequence_id (str): The sequence_id of the observation.
+
+    Returns:
+        tuple(bytes, dict): The parquet file and info about the projection.
+    """
+    # Get the XY positions via the WCS, keeping only the stars on the image.
+    catalog_sources, projection_info = projection.project_sources(wcs, catalog_sources)
+
+    # Get additional metadata.
+    unit_id, camera_id, observation_time = sequence_id.split('_')
+    catalog_sources['unit_id'] = unit_id
+    catalog_sources['sequence_id'] = sequence_id
+    catalog_sources['camera_id'] = camera_id
+    catalog_sources['time'] = pendulum.parse(observation_time).replace(tzinfo=None)
+
+    # Get just the columns we want.
+    catalog_sources = catalog_sources[SOURCE_COLUMNS]
+
+    bio = BytesIO()
+    catalog_sources.convert_dtypes().dropna().to_parquet(bio, index=False)
+
+    return bio.getvalue(), projection_info
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from astropy.wcs import WCS
+
+import projection
+
+# A PANOPTES camera: 5208 x 3476 pixels at about 10.3 arcsec per pixel.
+IMAGE_SHAPE = (5208, 3476)
+PIXEL_SCALE = 10.3 / 3600
+
+
+def make_wcs(dec, angle):
+    """A TAN WCS centered on `dec` and rotated by `angle` degrees."""
+    wcs = WCS(naxis=2)
+    wcs.wcs.ctype = ['RA---TAN', 'DEC--TAN']
+    wcs.wcs.crval = [120., dec]
+    wcs.wcs.crpix = [IMAGE_SHAPE[0] / 2, IMAGE_SHAPE[1] / 2]
+    cos, sin = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    wcs.wcs.cd = np.array([[-PIXEL_SCALE, 0], [0, PIXEL_SCALE]]) @ np.array([[cos, -sin], [sin, cos]])
+    wcs.pixel_shape = IMAGE_SHAPE
+
+    return wcs
+
+
+# The pole just off the top, bottom, right and left edges of the image.
+@pytest.mark.parametrize('dec,angle', [
+    (85, 0),
+    (-85, 0),
+    (85, 180),
+    (-85, 180),
+    (82.5, 90),
+    (-82.5, 90),
+    (82.5, 270),
+    (-82.5, 270),
+])
+def test_radec_precut_pole_off_edge(dec, angle):
+    wcs = make_wcs(dec, angle)
+    width, height = wcs.pixel_shape
+
+    pole_x, pole_y = wcs.wcs_world2pix([0], [np.sign(dec) * 90], 0)
+    assert not (0 <= pole_x[0] < width and 0 <= pole_y[0] < height)
+
+    rng = np.random.default_rng(42)
+    x = rng.uniform(0, width - 1, 100000)
+    y = rng.uniform(0, height - 1, 100000)
+    ra, dec = wcs.all_pix2world(x, y, 0)
+
+    assert projection.radec_precut(wcs, ra, dec).all()
@@ -0,0 +1,170 @@
+"""Plate-solve images with astrometry.net.
+
+`solve-field` is run directly with explicit options. When the approximate
+pointing is known, e.g. from the previous image in the sequence or the mount
+coordinates in the header, the index search is limited to `HINT_RADIUS`
+degrees around it and to the expected pixel scale, which is much faster than
+a blind solve. If the hinted solve fails a blind solve is tried.
+
+Each attempt is printed as a json line so the success rate and solve time
+with and without hints can be turned into log-based metrics.
+"""
+import json
+import os
+import re
+import subprocess
+import time
+from contextlib import suppress
+
+from astropy.io import fits
+from astropy.wcs import WCS
+
+SOLVE_FIELD = os.getenv('SOLVE_FIELD', 'solve-field')
+
+# Search radius in degrees around the hinted position.
+HINT_RADIUS = float(os.getenv('SOLVE_HINT_RADIUS', 2.))
+
+# Bounds on the pixel scale in arcsec per pixel used with a hint.
+PIXEL_SCALE_LOW = float(os.getenv('PIXEL_SCALE_LOW', 9.5))
+PIXEL_SCALE_HIGH = float(os.getenv('PIXEL_SCALE_HIGH', 11.))
+
+# CPU seconds allowed for each solve.
+SOLVE_TIMEOUT = int(os.getenv('SOLVE_TIMEOUT', 60))
+
+# Options for every solve, only the WCS file is written.
+BASE_OPTIONS = [
+    '--no-plots',
+    '--overwrite',
+    '--no-verify',
+    '--crpix-center',
+    '--downsample', '4',
+    '--temp-axy',
+    '--index-xyls', 'none',
+    '--solved', 'none',
+    '--match', 'none',
+    '--rdls', 'none',
+    '--corr', 'none',
+    '--new-fits', 'none',
+]
+
+
+# Cards in the WCS file that are not copied to the image header.
+SKIP_WCS_KEYWORDS = {'SIMPLE', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'EXTEND', 'COMMENT', 'HISTORY', ''}
+
+# Cards of an existing WCS in the image header, including the SIP distortion.
+WCS_KEYWORD_PATTERN = re.compile(r'^(WCSAXES|CTYPE\d|CUNIT\d|CRVAL\d|CRPIX\d|CDELT\d|CROTA\d|CD\d_\d|PC\d_\d|'
+                                 r'LONPOLE|LATPOLE|EQUINOX|RADESYS|A_\w+|B_\w+|AP_\w+|BP_\w+)$')
+
+
+def mount_hint(header):
+    """The hint from the mount coordinates in the header, or None if not present."""
+    try:
+        return dict(ra=float(header['RA-MNT']), dec=float(header['DEC-MNT']), source='mount')
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def solve_options(hint=None, timeout=SOLVE_TIMEOUT):
+    """The `solve-field` options for a hinted solve, or a blind solve if no hint.
+
+    Args:
+        hint (dict|None): The `ra` and `dec` in degrees, with an optional `radius`.
+        timeout (int): CPU seconds for the solve.
+
+    Returns:
+        list: The options.
+    """
+    options = BASE_OPTIONS + ['--cpulimit', str(timeout)]
+    if hint is None:
+        return options + ['--guess-scale']
+
+    return options + [
+        '--ra', f'{hint["ra"]:.6f}',
+        '--dec', f'{hint["dec"]:.6f}',
+        '--radius', f'{hint.get("radius", HINT_RADIUS):.3f}',
+        '--scale-units', 'arcsecperpix',
+        '--scale-low', f'{PIXEL_SCALE_LOW:.3f}',
+        '--scale-high', f'{PIXEL_SCALE_HIGH:.3f}',
+    ]
+
+
+def run_solve_field(fits_path, wcs_path, options, timeout=SOLVE_TIMEOUT):
+    """Run `solve-field` on the file, writing any other files next to it.
+
+    Returns:
+        `astropy.io.fits.Header`|None: The WCS header, or None if not solved.
+    """
+    with suppress(FileNotFoundError):
+        os.remove(wcs_path)
+
+    try:
+        subprocess.run([SOLVE_FIELD, *options, '--dir', os.path.dirname(fits_path), '--wcs', wcs_path, fits_path],
+                       stdout=subprocess.PIPE,
+                       stderr=subprocess.STDOUT,
+                       check=True,
+                       timeout=timeout + 30)
+    except subprocess.TimeoutExpired:
+        print(f'solve-field timed out for {fits_path}')
+        return None
+    except subprocess.CalledProcessError as e:
+        print(f'solve-field failed for {fits_path}: {e.output}')
+        return None
+
+    if not os.path.exists(wcs_path):
+        return None
+
+    wcs_header = fits.getheader(wcs_path)
+    if not WCS(wcs_header).is_celestial:
+        return None
+
+    return wcs_header
+
+
+def solve(fits_path, hint=None, timeout=SOLVE_TIMEOUT):
+    """Plate-solve the file, with the hint if given and blind otherwise or if that fails.
+
+    Args:
+        fits_path (str): The uncompressed FITS file.
+        hint (dict|None): The `ra`, `dec` and `source` of the hint, see `solve_options`.
+        timeout (int): CPU seconds for each solve.
+
+    Returns:
+        tuple(`astropy.io.fits.Header`|None, dict): The WCS header, or None if
+            not solved, and the method, hint source and seconds for the solve.
+    """
+    wcs_path = os.path.splitext(fits_path)[0] + '.wcs'
+
+    attempts = [hint, None] if hint is not None else [None]
+    solve_info = dict(method=None, hint_source=None if hint is None else hint.get('source'), seconds=0.)
+    wcs_header = None
+    for attempt_hint in attempts:
+        method = 'blind' if attempt_hint is None else 'hinted'
+
+        t0 = time.time()
+        wcs_header = run_solve_field(fits_path, wcs_path, solve_options(attempt_hint, timeout), timeout)
+        seconds = time.time() - t0
+        solve_info['seconds'] += seconds
+
+        print(json.dumps(dict(astrometry=dict(method=method,
+                                              hint_source=None if attempt_hint is None else attempt_hint.get('source'),
+                                              success=wcs_header is not None,
+                                              seconds=round(seconds, 3)))))
+        if wcs_header is not None:
+            solve_info['method'] = method
+            break
+
+    solve_info['seconds'] = round(solve_info['seconds'], 3)
+    return wcs_header, solve_info
+
+
+def add_wcs(header, wcs_header):
+    """Replace any WCS in the image header with the one written by `solve-field`, in place."""
+    for keyword in list(header.keys()):
+        if WCS_KEYWORD_PATTERN.match(keyword):
+            del header[keyword]
+
+    for card in wcs_header.cards:
+        if card.keyword not in SKIP_WCS_KEYWORDS:
+            header[card.keyword] = (card.value, card.comment)
+
+    return header
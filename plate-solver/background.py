@@ -0,0 +1,131 @@
+"""Background subtraction for the bayer images.
+
+Each color is a strided view of the image, e.g. `data[1::2, 0::2]` for red, so
+the backgrounds are found on the views directly rather than on full size
+masked arrays. For each color:
+
+    1. The view is split into boxes of `box_size` image pixels and the pixels
+       in each box are sigma clipped, giving the mean and standard deviation
+       of the background for the box.
+    2. The box values are median filtered with `filter_size` boxes.
+    3. The box values are interpolated to every pixel of the view and
+       subtracted in place from a float32 copy of the image.
+
+The image is only read once and, apart from the subtracted copy, only arrays
+the size of one color are made.
+"""
+import numpy as np
+
+# The (row, column) offsets of each color in a 2x2 bayer cell, with green at two.
+BAYER_OFFSETS = {
+    'r': [(1, 0)],
+    'g': [(0, 0), (1, 1)],
+    'b': [(0, 1)],
+}
+
+
+def subtract_background(data, camera_bias=0., box_size=(84, 84), filter_size=3, sigma=5., iters=5, **kwargs):
+    """Subtract the background of each color.
+
+    The backgrounds are found after removing the `camera_bias`, which is left in
+    the subtracted image.
+
+    Args:
+        data (`numpy.ndarray`): The bayer image.
+        camera_bias (float): The bias level of the camera.
+        box_size (tuple): The `(height, width)` of the boxes in image pixels.
+        filter_size (int): The size of the median filter in boxes.
+        sigma (float): The clipping limit in standard deviations.
+        iters (int): The largest number of clipping iterations.
+        **kwargs: Ignored, e.g. the `percentiles` of the background config.
+
+    Returns:
+        tuple(`numpy.ndarray`, dict): The float32 subtracted image and the
+            `(background, rms)` for each color, with one pixel per bayer cell.
+    """
+    subtracted = data.astype(np.float32)
+    # Boxes are in the pixels of each color.
+    color_box = (max(box_size[0] // 2, 1), max(box_size[1] // 2, 1))
+
+    backgrounds = dict()
+    for color, offsets in BAYER_OFFSETS.items():
+        views = [subtracted[row::2, col::2] for row, col in offsets]
+        back_mesh, rms_mesh = box_stats(views, color_box, sigma=sigma, iters=iters)
+        back_mesh = median_filter(back_mesh, filter_size) - camera_bias
+        rms_mesh = median_filter(rms_mesh, filter_size)
+
+        view_shape = views[0].shape
+        background = interpolate_mesh(back_mesh, color_box, view_shape)
+        for view in views:
+            view -= background[:view.shape[0], :view.shape[1]]
+
+        backgrounds[color] = (background, interpolate_mesh(rms_mesh, color_box, view_shape))
+
+    return subtracted, backgrounds
+
+
+def box_stats(views, box, sigma=5., iters=5):
+    """The sigma clipped mean and standard deviation in each box of the views.
+
+    The pixels of all the views, e.g. both greens, are used together. Pixels
+    after the last full box are not used.
+
+    Returns:
+        tuple(`numpy.ndarray`): The mean and standard deviation with one value per box.
+    """
+    box_height, box_width = box
+    num_y = min(view.shape[0] for view in views) // box_height
+    num_x = min(view.shape[1] for view in views) // box_width
+
+    samples = np.concatenate([
+        view[:num_y * box_height, :num_x * box_width]
+            .reshape(num_y, box_height, num_x, box_width)
+            .transpose(0, 2, 1, 3)
+            .reshape(num_y, num_x, box_height * box_width)
+        for view in views
+    ], axis=2)
+
+    for _ in range(iters):
+        mean = np.nanmean(samples, axis=2, keepdims=True)
+        std = np.nanstd(samples, axis=2, keepdims=True)
+        clipped = np.abs(samples - mean) > sigma * std
+        if not clipped.any():
+            break
+        samples[clipped] = np.nan
+
+    return np.nanmean(samples, axis=2), np.nanstd(samples, axis=2)
+
+
+def median_filter(mesh, size):
+    """Median filter the box values, with the edges repeated."""
+    if size <= 1:
+        return mesh
+
+    half = size // 2
+    padded = np.pad(mesh, half, mode='edge')
+    windows = np.lib.stride_tricks.sliding_window_view(padded, (size, size))
+    return np.median(windows, axis=(2, 3))
+
+
+def interpolate_mesh(mesh, box, shape):
+    """Bilinear interpolation of the box values, given at the box centers, to every pixel.
+
+    Returns:
+        `numpy.ndarray`: The float32 values with the `shape`.
+    """
+    def axis_weights(num_pixels, box_length, num_boxes):
+        position = (np.arange(num_pixels, dtype=np.float32) + 0.5) / box_length - 0.5
+        position = np.clip(position, 0, num_boxes - 1)
+        lower = np.minimum(position.astype(int), max(num_boxes - 2, 0))
+        upper = np.minimum(lower + 1, num_boxes - 1)
+        return lower, upper, (position - lower).astype(np.float32)
+
+    y_lower, y_upper, y_frac = axis_weights(shape[0], box[0], mesh.shape[0])
+    x_lower, x_upper, x_frac = axis_weights(shape[1], box[1], mesh.shape[1])
+
+    mesh = mesh.astype(np.float32)
+    rows = mesh[:, x_lower] * (1 - x_frac) + mesh[:, x_upper] * x_frac
+
+    values = rows[y_lower] * (1 - y_frac)[:, None]
+    values += rows[y_upper] * y_frac[:, None]
+    return values
@@ -1,7 +1,5 @@
 import os
-import subprocess
 import sys
-import time
 from contextlib import suppress
 
 from google.cloud import exceptions
@@ -11,12 +9,41 @@ from google.cloud import pubsub_v1
 from google.cloud import storage
 from panoptes.utils import image_id_from_path
 
+import pipeline
+import solver
+import workers
+
 PROJECT_ID = os.getenv('PROJECT_ID', 'panoptes-exp')
 PUBSUB_SUBSCRIPTION = 'plate-solve-read'
-MAX_MESSAGES = os.getenv('MAX_MESSAGES', 1)
 INCOMING_BUCKET = os.getenv('INCOMING_BUCKET', 'panoptes-incoming')
 ERROR_BUCKET = os.getenv('ERROR_BUCKET', 'panoptes-error-images')
 
+# Worker threads for the download and upload stages and the number of images
+# that can wait for each stage.
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', 2))
+UPLOAD_WORKERS = int(os.getenv('UPLOAD_WORKERS', 2))
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', 1))
+PIPELINE_STATS_INTERVAL = float(os.getenv('PIPELINE_STATS_INTERVAL', 60))
+
+# Worker processes for the background and solve stages. By default one per CPU
+# as long as there is `SOLVE_MEMORY_MB` for each after `RESERVED_MEMORY_MB`.
+SOLVE_MEMORY_MB = int(os.getenv('SOLVE_MEMORY_MB', 1536))
+RESERVED_MEMORY_MB = int(os.getenv('RESERVED_MEMORY_MB', 512))
+SOLVE_WORKERS = int(os.getenv('SOLVE_WORKERS', 0)) or workers.default_num_workers(SOLVE_MEMORY_MB * 2**20,
+                                                                                 RESERVED_MEMORY_MB * 2**20)
+
+# Images received but waiting to be downloaded. Once full, images from the
+# sequence with the most waiting are nacked so another instance can take them.
+BACKLOG_SIZE = int(os.getenv('BACKLOG_SIZE', 2 * SOLVE_WORKERS))
+
+# By default enough messages to keep every stage of the pipeline busy plus the backlog.
+MAX_MESSAGES = int(os.getenv('MAX_MESSAGES', DOWNLOAD_WORKERS + SOLVE_WORKERS + UPLOAD_WORKERS +
+                             2 * PIPELINE_QUEUE_SIZE + BACKLOG_SIZE))
+
+# The subscriber extends the lease of the received messages until they are
+# acked or nacked, up to this many seconds.
+MAX_LEASE_SECONDS = int(os.getenv('MAX_LEASE_SECONDS', 1800))
+
 # Storage
 try:
     firestore_db = firestore.Client()
@@ -30,13 +57,38 @@ except RuntimeError:
     print(f"Can't load Google credentials, exiting")
     sys.exit(1)
 
+solve_pipeline = None
+solver_pool = None
+
 
 def main():
-    print(f'Creating subscriber (messages={MAX_MESSAGES}) for {subscription_path}')
+    global solve_pipeline
+    global solver_pool
+
+    solver_pool = workers.SolverPool(num_workers=SOLVE_WORKERS)
+    print(f'Started {SOLVE_WORKERS} solver workers in {solver_pool.wait_ready():.1f} sec')
+
+    backlog = pipeline.FairQueue(BACKLOG_SIZE, key=lambda job: job.sequence_id, on_shed=shed_job)
+    solve_pipeline = pipeline.Pipeline(
+        [
+            ('download', solver.download_stage, DOWNLOAD_WORKERS),
+            ('process', process_stage, SOLVE_WORKERS),
+            ('upload', solver.upload_stage, UPLOAD_WORKERS),
+        ],
+        on_done=finish_job,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        interval=PIPELINE_STATS_INTERVAL,
+        input_queue=backlog
+    )
+    solve_pipeline.start()
+
+    print(f'Creating subscriber (messages={MAX_MESSAGES}, lease={MAX_LEASE_SECONDS} sec) '
+          f'for {subscription_path}')
     streaming_pull_future = subscriber.subscribe(
         subscription_path,
         callback=process_message,
-        flow_control=pubsub_v1.types.FlowControl(max_messages=int(MAX_MESSAGES))
+        flow_control=pubsub_v1.types.FlowControl(max_messages=MAX_MESSAGES,
+                                                 max_lease_duration=MAX_LEASE_SECONDS)
     )
 
     print(f'Listening for messages on {subscription_path}')
@@ -83,45 +135,51 @@ def process_message(message):
         message.ack()
         return
 
-    t0 = time.time()
-    solve_successful = False
-    try:
-        solve_cmd = ['/app/solver.py', '--bucket-path', bucket_path]
-        print(f'Submitting {solve_cmd}')
-        completed_process = subprocess.run(solve_cmd,
-                                           stdout=subprocess.PIPE,
-                                           stderr=subprocess.STDOUT,
-                                           check=True,
-                                           timeout=timeout)
-        print(f'Solving completed successfully for {bucket_path} in {time.time() - t0:.0f} sec')
-        print(f'{bucket_path} solver output: {completed_process.stdout}')
-        solve_successful = True
-    except subprocess.CalledProcessError as e:
-        print(f'Error in {bucket_path} plate solve script: {e!r}')
-        print(f'{bucket_path} solver output: {e.output}')
-        firestore_db.document(f'images/{image_id}').set(dict(status='error'), merge=True)
+    # The message is acked by `finish_job` once the image leaves the pipeline.
+    job = solver.SolveJob(bucket_path)
+    job.message = message
+    job.timeout = float(timeout)
+    solve_pipeline.submit(job)
 
-        try:
-            image_blob = incoming_bucket.blob(bucket_path)
-            error_blob = incoming_bucket.copy_blob(image_blob, error_bucket)
-            image_blob.delete()
-            print(f'Moved error FITS {bucket_path} to {error_blob.public_url}')
-        except exceptions.NotFound:
-            print(f'Error deleting after error, {bucket_path} blob path not found')
-    except FileNotFoundError:
-        print(f'Unable to download {bucket_path}, skipping.')
-    except Exception as e:
-        print(f'Error in {bucket_path} plate solve: {e!r}')
 
-        try:
-            error_blob = incoming_bucket.copy_blob(incoming_bucket.blob(bucket_path), error_bucket)
-            print(f'Moved error FITS {bucket_path} to {error_blob.public_url}')
-        except exceptions.NotFound:
-            print(f'Error deleting after error, {bucket_path} blob path not found')
+def shed_job(job):
+    """Give a job back to pubsub when the backlog is full."""
+    print(f'Backlog full, nacking {job.bucket_path}')
+    job.cleanup()
+    job.message.nack()
+
+
+def process_stage(job):
+    """Run the CPU bound stages for the job in one of the solver worker processes."""
+    solver_pool.run(job, solver.PROCESS_STAGES, timeout=job.timeout)
+
+
+def finish_job(job):
+    """Record the result of a `solver.SolveJob` that has left the pipeline and ack its message."""
+    try:
+        if isinstance(job.error, FileNotFoundError):
+            print(f'Unable to download {job.bucket_path}, skipping.')
+        elif job.error is not None:
+            print(f'Error in {job.bucket_path} plate solve: {job.error!r}')
+            move_to_error_bucket(job.bucket_path, job.image_id)
     finally:
-        t1 = time.time()
-        print(f'{bucket_path} finished in {t1 - t0:0.2f} secs. Solve success: {solve_successful}')
-        message.ack()
+        job.cleanup()
+        print(f'{job.bucket_path} finished in {job.elapsed:0.2f} secs. '
+              f'Solve success: {job.error is None} Stage timings: {job.timings!r}')
+        job.message.ack()
+
+
+def move_to_error_bucket(bucket_path, image_id):
+    """Mark the image as an error and move it from the incoming to the error bucket."""
+    firestore_db.document(f'images/{image_id}').set(dict(status='error'), merge=True)
+
+    try:
+        image_blob = incoming_bucket.blob(bucket_path)
+        error_blob = incoming_bucket.copy_blob(image_blob, error_bucket)
+        image_blob.delete()
+        print(f'Moved error FITS {bucket_path} to {error_blob.public_url}')
+    except exceptions.NotFound:
+        print(f'Error deleting after error, {bucket_path} blob path not found')
 
 
 if __name__ == '__main__':
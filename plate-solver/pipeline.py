@@ -0,0 +1,216 @@
+"""Run the solver stages concurrently on a stream of jobs.
+
+Each stage has its own worker threads and reads its jobs from a bounded queue,
+so the next image can be downloading while the current one is solved and the
+finished ones are uploaded. A full queue blocks the stage before it, which
+keeps the number of images on disk and in memory bounded.
+
+Jobs wait for the first stage in a `FairQueue`, which takes them in turn from
+each observation so that one long sequence can not hold up the others, and
+sheds jobs from the longest sequence once it is full.
+
+The time spent in each stage and the queue depths are printed as a single
+json line every `interval` seconds so they can be turned into log-based metrics.
+"""
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from collections import deque
+
+
+class StageStats(object):
+    """Count the jobs and the seconds spent in a stage."""
+
+    def __init__(self):
+        self.num_jobs = 0
+        self.num_errors = 0
+        self._durations = list()
+        self._lock = threading.Lock()
+
+    def add(self, seconds, error=False):
+        with self._lock:
+            self.num_jobs += 1
+            if error:
+                self.num_errors += 1
+            self._durations.append(seconds)
+
+    def report(self):
+        """Get the stats since the last report and reset the counters."""
+        with self._lock:
+            durations = sorted(self._durations)
+            stats = dict(
+                jobs=self.num_jobs,
+                errors=self.num_errors,
+                total_seconds=round(sum(durations), 3),
+                median_seconds=round(durations[len(durations) // 2], 3) if durations else None,
+                max_seconds=round(durations[-1], 3) if durations else None,
+            )
+
+            self.num_jobs = 0
+            self.num_errors = 0
+            self._durations = list()
+
+        return stats
+
+
+class FairQueue(object):
+    """A queue that takes jobs in turn from each group.
+
+    Has the `put`, `get` and `qsize` methods of `queue.Queue` but `put` never
+    blocks. If the queue is full the newest job from the largest group is removed
+    and passed to `on_shed` instead, e.g. to nack the message so it can be
+    handled by another instance.
+
+    Args:
+        maxsize (int): The number of jobs that can wait.
+        key (callable): Gets the group for a job.
+        on_shed (callable): Called with each job removed from a full queue.
+    """
+
+    def __init__(self, maxsize, key, on_shed):
+        self.maxsize = maxsize
+        self.key = key
+        self.on_shed = on_shed
+
+        self._groups = OrderedDict()
+        self._size = 0
+        self._condition = threading.Condition()
+
+    def qsize(self):
+        with self._condition:
+            return self._size
+
+    def put(self, job):
+        """Add the job to the end of its group, shedding a job if the queue is full."""
+        with self._condition:
+            self._groups.setdefault(self.key(job), deque()).append(job)
+            self._size += 1
+
+            shed_job = None
+            if self._size > self.maxsize:
+                largest_key = max(self._groups, key=lambda k: len(self._groups[k]))
+                shed_job = self._groups[largest_key].pop()
+                self._remove_if_empty(largest_key)
+                self._size -= 1
+
+            self._condition.notify()
+
+        if shed_job is not None:
+            self.on_shed(shed_job)
+
+    def get(self):
+        """Wait for the oldest job of the next group in turn."""
+        with self._condition:
+            while not self._size:
+                self._condition.wait()
+
+            group_key, group = next(iter(self._groups.items()))
+            job = group.popleft()
+            self._size -= 1
+
+            # Move the group to the back of the line.
+            self._groups.move_to_end(group_key)
+            self._remove_if_empty(group_key)
+
+        return job
+
+    def _remove_if_empty(self, group_key):
+        if not self._groups[group_key]:
+            del self._groups[group_key]
+
+
+class Pipeline(object):
+    """Pass jobs through the stages in order.
+
+    Each stage is called with the job and can set `job.finished` to skip the
+    remaining stages. An exception in a stage is stored in `job.error` and the
+    remaining stages are skipped. `on_done` is called with every job once it has
+    left the pipeline, from the thread of the last stage it went through.
+
+    The time each stage took is added to the `job.timings` dict.
+
+    Args:
+        stages (list): The `(name, func, num_workers)` for each stage.
+        on_done (callable): Called with the job when it leaves the pipeline.
+        queue_size (int): The number of jobs that can wait for each stage.
+        interval (float): Seconds between the stats reports, no reports if zero.
+        input_queue (`FairQueue`|None): The queue for the first stage if not a
+            `queue.Queue` of `queue_size`.
+    """
+
+    def __init__(self, stages, on_done, queue_size=1, interval=60., input_queue=None):
+        self.stages = stages
+        self.on_done = on_done
+        self.interval = interval
+
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+        if input_queue is not None:
+            self.queues[0] = input_queue
+        self.stats = {name: StageStats() for name, _, _ in stages}
+        self._threads = list()
+
+    @property
+    def queue_depths(self):
+        """dict: The number of jobs waiting for each stage."""
+        return {name: q.qsize() for (name, _, _), q in zip(self.stages, self.queues)}
+
+    def start(self):
+        """Start the worker threads for each stage and the stats reports."""
+        for stage_idx, (name, _, num_workers) in enumerate(self.stages):
+            for worker_idx in range(num_workers):
+                thread = threading.Thread(target=self._run_stage,
+                                          args=(stage_idx,),
+                                          name=f'{name}-{worker_idx}',
+                                          daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        if self.interval:
+            threading.Thread(target=self._report, name='pipeline-stats', daemon=True).start()
+
+    def submit(self, job):
+        """Add a job to the pipeline, blocking while a `queue.Queue` for the first stage is full."""
+        self.queues[0].put(job)
+
+    def report(self):
+        """dict: The stats for each stage since the last report and the queue depths."""
+        stage_stats = {name: stats.report() for name, stats in self.stats.items()}
+        for name, depth in self.queue_depths.items():
+            stage_stats[name]['queue_depth'] = depth
+
+        return stage_stats
+
+    def _run_stage(self, stage_idx):
+        name, func, _ = self.stages[stage_idx]
+        stage_queue = self.queues[stage_idx]
+        is_last = stage_idx == len(self.stages) - 1
+
+        while True:
+            job = stage_queue.get()
+            t0 = time.time()
+            try:
+                func(job)
+            except Exception as e:
+                job.error = e
+            finally:
+                elapsed = time.time() - t0
+                job.timings[name] = round(elapsed, 3)
+                self.stats[name].add(elapsed, error=job.error is not None)
+
+            if is_last or job.finished or job.error is not None:
+                self._finish(job)
+            else:
+                self.queues[stage_idx + 1].put(job)
+
+    def _finish(self, job):
+        try:
+            self.on_done(job)
+        except Exception as e:
+            print(f'Problem finishing job: {e!r}')
+
+    def _report(self):
+        while True:
+            time.sleep(self.interval)
+            print(json.dumps(dict(pipeline_stats=self.report())))
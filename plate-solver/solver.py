@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
 
+import json
 import os
 import sys
 import tempfile
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from contextlib import suppress
 
 import click
@@ -16,10 +20,16 @@ from google.cloud import storage
 from panoptes.utils import current_time
 from panoptes.utils import image_id_from_path
 from panoptes.utils import sequence_id_from_path
-from panoptes.utils.images import bayer
 from panoptes.utils.images import fits as fits_utils
 from panoptes.utils.logger import logger
 
+import astrometry
+import background
+import uploads
+import wcs_transfer
+from common import fits_header
+from common import header_cache
+
 logger.enable('panoptes')
 logger.remove()
 logger.add(sys.stderr, format="{message}", level="DEBUG")
@@ -27,17 +37,121 @@ logger.add(sys.stderr, format="{message}", level="DEBUG")
 INCOMING_BUCKET = os.getenv('INCOMING_BUCKET_NAME', 'panoptes-incoming')
 IMAGES_BUCKET = os.getenv('IMAGES_BUCKET_NAME', 'panoptes-raw-images')
 
+DEFAULT_SOLVE_CONFIG = {
+    "timeout": astrometry.SOLVE_TIMEOUT,
+}
+DEFAULT_BACKGROUND_CONFIG = {
+    "camera_bias": 2048.,
+    "filter_size": 3,
+    "box_size": (84, 84),
+    "percentiles": [10, 25, 50, 75, 90]
+}
+
+# Transfer the WCS from the last solved image in the sequence when possible, see `wcs_transfer`.
+WCS_TRANSFER = os.getenv('WCS_TRANSFER', 'True') == 'True'
+
+# The last image solved by astrometry.net in each sequence by this process, with
+# its WCS and stars, see `get_solve_hint` and `wcs_transfer`.
+MAX_RECENT_SOLUTIONS = 100
+recent_solutions = OrderedDict()
+
 # Storage
 try:
     firestore_db = firestore.Client()
     storage_client = storage.Client()
     incoming_bucket = storage_client.get_bucket(INCOMING_BUCKET)
     raw_images_bucket = storage_client.get_bucket(IMAGES_BUCKET)
+    fits_header_cache = header_cache.from_env(storage_client)
 except RuntimeError:
     print(f"Can't load Google credentials, exiting")
     sys.exit(1)
 
 
+class SolveJob(object):
+    """An image moving through the solver stages.
+
+    Each stage adds its results to the job and the time it took to `timings`.
+    A stage can set `finished` if the remaining stages are not needed.
+
+    The job can be pickled to run stages in a `workers.SolverPool`, in which case
+    the clients and the temporary directory stay with the original job.
+
+    Args:
+        bucket_path (str): The relative path to the file blob.
+        solve_config (dict|None): An optional dictionary of plate-solve configuration items.
+        background_config (dict|None): An optional dictionary of background configuration items.
+    """
+
+    def __init__(self, bucket_path, solve_config=None, background_config=None):
+        self.bucket_path = bucket_path
+        self.solve_config = solve_config or DEFAULT_SOLVE_CONFIG
+        self.background_config = background_config or DEFAULT_BACKGROUND_CONFIG
+
+        # Extract the sequence_id and image_id from the path directly.
+        # Note that this helps with some legacy units where the unit_id
+        # was given a friendly name, which then propagated into the sequence_id
+        # and image_id. This could potentially be removed in future although
+        # the path, sequence_id, and image_id should always match so should
+        # be okay to leave. wtgee 04-20
+        self.image_id = image_id_from_path(bucket_path)
+        self.sequence_id = sequence_id_from_path(bucket_path)
+
+        self.start_time = time.time()
+        self.timings = dict()
+        self.timeout = None
+        self.finished = False
+        self.error = None
+        self.message = None
+
+        self._tmp_dir = tempfile.TemporaryDirectory()
+        self.tmp_dir_name = self._tmp_dir.name
+
+        self.image_doc_ref = firestore_db.document(f'images/{self.image_id}')
+        self.incoming_blob = incoming_bucket.blob(bucket_path)
+        self.local_path = None
+        self.header = None
+        self.data = None
+        self.subtracted_data = None
+        self.back_path = None
+        self.background_header = None
+        self.backgrounds = None
+        self.background_info = dict(background_median=dict(), background_rms=dict())
+        self.solved_path = None
+        self.solved_header = None
+        self.solve_info = dict()
+        self.output_info = dict()
+        self.wcs_method = None
+
+    # Attributes that are not sent to the worker processes.
+    _local_attributes = ('_tmp_dir', 'image_doc_ref', 'incoming_blob', 'message')
+
+    def __getstate__(self):
+        return {name: value
+                for name, value in self.__dict__.items()
+                if name not in self._local_attributes}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._tmp_dir = None
+        self.message = None
+        self.image_doc_ref = firestore_db.document(f'images/{self.image_id}')
+        self.incoming_blob = incoming_bucket.blob(self.bucket_path)
+
+    @property
+    def elapsed(self):
+        """float: Seconds since the job was created."""
+        return time.time() - self.start_time
+
+    def cleanup(self):
+        """Remove the temporary files for the job."""
+        self.data = None
+        self.subtracted_data = None
+        self.backgrounds = None
+        if self._tmp_dir is not None:
+            with suppress(FileNotFoundError):
+                self._tmp_dir.cleanup()
+
+
 @click.command()
 @click.option('--bucket-path', required=True, help='Relative path in bucket.')
 @click.option('--background-config', type=dict, help='Background subtract configuration items.')
@@ -56,216 +170,330 @@ def solve_file(bucket_path, solve_config=None, background_config=None):
         background_config (dict|None): An optional dictionary of plate-solve configuration items.
 
     """
-    with tempfile.TemporaryDirectory() as tmp_dir_name:
-        t0 = time.time()
-        print(f'Creating temp directory {tmp_dir_name} for {bucket_path}')
-
-        # Extract the sequence_id and image_id from the path directly.
-        # Note that this helps with some legacy units where the unit_id
-        # was given a friendly name, which then propagated into the sequence_id
-        # and image_id. This could potentially be removed in future although
-        # the path, sequence_id, and image_id should always match so should
-        # be okay to leave. wtgee 04-20
-        image_id = image_id_from_path(bucket_path)
-        sequence_id = sequence_id_from_path(bucket_path)
-        print(f'Solving sequence_id={sequence_id} image_id={image_id} for {bucket_path}'
-              f'({t0 - time.time():.0f} sec)')
-
-        image_doc_ref = firestore_db.document(f'images/{image_id}')
-        image_doc_snap = image_doc_ref.get(['solved', 'background_median'])
-
-        print(f'Got image snapshot from firestore'
-              f'({t0 - time.time():.0f} sec)')
-
+    job = SolveJob(bucket_path, solve_config=solve_config, background_config=background_config)
+    try:
+        for stage_name, stage in STAGES:
+            t0 = time.time()
+            stage(job)
+            job.timings[stage_name] = round(time.time() - t0, 3)
+            if job.finished:
+                break
+    finally:
+        print(f'{bucket_path} stage timings: {job.timings!r}')
+        job.cleanup()
+
+
+def download_stage(job):
+    """Download the image and check if it still needs solving."""
+    print(f'Solving sequence_id={job.sequence_id} image_id={job.image_id} for {job.bucket_path}')
+
+    image_doc_snap = job.image_doc_ref.get(['solved', 'background_median'])
+    print(f'Got image snapshot from firestore ({job.elapsed:.0f} sec)')
+
+    try:
+        image_solved = image_doc_snap.get('solved')
+    except KeyError:
+        image_solved = False
+
+    try:
+        has_background = len(image_doc_snap.get('background_median')) > 0
+    except KeyError:
+        has_background = False
+
+    # Download image from storage bucket.
+    print(f'Getting file for {job.bucket_path} ({job.elapsed:.0f} sec)')
+    job.local_path = download_file(job.tmp_dir_name, job.bucket_path)
+    print(f'Got file for {job.bucket_path} ({job.elapsed:.0f} sec)')
+    job.header = fits_utils.getheader(job.local_path)
+    headers_say_solved = job.header.get('STATUS') == 'solved'
+
+    if image_solved and has_background and headers_say_solved and WCS(job.header).is_celestial:
+        print(f'Image has been solved with background, moving image to raw bucket.')
         try:
-            image_solved = image_doc_snap.get('solved')
-        except KeyError:
-            image_solved = False
+            incoming_bucket.copy_blob(job.incoming_blob, raw_images_bucket)
+            job.incoming_blob.delete()
+        except exceptions.NotFound as e:
+            print(f'Trouble moving {job.bucket_path} blob to raw images: {e!r}')
+        finally:
+            job.finished = True
+
+
+def background_stage(job):
+    """Subtract the background and get the stats for it."""
+    print(f"Starting plate-solving for FITS file {job.bucket_path} ({job.elapsed:.0f} sec)")
+
+    local_path = job.local_path
+    header = job.header
+    background_config = job.background_config
+
+    job.data = fits_utils.getdata(local_path)
+
+    header.update(dict(FILENAME=job.incoming_blob.public_url, SEQID=job.sequence_id, IMAGEID=job.image_id))
+    bg_header = fits.Header()
+    bg_header.update(header)
+
+    job.subtracted_data = job.data
+    # Get the background and store some stats about it.
+    try:
+        job.subtracted_data, rgb_backs = background.subtract_background(job.data, **background_config)
+        print(f'Got background for {local_path} ({job.elapsed:.0f} sec)')
+
+        job.background_header = bg_header
+        job.backgrounds = rgb_backs
+
+        for color, (back_data, back_rms) in rgb_backs.items():
+            # Info to save to firestore.
+            job.background_info['background_median'][color] = np.percentile(
+                back_data,
+                q=background_config.get('percentiles', [25, 50, 75])
+            ).tolist()
+            job.background_info['background_rms'][color] = np.percentile(
+                back_rms,
+                q=background_config.get('percentiles', [25, 50, 75])
+            ).tolist()
+    except Exception as e:
+        print(f'Problem getting background for {local_path}, plate-solving without: {e!r}')
+        header['BACKFAIL'] = True
+
+
+def solve_stage(job):
+    """Get the WCS for the background subtracted image and make the solved header.
+
+    The WCS is transferred from the last image solved in the sequence if the stars
+    match, otherwise the image is plate-solved with astrometry.net.
+    """
+    solve_config = job.solve_config
 
-        try:
-            has_background = len(image_doc_snap.get('background_median')) > 0
-        except KeyError:
-            has_background = False
-
-        # Blob for solved image.
-        print(f'Getting blob for {bucket_path} ({t0 - time.time():.0f} sec)')
-        incoming_blob = incoming_bucket.blob(bucket_path)
-        print(f'Got blob for {bucket_path} ({t0 - time.time():.0f} sec)')
-
-        # Download image from storage bucket.
-        print(f'Getting file for {bucket_path} ({t0 - time.time():.0f} sec)')
-        local_path = download_file(tmp_dir_name, bucket_path)
-        print(f'Got file for {bucket_path} ({t0 - time.time():.0f} sec)')
-        header = fits_utils.getheader(local_path)
-        headers_say_solved = header.get('STATUS') == 'solved'
-
-        if solve_config is None:
-            solve_config = {
-                "skip_solved": False,
-            }
-        if background_config is None:
-            background_config = {
-                "camera_bias": 2048.,
-                "filter_size": 3,
-                "box_size": (84, 84),
-                "percentiles": [10, 25, 50, 75, 90]
-            }
-
-        if image_solved and has_background and headers_say_solved and WCS(header).is_celestial:
-            print(f'Image has been solved with background, moving image to raw bucket.')
-            try:
-                incoming_bucket.copy_blob(incoming_blob, raw_images_bucket)
-                incoming_blob.delete()
-            except exceptions.NotFound as e:
-                print(f'Trouble moving {bucket_path} blob to raw images: {e!r}')
-            finally:
-                return
-
-        print(f"Starting plate-solving for FITS file {bucket_path}"
-              f'({t0 - time.time():.0f} sec)')
-
-        data = fits_utils.getdata(local_path)
-
-        header.update(dict(FILENAME=incoming_blob.public_url, SEQID=sequence_id, IMAGEID=image_id))
-        bg_header = fits.Header()
-        bg_header.update(header)
-
-        subtracted_data = data
-        # Get the background and store some stats about it.
-        background_info = dict(background_median=dict(), background_rms=dict())
-        try:
-            rgb_backs = bayer.get_rgb_background(local_path,
-                                                 return_separate=True,
-                                                 **background_config)
-            if len(rgb_backs) is None:
-                print(f'Could not get RGB background for {local_path}, plate-solving without')
-                header['BACKFAIL'] = True
-            else:
-                print(f'Got background for {local_path} ({t0 - time.time():.0f} sec)')
-                # Create one array for the backgrounds, where any holes are filled with zeros.
-                rgb_masks = bayer.get_rgb_masks(fits_utils.getdata(local_path))
-                full_background = np.array([np.ma.array(data=d0.background, mask=m0).filled(0)
-                                            for d0, m0
-                                            in zip(rgb_backs, rgb_masks)]).sum(0)
-
-                # Get the actual background subtracted data.
-                subtracted_data = (data - full_background).copy()
-
-                # Save background file as unsigned int16.
-                bg_header.add_comment(
-                    "RGB background. The first three extensions (after the primary)")
-                bg_header.add_comment(
-                    "are for RGB background maps, the next three are the RMS maps.")
-
-                empty_primary_hdu = fits.PrimaryHDU(header=bg_header)
-                hdu_list = [empty_primary_hdu]
-
-                for color, back_data in zip('rgb', rgb_backs):
-                    print(
-                        f'Creating {color} background file for {bucket_path} ('
-                        f'{t0 - time.time():.0f} sec)')
-                    back_hdu = fits.ImageHDU(data=back_data.background.astype(np.uint16))
-                    rms_hdu = fits.ImageHDU(data=back_data.background_rms.astype(np.uint16))
-
-                    hdu_list.extend([back_hdu, rms_hdu])
-
-                    # Info to save to firestore.
-                    background_info['background_median'][color] = np.percentile(
-                        back_data.background,
-                        q=background_config.get('percentiles', [25, 50, 75])
-                    ).tolist()
-                    background_info['background_rms'][color] = np.percentile(
-                        back_data.background_rms,
-                        q=background_config.get('percentiles', [25, 50, 75])
-                    ).tolist()
-
-                back_path = local_path.replace('.fits', f'-background.fits')
-                back_path = back_path.replace('.fz', '')  # Remove fz if present.
-
-                # Save and compress the background file.
-                fits.HDUList(hdu_list).writeto(back_path, overwrite=True)
-                back_path = fits_utils.fpack(back_path)
-        except Exception as e:
-            print(f'Problem getting background for {local_path}: {e!r}')
+    star_x, star_y = wcs_transfer.find_stars(job.subtracted_data)
 
+    wcs_header = None
+    reference = recent_solutions.get(job.sequence_id)
+    if WCS_TRANSFER and reference is not None:
+        t0 = time.time()
+        wcs_header, transfer_info = wcs_transfer.transfer(reference, star_x, star_y)
+        print(f'{job.bucket_path} WCS transfer info: {transfer_info}')
+        if wcs_header is not None:
+            job.wcs_method = 'transfer'
+            job.solve_info = dict(method='transfer',
+                                  hint_source=None,
+                                  seconds=round(time.time() - t0, 3),
+                                  transfer=transfer_info)
+
+    if wcs_header is None:
         # Save subtracted file locally for solving.
-        print(
-            f'Creating new background subtracted file for {local_path}'
-            f'({t0 - time.time():.0f} sec)')
-
-        primary_image_hdu = fits.PrimaryHDU(data=subtracted_data, header=header)
-
-        new_local_path = local_path.replace('.fz', '')
-        primary_image_hdu.writeto(new_local_path, overwrite=True)
-        assert os.path.exists(new_local_path)
-
-        print(
-            f'Plate solving background subtracted {new_local_path} with args: {solve_config!r}'
-            f'({t0 - time.time():.0f} sec)')
-
-        solve_info = fits_utils.get_solve_field(new_local_path, **solve_config)
-        print(f'{new_local_path} solve info: {solve_info}')
-        solved_path = solve_info['solved_fits_file']
-
-        # Save over original file with new headers but old data.
-        print(
-            f'Creating new plate-solved file for {new_local_path} from {solved_path} ('
-            f'{t0 - time.time():.0f} sec)')
-        solved_header = fits_utils.getheader(solved_path)
-        if not WCS(solved_header).is_celestial:
-            raise Exception(f'WARNING the returned header does not have a valid WCS')
-
-        # Remove old astrometry.net comments.
-        solved_header.remove('COMMENT', ignore_missing=True, remove_all=True)
-        solved_header.add_history(
-            f'Plate-solved by panoptes network at {current_time(pretty=True)}')
-        solved_header['STATUS'] = 'solved'
-
-        solved_hdu = fits.PrimaryHDU(data=data.astype(np.uint16), header=solved_header)
-        solved_hdu.writeto(solved_path, overwrite=True)
-        # Remove the original fpacked file
-        if solved_path == local_path:
-            print(f'Removing the existing fpacked file before packing new')
-            try:
-                os.remove(local_path)
-            except Exception as e:
-                print(f'Error removing existing fpacked: {e!r}')
-        solved_path = fits_utils.fpack(solved_path)
-
+        subtracted_path = job.local_path.replace('.fz', '').replace('.fits', '') + '-subtracted.fits'
+        print(f'Creating new background subtracted file for {job.local_path} ({job.elapsed:.0f} sec)')
+
+        primary_image_hdu = fits.PrimaryHDU(data=job.subtracted_data, header=job.header)
+        primary_image_hdu.writeto(subtracted_path, overwrite=True)
+        assert os.path.exists(subtracted_path)
+
+        hint = get_solve_hint(job)
+        print(f'Plate solving background subtracted {subtracted_path} with hint={hint!r} '
+              f'args={solve_config!r} ({job.elapsed:.0f} sec)')
+
+        wcs_header, job.solve_info = astrometry.solve(subtracted_path, hint=hint, **solve_config)
+        print(f'{job.bucket_path} solve info: {job.solve_info}')
+        if wcs_header is None:
+            raise Exception(f'WARNING unable to plate-solve {job.bucket_path}')
+
+        job.wcs_method = 'astrometry.net'
+        remember_solution(job, wcs_header, star_x, star_y)
+
+    # The original header with the new WCS.
+    print(f'Creating plate-solved header for {job.bucket_path} with {job.wcs_method} WCS '
+          f'({job.elapsed:.0f} sec)')
+    solved_header = astrometry.add_wcs(job.header.copy(), wcs_header)
+    solved_header['WCSMETH'] = (job.wcs_method, 'Method used for the WCS')
+
+    # Remove old astrometry.net comments.
+    solved_header.remove('COMMENT', ignore_missing=True, remove_all=True)
+    solved_header.add_history(
+        f'Plate-solved by panoptes network at {current_time(pretty=True)}')
+    solved_header['STATUS'] = 'solved'
+
+    job.solved_header = solved_header
+
+    # The subtracted data is no longer needed.
+    job.subtracted_data = None
+
+
+def output_stage(job):
+    """Write the solved image and the background file as tile-compressed FITS, ready to upload."""
+    t0 = time.time()
+    base_path = job.local_path.replace('.fz', '').replace('.fits', '')
+    bytes_written = 0
+
+    # Same layout as fpack, an empty primary followed by the compressed image.
+    job.solved_path = f'{base_path}-solved.fits.fz'
+    fits.HDUList([
+        fits.PrimaryHDU(),
+        fits.CompImageHDU(data=job.data.astype(np.uint16, copy=False), header=job.solved_header)
+    ]).writeto(job.solved_path, overwrite=True)
+    bytes_written += os.path.getsize(job.solved_path)
+
+    if job.backgrounds is not None:
+        # Save background file as unsigned int16.
+        bg_header = job.background_header
+        bg_header.add_comment(
+            "RGB background. The extensions (after the primary) are the background")
+        bg_header.add_comment(
+            "and RMS maps for each of R, G and B, with one pixel per bayer cell.")
+
+        hdu_list = [fits.PrimaryHDU(header=bg_header)]
+        for color, (back_data, back_rms) in job.backgrounds.items():
+            hdu_list.extend([
+                fits.CompImageHDU(data=np.clip(back_data, 0, None).astype(np.uint16)),
+                fits.CompImageHDU(data=np.clip(back_rms, 0, None).astype(np.uint16)),
+            ])
+
+        job.back_path = f'{base_path}-background.fits.fz'
+        fits.HDUList(hdu_list).writeto(job.back_path, overwrite=True)
+        bytes_written += os.path.getsize(job.back_path)
+
+    job.output_info = dict(bytes_written=bytes_written, seconds=round(time.time() - t0, 3))
+    print(json.dumps(dict(solver_output=dict(image_id=job.image_id, **job.output_info))))
+
+    # The image data is no longer needed.
+    job.data = None
+    job.backgrounds = None
+
+
+def upload_stage(job):
+    """Upload the solved and background files and record the metadata.
+
+    The solved and background files are uploaded at the same time and the
+    firestore update is sent once the solved file is stored. If the background
+    upload or the update fails the fields of the update are removed again. The
+    incoming image is only removed once all of them have succeeded.
+    """
+    t0 = time.time()
+    bucket_path = job.bucket_path
+    outgoing_blob = raw_images_bucket.blob(bucket_path)
+
+    image_doc_updates = dict(
+        status='solved',
+        solved=True,
+        public_url=outgoing_blob.public_url,
+        ra_image=job.solved_header.get('CRVAL1'),
+        dec_image=job.solved_header.get('CRVAL2'),
+        solve_method=job.solve_info.get('method'),
+        solve_hint=job.solve_info.get('hint_source'),
+        solve_seconds=job.solve_info.get('seconds'),
+        wcs_method=job.wcs_method,
+        wcs_transfer=job.solve_info.get('transfer'),
+        **job.background_info
+    )
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
         #  Upload the plate-solved image.
-        outgoing_blob = raw_images_bucket.blob(bucket_path)
-        print(f'Uploading {solved_path} to {outgoing_blob.public_url} ({t0 - time.time():.0f} sec)')
-        outgoing_blob.upload_from_filename(solved_path)
+        print(f'Uploading {job.solved_path} to {outgoing_blob.public_url} ({job.elapsed:.0f} sec)')
+        solved_future = executor.submit(uploads.upload_file, raw_images_bucket, bucket_path, job.solved_path)
 
         # Save the background alongside the normal image.
-        back_bucket_name = bucket_path.replace('.fits', f'-background.fits')
-        blob = raw_images_bucket.blob(back_bucket_name)
-        print(
-            f'Uploading background file for {back_path} to {blob.public_url}'
-            f'({t0 - time.time():.0f} sec)')
-        blob.upload_from_filename(back_path)
-
-        print(f'Removing from incoming bucket')
-        try:
-            incoming_blob.delete()
-        except exceptions.NotFound as e:
-            print(f'Error deleting {incoming_blob}')
+        futures = list()
+        if job.back_path is not None:
+            back_bucket_name = bucket_path.replace('.fits', f'-background.fits')
+            print(f'Uploading background file for {job.back_path} to {back_bucket_name} ({job.elapsed:.0f} sec)')
+            futures.append(executor.submit(uploads.upload_file, raw_images_bucket, back_bucket_name, job.back_path))
 
+        # Nothing is written to firestore unless the solved image is stored.
+        outgoing_blob = solved_future.result()
+
+        # Record the metadata in firestore while the background upload finishes.
         print(f'Recording metadata for {bucket_path}')
-        image_doc_updates = dict(
-            status='solved',
-            solved=True,
-            public_url=outgoing_blob.public_url,
-            ra_image=solved_header.get('CRVAL1'),
-            dec_image=solved_header.get('CRVAL2'),
-            **background_info
-        )
-
-        # Record the metadata in firestore.
-        image_doc_ref.set(
-            image_doc_updates,
-            merge=True
-        )
+        doc_future = executor.submit(job.image_doc_ref.set, image_doc_updates, merge=True)
+        futures.append(doc_future)
+
+        # Add the solved header to the shared cache for the new generation of the blob.
+        if fits_header_cache.is_shared:
+            solved_header_bytes, _ = fits_header.read_file_header_bytes(job.solved_path)
+            fits_header_cache.put(IMAGES_BUCKET,
+                                  bucket_path,
+                                  outgoing_blob.generation,
+                                  fits_header.parse_header(solved_header_bytes))
+
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            # Undo the metadata before the image is marked as an error and moved
+            # to the error bucket, so it is not left as solved.
+            wait([doc_future])
+            image_doc_rollback = {key: firestore.DELETE_FIELD for key in image_doc_updates}
+            image_doc_rollback.update(status='error', solved=False)
+            job.image_doc_ref.set(image_doc_rollback, merge=True)
+            raise
+
+    # Only remove the image once everything for it is stored.
+    print(f'Removing from incoming bucket')
+    delete_incoming_blob(job)
+
+    upload_info = dict(image_id=job.image_id,
+                       bytes_uploaded=sum(os.path.getsize(path)
+                                          for path in (job.solved_path, job.back_path)
+                                          if path is not None),
+                       seconds=round(time.time() - t0, 3))
+    print(json.dumps(dict(solver_upload=upload_info)))
+
+
+def delete_incoming_blob(job):
+    """Remove the image from the incoming bucket."""
+    try:
+        job.incoming_blob.delete()
+    except exceptions.NotFound as e:
+        print(f'Error deleting {job.incoming_blob}')
+
+
+def get_solve_hint(job):
+    """The pointing of the last image solved in the sequence, else the mount pointing in the header.
+
+    Returns:
+        dict|None: The `ra`, `dec` and `source` of the hint, or None if there is none.
+    """
+    reference = recent_solutions.get(job.sequence_id)
+    if reference is not None:
+        return dict(ra=reference['ra'], dec=reference['dec'], source='sequence')
+
+    solved_docs = (firestore_db.collection('images')
+                   .where('sequence_id', '==', job.sequence_id)
+                   .where('solved', '==', True)
+                   .select(['ra_image', 'dec_image'])
+                   .limit(1)
+                   .stream())
+    for doc in solved_docs:
+        ra = doc.get('ra_image')
+        dec = doc.get('dec_image')
+        if ra is not None and dec is not None:
+            return dict(ra=ra, dec=dec, source='sequence')
+
+    return astrometry.mount_hint(job.header)
+
+
+def remember_solution(job, wcs_header, star_x, star_y):
+    """Keep the solved image as the reference for the next ones in the sequence."""
+    recent_solutions[job.sequence_id] = dict(image_id=job.image_id,
+                                             wcs_header=wcs_header,
+                                             x=star_x,
+                                             y=star_y,
+                                             ra=wcs_header['CRVAL1'],
+                                             dec=wcs_header['CRVAL2'])
+    recent_solutions.move_to_end(job.sequence_id)
+    while len(recent_solutions) > MAX_RECENT_SOLUTIONS:
+        recent_solutions.popitem(last=False)
+
+
+# The stages in order, see `pipeline.Pipeline` for running them concurrently.
+STAGES = [
+    ('download', download_stage),
+    ('background', background_stage),
+    ('solve', solve_stage),
+    ('output', output_stage),
+    ('upload', upload_stage),
+]
+
+# The CPU bound stages, which the service runs in a `workers.SolverPool`.
+PROCESS_STAGES = ['background', 'solve', 'output']
 
 
 def download_file(tmp_dir_name, bucket_path):
@@ -0,0 +1,113 @@
+"""Upload the solver outputs to storage.
+
+Files are sent as resumable uploads in chunks of `UPLOAD_CHUNK_MB`, read from
+disk as they are sent. Files of at least `COMPOSITE_UPLOAD_MB` are split into
+`COMPOSITE_UPLOAD_PARTS` parts which are uploaded at the same time and then
+composed into the final object, after which the parts are deleted.
+
+Each upload has an `if_generation_match` precondition, so a retry of a request
+that already succeeded cannot write the object twice and the client retries
+the upload on transient errors. The first try expects the object not to
+exist; if it does, e.g. when an image is solved again, the upload is repeated
+with the generation of the existing object.
+"""
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import exceptions
+
+# Size in MB of each request of a resumable upload.
+UPLOAD_CHUNK_MB = int(os.getenv('UPLOAD_CHUNK_MB', 32))
+
+# Files of at least this many MB are sent as a parallel composite upload, 0 to never do so.
+COMPOSITE_UPLOAD_MB = int(os.getenv('COMPOSITE_UPLOAD_MB', 0))
+
+# Number of parts for a parallel composite upload, at most 32.
+COMPOSITE_UPLOAD_PARTS = min(int(os.getenv('COMPOSITE_UPLOAD_PARTS', 4)), 32)
+
+
+def upload_file(bucket, blob_name, path):
+    """Upload the file, replacing any existing object.
+
+    Args:
+        bucket (`google.cloud.storage.bucket.Bucket`): The bucket for the object.
+        blob_name (str): The name of the object.
+        path (str): The local file.
+
+    Returns:
+        `google.cloud.storage.blob.Blob`: The uploaded object, with its `generation`.
+    """
+    if COMPOSITE_UPLOAD_MB > 0 and os.path.getsize(path) >= COMPOSITE_UPLOAD_MB * 2**20:
+        return composite_upload(bucket, blob_name, path)
+
+    blob = bucket.blob(blob_name, chunk_size=UPLOAD_CHUNK_MB * 2**20)
+    with_generation_match(bucket, blob_name,
+                          lambda generation: blob.upload_from_filename(path, if_generation_match=generation))
+
+    return blob
+
+
+def composite_upload(bucket, blob_name, path, num_parts=COMPOSITE_UPLOAD_PARTS):
+    """Upload the parts of the file at the same time and compose them into one object.
+
+    The parts are uploaded next to the object with a unique suffix and are
+    deleted afterwards, even if the upload fails.
+
+    Returns:
+        `google.cloud.storage.blob.Blob`: The composed object, with its `generation`.
+    """
+    size = os.path.getsize(path)
+    part_size = -(-size // num_parts)
+    part_prefix = f'{blob_name}.part-{uuid.uuid4().hex}'
+
+    def upload_part(part_num):
+        with open(path, 'rb') as f:
+            f.seek(part_num * part_size)
+            part_data = f.read(part_size)
+
+        part_blob = bucket.blob(f'{part_prefix}-{part_num:02d}')
+        part_blob.upload_from_string(part_data, if_generation_match=0)
+        return part_blob
+
+    part_blobs = list()
+    try:
+        with ThreadPoolExecutor(max_workers=num_parts) as executor:
+            futures = [executor.submit(upload_part, part_num)
+                       for part_num in range(num_parts)
+                       if part_num * part_size < size]
+
+        # Keep every part that was uploaded so it is deleted, then raise any error.
+        part_blobs = [future.result() for future in futures if future.exception() is None]
+        for future in futures:
+            future.result()
+
+        blob = bucket.blob(blob_name)
+        with_generation_match(bucket, blob_name,
+                              lambda generation: blob.compose(part_blobs, if_generation_match=generation))
+    finally:
+        for part_blob in part_blobs:
+            try:
+                part_blob.delete()
+            except exceptions.NotFound:
+                pass
+
+    return blob
+
+
+def with_generation_match(bucket, blob_name, write):
+    """Call `write` with the generation the object is expected to have.
+
+    The first call expects no object. If there is one, `write` is called again
+    with its current generation.
+
+    Args:
+        bucket (`google.cloud.storage.bucket.Bucket`): The bucket of the object.
+        blob_name (str): The name of the object.
+        write (callable): Writes the object given the `if_generation_match` value.
+    """
+    try:
+        write(0)
+    except exceptions.PreconditionFailed:
+        existing_blob = bucket.get_blob(blob_name)
+        write(0 if existing_blob is None else existing_blob.generation)
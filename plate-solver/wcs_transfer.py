@@ -0,0 +1,174 @@
+"""Reuse the WCS of an earlier image in the sequence instead of solving again.
+
+The mount tracks during an observation so the stars only move a few pixels
+between images. The brightest stars are found in both the reference image,
+the last one solved by astrometry.net, and the new image. The offset between
+them is found by voting over the offsets of every pair of stars and then
+refined with the matched pairs. If enough stars match with a small residual
+the reference WCS is moved by the offset, otherwise the image is solved.
+"""
+import os
+
+import numpy as np
+from astropy.wcs import WCS
+
+# Number of bright stars used for the match.
+NUM_STARS = int(os.getenv('WCS_TRANSFER_NUM_STARS', 50))
+
+# Largest shift in pixels from the reference image.
+MAX_SHIFT = float(os.getenv('WCS_TRANSFER_MAX_SHIFT', 100))
+
+# Stars within this many pixels after the shift are matched.
+MATCH_TOLERANCE = float(os.getenv('WCS_TRANSFER_MATCH_TOLERANCE', 2))
+
+# The fewest matched stars and the largest RMS residual in pixels for the transfer.
+MIN_MATCHES = int(os.getenv('WCS_TRANSFER_MIN_MATCHES', 15))
+MAX_RESIDUAL = float(os.getenv('WCS_TRANSFER_MAX_RESIDUAL', 0.75))
+
+# Peaks this many times the noise above the background are stars.
+DETECT_SIGMA = 10.
+
+# Half size in binned pixels of the box used for the centroids.
+CENTROID_HALF_SIZE = 2
+
+
+def find_stars(data, num_stars=NUM_STARS):
+    """Find the brightest stars in a background subtracted bayer image.
+
+    The image is binned to one pixel per 2x2 bayer cell so the colors do not
+    produce peaks of their own.
+
+    Args:
+        data (`numpy.ndarray`): The image.
+        num_stars (int): The largest number of stars returned.
+
+    Returns:
+        tuple(`numpy.ndarray`): The zero-based `x` and `y` centroids of the stars
+            in the image pixels, brightest first.
+    """
+    height, width = data.shape
+    binned = data[:height // 2 * 2, :width // 2 * 2].astype(np.float32)
+    binned = binned.reshape(height // 2, 2, width // 2, 2).sum(axis=(1, 3))
+
+    sample = binned[::4, ::4]
+    background = np.median(sample)
+    noise = 1.4826 * np.median(np.abs(sample - background))
+    threshold = background + DETECT_SIGMA * max(noise, 1.)
+
+    # Local maxima above the threshold, away from the edges.
+    edge = CENTROID_HALF_SIZE + 1
+    center = binned[edge:-edge, edge:-edge]
+    is_peak = center > threshold
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dx or dy:
+                neighbour = binned[edge + dy:binned.shape[0] - edge + dy, edge + dx:binned.shape[1] - edge + dx]
+                is_peak &= center >= neighbour
+
+    peak_y, peak_x = np.nonzero(is_peak)
+    brightest = np.argsort(center[peak_y, peak_x])[::-1][:num_stars]
+    peak_y = peak_y[brightest] + edge
+    peak_x = peak_x[brightest] + edge
+
+    # Centroid in a small box around each peak.
+    offsets = np.arange(-CENTROID_HALF_SIZE, CENTROID_HALF_SIZE + 1)
+    box = binned[peak_y[:, None, None] + offsets[None, :, None],
+                 peak_x[:, None, None] + offsets[None, None, :]] - background
+    box = np.clip(box, 0, None)
+    total = box.sum(axis=(1, 2))
+    x = peak_x + (box.sum(axis=1) * offsets).sum(axis=1) / total
+    y = peak_y + (box.sum(axis=2) * offsets).sum(axis=1) / total
+
+    # Back to the image pixels, the center of a binned pixel is between two image pixels.
+    return 2 * x + 0.5, 2 * y + 0.5
+
+
+def match_offset(ref_x, ref_y, x, y, max_shift=MAX_SHIFT, tolerance=MATCH_TOLERANCE):
+    """Find the offset of the stars from the reference stars.
+
+    Returns:
+        tuple|None: The `dx`, `dy` offset, the number of matched stars and the
+            RMS residual in pixels, or None if there are no stars.
+    """
+    if len(ref_x) == 0 or len(x) == 0:
+        return None
+
+    # Vote with the offsets of every pair, binned at the match tolerance.
+    pair_dx = (x[None, :] - ref_x[:, None]).ravel()
+    pair_dy = (y[None, :] - ref_y[:, None]).ravel()
+    in_range = (np.abs(pair_dx) < max_shift) & (np.abs(pair_dy) < max_shift)
+    if not in_range.any():
+        return None
+
+    bin_size = 2 * tolerance
+    bins = np.arange(-max_shift, max_shift + bin_size, bin_size)
+    votes, _, _ = np.histogram2d(pair_dx[in_range], pair_dy[in_range], bins=[bins, bins])
+    best_x, best_y = np.unravel_index(np.argmax(votes), votes.shape)
+    dx = bins[best_x] + tolerance
+    dy = bins[best_y] + tolerance
+
+    # Refine with the pairs close to the voted offset.
+    for radius in (bin_size, tolerance):
+        close = np.hypot(pair_dx - dx, pair_dy - dy) < radius
+        if not close.any():
+            return None
+        dx = np.median(pair_dx[close])
+        dy = np.median(pair_dy[close])
+
+    # Match each reference star to the nearest star after the shift.
+    distances = np.hypot(x[None, :] - ref_x[:, None] - dx, y[None, :] - ref_y[:, None] - dy)
+    nearest = distances.min(axis=1)
+    matched = nearest < tolerance
+    if not matched.any():
+        return None
+
+    residual = float(np.sqrt(np.mean(nearest[matched] ** 2)))
+    return float(dx), float(dy), int(matched.sum()), residual
+
+
+def shift_wcs(wcs_header, dx, dy):
+    """Move the WCS so that the sky is `dx`, `dy` pixels from where it was.
+
+    The reference pixel stays at the same place on the detector, along with the
+    distortion, and the sky coordinate at it changes.
+
+    Returns:
+        `astropy.io.fits.Header`: A copy of the header with the new `CRVAL1` and `CRVAL2`.
+    """
+    wcs = WCS(wcs_header)
+    crpix_x, crpix_y = wcs.wcs.crpix
+    crval = wcs.all_pix2world([[crpix_x - dx, crpix_y - dy]], 1)[0]
+
+    shifted_header = wcs_header.copy()
+    shifted_header['CRVAL1'] = float(crval[0])
+    shifted_header['CRVAL2'] = float(crval[1])
+
+    return shifted_header
+
+
+def transfer(reference, x, y):
+    """Get the WCS for an image from the reference image if the stars match well enough.
+
+    Args:
+        reference (dict): The `wcs_header`, star `x` and `y` and `image_id` of the reference image.
+        x (`numpy.ndarray`): The star `x` positions in the image.
+        y (`numpy.ndarray`): The star `y` positions in the image.
+
+    Returns:
+        tuple(`astropy.io.fits.Header`|None, dict): The shifted WCS header, or
+            None if the match is not good enough, and info about the match.
+    """
+    match = match_offset(reference['x'], reference['y'], x, y)
+    if match is None:
+        return None, dict(reference=reference['image_id'], num_matches=0)
+
+    dx, dy, num_matches, residual = match
+    transfer_info = dict(reference=reference['image_id'],
+                         dx=round(dx, 3),
+                         dy=round(dy, 3),
+                         num_matches=num_matches,
+                         residual=round(residual, 3))
+    if num_matches < MIN_MATCHES or residual > MAX_RESIDUAL:
+        return None, transfer_info
+
+    return shift_wcs(reference['wcs_header'], dx, dy), transfer_info
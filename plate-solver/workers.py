@@ -0,0 +1,226 @@
+"""Run solver stages in a pool of persistent worker processes.
+
+Starting `solver.py` for each image pays for the interpreter start, the imports
+of astropy, numpy, the google clients and panoptes-utils, and creating the
+firestore and storage clients. The workers here do that once when they start
+and then run the stages for one job at a time, so each image only pays for
+sending the job state to the worker and back.
+
+If a job takes longer than its timeout the worker process is terminated and a
+new one is started in its place.
+
+`default_num_workers` sizes the pool for the CPUs and memory of the instance.
+"""
+import importlib
+import multiprocessing
+import os
+import queue
+import time
+
+# Files with the memory limit of the container, for cgroup v2 and v1.
+CGROUP_MEMORY_FILES = ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']
+
+
+def available_cpus():
+    """int: The number of CPUs this process can run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory():
+    """int: The memory limit of the container in bytes, or the physical memory if not limited."""
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for path in CGROUP_MEMORY_FILES:
+        try:
+            with open(path) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+
+        if limit.isdigit():
+            memory = min(memory, int(limit))
+        break
+
+    return memory
+
+
+def default_num_workers(memory_per_worker, reserved_memory=0):
+    """The number of solves that fit in the CPUs and memory of the instance.
+
+    Args:
+        memory_per_worker (int): The bytes needed for each solve.
+        reserved_memory (int): The bytes needed by everything else, e.g. the
+            images waiting in the pipeline.
+
+    Returns:
+        int: One solve per CPU, limited by the memory, and at least one.
+    """
+    num_for_memory = (available_memory() - reserved_memory) // memory_per_worker
+    return max(1, min(available_cpus(), num_for_memory))
+
+
+class SolverWorker(object):
+    """A worker process and the connection used to send it jobs."""
+
+    def __init__(self, mp_context, module_name='solver'):
+        self.conn, child_conn = mp_context.Pipe()
+        self.process = mp_context.Process(target=run_worker, args=(child_conn, module_name), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+        self.start_time = time.time()
+        self.is_ready = False
+
+    def wait_ready(self):
+        """Wait for the worker to finish its imports."""
+        if not self.is_ready:
+            self.conn.recv()
+            self.is_ready = True
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join(timeout=5)
+        self.conn.close()
+
+
+class SolverPool(object):
+    """Run the solver stages for a job in one of the worker processes.
+
+    Args:
+        num_workers (int): The number of worker processes.
+        timeout (float): The default number of seconds a job can take.
+        module_name (str): The module with the `STAGES` and `SolveJob` class,
+            default `solver`.
+    """
+
+    def __init__(self, num_workers=1, timeout=600., module_name='solver'):
+        self.num_workers = num_workers
+        self.timeout = timeout
+        self.module_name = module_name
+
+        self._mp_context = multiprocessing.get_context('spawn')
+        self._workers = queue.Queue()
+        for _ in range(num_workers):
+            self._workers.put(SolverWorker(self._mp_context, module_name))
+
+    def wait_ready(self):
+        """Wait for all the workers to finish their imports.
+
+        Returns:
+            float: The seconds since the slowest worker was started.
+        """
+        workers = [self._workers.get() for _ in range(self.num_workers)]
+        try:
+            for worker in workers:
+                worker.wait_ready()
+        finally:
+            for worker in workers:
+                self._workers.put(worker)
+
+        return max(time.time() - worker.start_time for worker in workers)
+
+    def run(self, job, stage_names, timeout=None):
+        """Run the named `solver.STAGES` for the job in a worker.
+
+        The job state is updated with the results from the worker, including the
+        timings for each stage, as if the stages were run in this process.
+
+        Args:
+            job (`solver.SolveJob`): The job.
+            stage_names (list): The names of the stages to run in order.
+            timeout (float|None): The seconds the stages can take, default `self.timeout`.
+
+        Raises:
+            TimeoutError: If the stages take longer than the timeout.
+            Exception: Whatever the stages raise.
+        """
+        timeout = timeout or self.timeout
+
+        worker = self._workers.get()
+        try:
+            worker.wait_ready()
+            worker.conn.send((job.__getstate__(), stage_names))
+            is_finished = worker.conn.poll(timeout)
+            if is_finished:
+                job_state, error = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            # The worker died, e.g. killed for using too much memory.
+            self._workers.put(self._restart(worker))
+            raise RuntimeError(f'Solver worker exited running {stage_names}: {e!r}')
+        except Exception:
+            self._workers.put(worker)
+            raise
+
+        if not is_finished:
+            self._workers.put(self._restart(worker))
+            raise TimeoutError(f'Solver stages {stage_names} timed out after {timeout} sec')
+
+        self._workers.put(worker)
+        job.__dict__.update(job_state)
+        if error is not None:
+            raise error
+
+    def _restart(self, worker):
+        worker.stop()
+        return SolverWorker(self._mp_context, self.module_name)
+
+    def ping(self):
+        """Send an empty job to a worker, returning the seconds for the round trip."""
+        worker = self._workers.get()
+        try:
+            worker.wait_ready()
+            t0 = time.time()
+            worker.conn.send((None, []))
+            worker.conn.recv()
+            return time.time() - t0
+        finally:
+            self._workers.put(worker)
+
+    def close(self):
+        for _ in range(self.num_workers):
+            self._workers.get().stop()
+
+
+def run_worker(conn, module_name='solver'):
+    """Run jobs sent over the connection until it is closed.
+
+    The imports, and so the clients created by `solver`, happen once per process.
+    """
+    solver = importlib.import_module(module_name)
+
+    stages = dict(solver.STAGES)
+    conn.send('ready')
+
+    while True:
+        try:
+            job_state, stage_names = conn.recv()
+        except EOFError:
+            return
+
+        if job_state is None:
+            conn.send((None, None))
+            continue
+
+        job = solver.SolveJob.__new__(solver.SolveJob)
+        job.__setstate__(job_state)
+
+        error = None
+        for stage_name in stage_names:
+            t0 = time.time()
+            try:
+                stages[stage_name](job)
+            except Exception as e:
+                error = e
+            finally:
+                job.timings[stage_name] = round(time.time() - t0, 3)
+
+            if error is not None or job.finished:
+                break
+
+        try:
+            conn.send((job.__getstate__(), error))
+        except Exception as e:
+            # The error could not be pickled.
+            conn.send((job.__getstate__(), RuntimeError(f'{error!r}: {e!r}')))
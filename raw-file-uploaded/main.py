@@ -2,16 +2,21 @@ import base64
 import json
 import os
 import sys
+import time
 from contextlib import suppress
 
 from dateutil.parser import parse as parse_date
+from google.cloud import exceptions
 from google.cloud import firestore
-from google.cloud import pubsub
 from google.cloud import storage
 from panoptes.utils import image_id_from_path
 from panoptes.utils import sequence_id_from_path
 from panoptes.utils.logger import logger
 
+import routing
+from common import batch_publisher
+from common import header_cache
+
 logger.remove()
 logger.add(sys.stdout,
            level=os.getenv('LOG_LEVEL', 'INFO'),
@@ -24,10 +29,10 @@ logger.add(sys.stdout,
 FITS_HEADER_URL = os.getenv('FITS_HEADER_URL',
                             'https://us-central1-panoptes-exp.cloudfunctions.net/get-fits-header')
 
-publisher = pubsub.PublisherClient()
-
 project_id = os.getenv('GOOGLE_CLOUD_PROJECT', 'panoptes-exp')
-pubsub_base = f'projects/{project_id}/topics'
+
+# Messages are sent in batches and waited on before the function returns.
+publisher = batch_publisher.BatchPublisher(project_id=project_id)
 
 plate_solve_topic = os.getenv('SOLVER_topic', 'plate-solve')
 make_rgb_topic = os.getenv('RGB_topic', 'make-rgb-fits')
@@ -43,6 +48,14 @@ jpg_images_bucket = sc.get_bucket(os.getenv('JPG_BUCKET_NAME', 'panoptes-exp.app
 
 firestore_db = firestore.Client()
 
+# Observation and unit documents known to exist, with the time to forget them.
+KNOWN_DOCS_TTL = float(os.getenv('KNOWN_DOCS_TTL', 600))
+MAX_KNOWN_DOCS = 1000
+known_docs = dict()
+
+# Parsed FITS headers, keyed by the generation of the blob.
+fits_header_cache = header_cache.from_env(sc)
+
 
 def entry_point(raw_message, context):
     """Background Cloud Function to be triggered by Cloud Storage.
@@ -63,12 +76,19 @@ def entry_point(raw_message, context):
         logger.debug(f"Message: {message!r} \t Attributes: {attributes!r}")
 
         process_topic(message, attributes)
-        # Flush the stdout to avoid log buffering.
-        sys.stdout.flush()
 
     except Exception as e:
         logger.error(f'error: {e}')
 
+    finally:
+        # The instance can be frozen once the function returns, so wait for the messages.
+        for error in publisher.flush():
+            logger.error(f'Error publishing message: {error!r}')
+        logger.info(json.dumps(dict(publisher_stats=publisher.stats)))
+
+        # Flush the stdout to avoid log buffering.
+        sys.stdout.flush()
+
 
 def process_topic(message, attributes):
     """Look for uploaded files and process according to the file type.
@@ -88,6 +108,7 @@ def process_topic(message, attributes):
         None; the output is written to Stackdriver Logging
     """
     bucket_path = attributes['objectId']
+    generation = attributes.get('objectGeneration')
 
     if bucket_path is None:
         raise Exception(f'No file requested')
@@ -108,18 +129,18 @@ def process_topic(message, attributes):
         field_name = path_parts.pop(1)
         new_path = '/'.join(path_parts)
         logger.debug(f'Removed field name ["{field_name}"], moving: {bucket_path} -> {new_path}')
-        incoming_bucket.rename_blob(incoming_bucket.get_blob(bucket_path), new_path)
+        incoming_bucket.rename_blob(incoming_bucket.blob(bucket_path), new_path)
         return
 
     logger.debug(f"Processing {bucket_path}")
     try:
-        process_lookup[file_ext](bucket_path)
+        process_lookup[file_ext](bucket_path, generation=generation)
     except KeyError as e:
         logger.warning(f'No handling for {file_ext}, moving to temp bucket')
-        process_unknown(bucket_path)
+        process_unknown(bucket_path, generation=generation)
 
 
-def process_fits(bucket_path):
+def process_fits(bucket_path, generation=None):
     """Record and move the FITS images.
 
     Record the metadata for all observation images in the firestore db. Move a copy
@@ -129,42 +150,42 @@ def process_fits(bucket_path):
 
     Args:
         bucket_path (str): The relative path in a google storage bucket.
+        generation (str|None): The generation of the uploaded blob.
     """
     try:
         if 'pointing' not in bucket_path:
-            add_records_to_db(bucket_path)
+            add_records_to_db(bucket_path, generation=generation)
     except Exception as e:
         logger.error(f'Error adding firestore record for {bucket_path}: {e!r}')
     else:
         # Archive file.
-        copy_blob_to_bucket(bucket_path, raw_archive_bucket)
+        copy_blob_to_bucket(bucket_path, raw_archive_bucket, generation=generation)
 
         # Send to plate solver.
         send_pubsub_message(plate_solve_topic, dict(bucket_path=bucket_path))
 
 
-def process_cr2(bucket_path):
+def process_cr2(bucket_path, generation=None):
     """Move cr2 to archive and observation bucket"""
-    copy_blob_to_bucket(bucket_path, raw_archive_bucket)
-    move_blob_to_bucket(bucket_path, raw_images_bucket)
+    move_blob_to_bucket(bucket_path, [raw_archive_bucket, raw_images_bucket], generation=generation)
 
 
-def process_jpg(bucket_path):
+def process_jpg(bucket_path, generation=None):
     """Move jpgs to observation bucket"""
-    move_blob_to_bucket(bucket_path, jpg_images_bucket)
+    move_blob_to_bucket(bucket_path, jpg_images_bucket, generation=generation)
 
 
-def process_timelapse(bucket_path):
+def process_timelapse(bucket_path, generation=None):
     """Move jpgs to observation bucket"""
-    move_blob_to_bucket(bucket_path, timelapse_bucket)
+    move_blob_to_bucket(bucket_path, timelapse_bucket, generation=generation)
 
 
-def process_unknown(bucket_path):
+def process_unknown(bucket_path, generation=None):
     """Move unknown extensions to the temp bucket."""
-    move_blob_to_bucket(bucket_path, temp_bucket)
+    move_blob_to_bucket(bucket_path, temp_bucket, generation=generation)
 
 
-def add_records_to_db(bucket_path):
+def add_records_to_db(bucket_path, generation=None):
     """Add FITS image info to firestore_db.
 
     Note:
@@ -174,6 +195,7 @@ def add_records_to_db(bucket_path):
     Args:
         header (dict): FITS Header message from an observation.
         bucket_path (str): Full path to the image in a Google Storage Bucket.
+        generation (str|None): The generation of the blob.
 
     Returns:
         str: The image_id.
@@ -182,7 +204,7 @@ def add_records_to_db(bucket_path):
         e: Description
     """
     logger.debug(f'Recording {bucket_path} metadata.')
-    header = lookup_fits_header(bucket_path)
+    header = lookup_fits_header(bucket_path, generation=generation)
     logger.debug(f'Getting sequence_id and image_id from {bucket_path!r}')
 
     try:
@@ -210,55 +232,55 @@ def add_records_to_db(bucket_path):
 
         img_time = parse_date(image_id.split('_')[-1])
 
-        logger.debug(f'Getting document for observation {sequence_id}')
         seq_doc_ref = firestore_db.document(f'observations/{sequence_id}')
-        seq_doc_snap = seq_doc_ref.get()
-
+        unit_doc_ref = firestore_db.document(f'units/{unit_id}')
         image_doc_ref = firestore_db.document(f'images/{image_id}')
-        image_doc_snap = image_doc_ref.get()
-
-        batch = firestore_db.batch()
 
-        # Create unit and observation documents if needed.
-        if not seq_doc_snap.exists:
+        # Look up the image along with any unit and observation not known to exist, in one read.
+        # Once they are known the image is created without a read, see `create_docs`.
+        doc_refs = [doc_ref for doc_ref in (unit_doc_ref, seq_doc_ref) if not is_known_doc(doc_ref.path)]
+        if doc_refs:
+            logger.debug(f'Getting documents {[doc_ref.path for doc_ref in doc_refs]!r} and {image_doc_ref.path}')
+            doc_snaps = firestore_db.get_all(doc_refs + [image_doc_ref], field_paths=['status'])
+            missing_docs = {doc_snap.reference.path for doc_snap in doc_snaps if not doc_snap.exists}
+        else:
+            missing_docs = {image_doc_ref.path}
+
+        new_docs = list()
+
+        # Add a units doc if it doesn't exist.
+        if unit_doc_ref.path in missing_docs:
+            logger.debug(f'Making new document for unit {unit_id}')
+            unit_message = dict(
+                name=header.get('OBSERVER', ''),
+                location=firestore.GeoPoint(header['LAT-OBS'],
+                                            header['LONG-OBS']),
+                elevation=float(header.get('ELEV-OBS')),
+                status='active'
+            )
+            new_docs.append((unit_doc_ref, unit_message))
+
+        # Add an observation doc if it doesn't exist.
+        if seq_doc_ref.path in missing_docs:
             logger.debug(f'Making new document for observation {sequence_id}')
-            # If no sequence doc then probably no unit id. This is just to minimize
-            # the number of lookups that would be required if we looked up unit_id
-            # doc each time.
-            logger.debug(f'Getting doc for unit {unit_id}')
-            unit_doc_ref = firestore_db.document(f'units/{unit_id}')
-            unit_doc_snap = unit_doc_ref.get()
-
-            # Add a units doc if it doesn't exist.
-            if not unit_doc_snap.exists:
-                unit_message = dict(
-                    name=header.get('OBSERVER', ''),
-                    location=firestore.GeoPoint(header['LAT-OBS'],
-                                                header['LONG-OBS']),
-                    elevation=float(header.get('ELEV-OBS')),
-                    status='active'
-                )
-                batch.create(unit_doc_ref, unit_message)
-
-            if not seq_doc_snap.exists:
-                seq_message = dict(
-                    unit_id=unit_id,
-                    camera_id=camera_id,
-                    time=sequence_time,
-                    exptime=header.get('EXPTIME'),
-                    project=header.get('ORIGIN'),
-                    software_version=header.get('CREATOR', ''),
-                    field_name=header.get('FIELD', ''),
-                    iso=header.get('ISO'),
-                    ra=header.get('CRVAL1'),
-                    dec=header.get('CRVAL2'),
-                    status='receiving_files',
-                    received_time=firestore.SERVER_TIMESTAMP)
-                logger.debug(f"Adding new sequence: {seq_message!r}")
-                batch.create(seq_doc_ref, seq_message)
+            seq_message = dict(
+                unit_id=unit_id,
+                camera_id=camera_id,
+                time=sequence_time,
+                exptime=header.get('EXPTIME'),
+                project=header.get('ORIGIN'),
+                software_version=header.get('CREATOR', ''),
+                field_name=header.get('FIELD', ''),
+                iso=header.get('ISO'),
+                ra=header.get('CRVAL1'),
+                dec=header.get('CRVAL2'),
+                status='receiving_files',
+                received_time=firestore.SERVER_TIMESTAMP)
+            logger.debug(f"Adding new sequence: {seq_message!r}")
+            new_docs.append((seq_doc_ref, seq_message))
 
         # Create image document if needed.
-        if not image_doc_snap.exists:
+        if image_doc_ref.path in missing_docs:
             logger.debug(f"Adding image document for SEQ={sequence_id} IMG={image_id}")
 
             image_message = dict(
@@ -278,9 +300,12 @@ def add_records_to_db(bucket_path):
                 dec_mnt=header.get('DEC-MNT'),
                 received_time=firestore.SERVER_TIMESTAMP)
             logger.debug(f'Adding image: {image_message!r}')
-            batch.create(image_doc_ref, image_message)
+            new_docs.append((image_doc_ref, image_message))
 
-        batch.commit()
+        create_docs(new_docs)
+
+        remember_known_doc(unit_doc_ref.path)
+        remember_known_doc(seq_doc_ref.path)
 
     except Exception as e:
         logger.error(f'Error in adding record: {e!r}')
@@ -289,6 +314,52 @@ def add_records_to_db(bucket_path):
     return True
 
 
+def create_docs(new_docs):
+    """Create the documents in one batch, skipping any that already exist.
+
+    If another instance created one of the documents since it was looked up,
+    or the image was uploaded again, the batch fails and each document is
+    created on its own instead.
+
+    Args:
+        new_docs (list): The `(doc_ref, message)` of each document.
+    """
+    if not new_docs:
+        return
+
+    batch = firestore_db.batch()
+    for doc_ref, message in new_docs:
+        batch.create(doc_ref, message)
+
+    try:
+        batch.commit()
+    except exceptions.Conflict:
+        logger.debug('Documents already exist, creating them one at a time')
+        for doc_ref, message in new_docs:
+            try:
+                doc_ref.create(message)
+            except exceptions.Conflict:
+                logger.debug(f'Document {doc_ref.path} already exists')
+
+
+def is_known_doc(doc_path):
+    """If the document is known to exist, see `remember_known_doc`."""
+    expire_time = known_docs.get(doc_path)
+    return expire_time is not None and expire_time > time.monotonic()
+
+
+def remember_known_doc(doc_path):
+    """Remember that the document exists for the next `KNOWN_DOCS_TTL` seconds."""
+    now = time.monotonic()
+    if len(known_docs) >= MAX_KNOWN_DOCS:
+        for expired_path in [path for path, expire_time in known_docs.items() if expire_time <= now]:
+            del known_docs[expired_path]
+        if len(known_docs) >= MAX_KNOWN_DOCS:
+            known_docs.clear()
+
+    known_docs[doc_path] = now + KNOWN_DOCS_TTL
+
+
 def send_pubsub_message(topic, data):
     """Send a pubsub message.
 
@@ -296,25 +367,31 @@ def send_pubsub_message(topic, data):
     but also unwrap the dict here to set as attribute as well.
 
     Note that data needs to be encoded but attributes do not.
+
+    The message is sent with the next batch, see `entry_point` for where the
+    function waits for it.
     """
     logger.debug(f"Sending message to {topic}: {data!r}")
 
-    publisher.publish(f'{pubsub_base}/{topic}', json.dumps(data).encode(), **data)
+    return publisher.publish(topic, json.dumps(data).encode(), **data)
 
 
-def move_blob_to_bucket(blob_name, new_bucket, remove=True):
+def move_blob_to_bucket(blob_name, new_bucket, remove=True, generation=None):
     """Copy the blob from the incoming bucket to the `new_bucket`.
 
+    See `routing.route_blob`, which logs the requests and time taken.
+
     Args:
         blob_name (str): The relative path to the blob.
-        new_bucket (str): The name of the bucket where we move/copy the file.
+        new_bucket (`google.cloud.storage.bucket.Bucket`|list): The bucket, or buckets,
+            where we move/copy the file.
         remove (bool, optional): If file should be removed afterwards, i.e. a move, or just copied.
             Default True as per the function name.
+        generation (str|None): The generation of the blob, if known.
     """
-    logger.debug(f'Moving {blob_name} → {new_bucket}')
-    incoming_bucket.copy_blob(incoming_bucket.get_blob(blob_name), new_bucket)
-    if remove:
-        incoming_bucket.delete_blob(blob_name)
+    new_buckets = new_bucket if isinstance(new_bucket, list) else [new_bucket]
+    logger.debug(f'Moving {blob_name} → {[bucket.name for bucket in new_buckets]}')
+    routing.route_blob(incoming_bucket, blob_name, new_buckets, remove=remove, generation=generation)
 
 
 def copy_blob_to_bucket(*args, **kwargs):
@@ -322,77 +399,23 @@ def copy_blob_to_bucket(*args, **kwargs):
     move_blob_to_bucket(*args, **kwargs)
 
 
-def lookup_fits_header(bucket_path):
+def lookup_fits_header(bucket_path, generation=None):
     """Read the FITS header from storage.
 
-    FITS Header Units are stored in blocks of 2880 bytes consisting of 36 lines
-    that are 80 bytes long each. The Header Unit always ends with the single
-    word 'END' on a line (not necessarily line 36).
-
-    Here the header is streamed from Storage until the 'END' is found, with
-    each line given minimal parsing.
-
-    See https://fits.gsfc.nasa.gov/fits_primer.html for overview of FITS format.
+    The header is looked up in the header cache first. See
+    `common.fits_header.read_header_bytes` for how it is read on a miss.
 
     Args:
-        bucket_path (`google.cloud.storage.blob.Blob`): Blob or path to remote blob.
-            If just the blob name is given then the blob is looked up first.
+        bucket_path (str): The relative path to the blob in the incoming bucket.
+        generation (str|None): The generation of the blob, looked up if not given.
 
     Returns:
         dict: FITS header as a dictonary.
     """
-    card_num = 1
-    if bucket_path.endswith('.fz'):
-        card_num = 2  # We skip the compression header info card
-
-    headers = dict()
-
     logger.debug(f'Looking up header for file: {bucket_path}')
-    storage_blob = incoming_bucket.get_blob(bucket_path)
-
-    streaming = True
-    while streaming:
-        # Get a header card
-        start_byte = 2880 * (card_num - 1)
-        end_byte = (2880 * card_num) - 1
-        b_string = storage_blob.download_as_string(start=start_byte,
-                                                   end=end_byte)
-
-        # Loop over 80-char lines
-        for i, j in enumerate(range(0, len(b_string), 80)):
-            item_string = b_string[j: j + 80].decode()
-            logger.trace(f'Fits header line {i}: {item_string}')
-
-            # End of FITS Header, stop streaming
-            if item_string.startswith('END'):
-                streaming = False
-                break
-
-            # Get key=value pairs (skip COMMENTS and HISTORY)
-            if item_string.find('=') > 0:
-                k, v = item_string.split('=')
-
-                # Remove FITS comment
-                if ' / ' in v:
-                    v = v.split(' / ')[0]
-
-                v = v.strip()
-
-                # Cleanup and discover type in dumb fashion
-                if v.startswith("'") and v.endswith("'"):
-                    v = v.replace("'", "").strip()
-                elif v.find('.') > 0:
-                    v = float(v)
-                elif v == 'T':
-                    v = True
-                elif v == 'F':
-                    v = False
-                else:
-                    v = int(v)
-
-                headers[k.strip()] = v
-
-        card_num += 1
+    storage_blob = incoming_bucket.blob(bucket_path)
+    headers = fits_header_cache.lookup(storage_blob, generation=generation)
 
     logger.debug(f'Headers: {headers}')
+    logger.debug(f'Header cache: {fits_header_cache.stats!r}')
     return headers
@@ -0,0 +1,80 @@
+"""Copy and move the uploaded files from the incoming bucket.
+
+The blob handles are made without fetching their metadata, and the copies use
+`rewrite`, which is repeated with the returned token until the object is
+copied, so large objects and copies between locations or storage classes do
+not time out. The copies to every destination run at the same time and the
+incoming blob is only removed once they have all finished.
+
+When the generation of the uploaded blob is known, the copies are of that
+generation and the removal only happens if the blob has not been replaced
+since, so a file uploaded again while it was being moved is not lost.
+"""
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import exceptions
+from panoptes.utils.logger import logger
+
+
+def route_blob(source_bucket, blob_name, destinations, remove=True, generation=None):
+    """Copy the blob to each of the `destinations`, then remove it if requested.
+
+    Args:
+        source_bucket (`google.cloud.storage.bucket.Bucket`): The bucket of the blob.
+        blob_name (str): The relative path to the blob.
+        destinations (list): The `google.cloud.storage.bucket.Bucket`s to copy the blob to.
+        remove (bool, optional): If the blob should be removed afterwards, default True.
+        generation (int|str|None): The generation of the blob, if known.
+
+    Returns:
+        dict: The number of storage requests and the seconds taken.
+    """
+    t0 = time.time()
+    generation = int(generation) if generation is not None else None
+    source_blob = source_bucket.blob(blob_name, generation=generation)
+
+    with ThreadPoolExecutor(max_workers=max(len(destinations), 1)) as executor:
+        num_requests = sum(executor.map(lambda bucket: rewrite_blob(source_blob, bucket), destinations))
+
+    if remove:
+        num_requests += 1
+        try:
+            source_bucket.delete_blob(blob_name, if_generation_match=generation)
+        except exceptions.NotFound:
+            logger.warning(f'{blob_name} was already removed from {source_bucket.name}')
+        except exceptions.PreconditionFailed:
+            logger.warning(f'{blob_name} was uploaded again, not removing it from {source_bucket.name}')
+
+    routing_info = dict(blob_name=blob_name,
+                        destinations=[bucket.name for bucket in destinations],
+                        removed=remove,
+                        requests=num_requests,
+                        seconds=round(time.time() - t0, 3))
+    logger.info(json.dumps(dict(blob_routing=routing_info)))
+
+    return routing_info
+
+
+def rewrite_blob(source_blob, bucket, new_name=None):
+    """Copy the blob to the bucket with `rewrite`, until it is done.
+
+    Args:
+        source_blob (`google.cloud.storage.blob.Blob`): The blob to copy.
+        bucket (`google.cloud.storage.bucket.Bucket`): The destination bucket.
+        new_name (str|None): The name of the copy, default the name of the blob.
+
+    Returns:
+        int: The number of rewrite requests.
+    """
+    logger.debug(f'Copying {source_blob.name} → {bucket.name}')
+    new_blob = bucket.blob(new_name or source_blob.name)
+
+    token, _, _ = new_blob.rewrite(source_blob)
+    num_requests = 1
+    while token is not None:
+        token, _, _ = new_blob.rewrite(source_blob, token=token)
+        num_requests += 1
+
+    return num_requests